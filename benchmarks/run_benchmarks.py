@@ -0,0 +1,259 @@
+"""
+Benchmarks of the hot paths of pyCeterisParibus
+
+For every benchmark wall time (median of repeats), peak memory traced with tracemalloc
+and the number of calls of the predict function are reported.
+Results are stored in json, so they might be compared with a baseline from a previous release.
+Sizes of the small suite are chosen so that every benchmark runs for at least ~100ms,
+shorter timings are dominated by noise of the machine.
+
+Run from the main directory of the repository:
+    python -m benchmarks.run_benchmarks --suite small --output results.json --baseline benchmarks/baseline_small.json
+"""
+import argparse
+import json
+import os
+import platform
+import sys
+import tempfile
+import time
+import tracemalloc
+import warnings
+
+import numpy as np
+import pandas as pd
+
+from ceteris_paribus.explainer import explain
+from ceteris_paribus.gower import gower_distances
+from ceteris_paribus.profiles import individual_variable_profile
+from ceteris_paribus.select_data import select_neighbours, select_sample, select_neighbours_batch
+from ceteris_paribus.utils import save_profiles
+
+# parameters of subsequent runs of every benchmark, scaling sizes of the data
+SUITES = {
+    'small': {
+        'profile': [dict(rows=2000, variables=5, grid_points=101, observations=2000),
+                    dict(rows=1000, variables=10, grid_points=101, observations=500)],
+        'gower_distances': [dict(rows=500000, variables=10)],
+        'select_neighbours': [dict(rows=600000, variables=10, n=20)],
+        'select_neighbours_batch': [dict(rows=10000, variables=10, observations=250, n=20)],
+        'select_sample': [dict(rows=1500000, variables=10, n=750000)],
+        'dump_profiles': [dict(rows=1000, variables=10, grid_points=101, observations=50)],
+    },
+    'large': {
+        'profile': [dict(rows=10000, variables=20, grid_points=101, observations=100),
+                    dict(rows=100000, variables=50, grid_points=101, observations=200)],
+        'gower_distances': [dict(rows=1000000, variables=20)],
+        'select_neighbours': [dict(rows=1000000, variables=20, n=20)],
+        'select_neighbours_batch': [dict(rows=1000000, variables=20, observations=5000, n=20)],
+        'select_sample': [dict(rows=1000000, variables=20, n=1000)],
+        'dump_profiles': [dict(rows=10000, variables=20, grid_points=101, observations=500)],
+    }
+}
+
+
+def make_data(rows, variables, seed=42):
+    """
+    Create synthetic data with mixed types of columns: floats, integers, strings and booleans
+    """
+    rng = np.random.RandomState(seed)
+    columns = []
+    for i in range(variables):
+        kind = i % 4
+        if kind == 0:
+            values = rng.normal(size=rows)
+        elif kind == 1:
+            values = rng.randint(0, 100, rows)
+        elif kind == 2:
+            values = rng.choice(['a', 'b', 'c', 'd', 'e'], rows)
+        else:
+            values = rng.random_sample(rows) > 0.5
+        columns.append(('x{}'.format(i), values))
+    return pd.DataFrame.from_dict(dict(columns))[[name for name, _ in columns]]
+
+
+class CountingModel:
+
+    def __init__(self):
+        """
+        Cheap dummy model counting calls of the predict function
+        """
+        self.calls = 0
+        self.rows = 0
+
+    def predict(self, df):
+        self.calls += 1
+        self.rows += len(df)
+        result = np.zeros(len(df))
+        for i, column in enumerate(df.columns):
+            values = df[column]
+            if values.dtype == object and isinstance(values.iloc[0], str):
+                result += (values == 'a').values
+            else:
+                result += values.values.astype(float) * (i + 1)
+        return result
+
+
+def _profile(rows, variables, grid_points, observations):
+    data = make_data(rows, variables)
+    model = CountingModel()
+    explainer = explain(model, data=data, label='counting_model')
+    new_observation = data.iloc[:observations]
+
+    def run():
+        individual_variable_profile(explainer, new_observation, grid_points=grid_points)
+
+    return run, model
+
+
+def _gower_distances(rows, variables):
+    data = make_data(rows, variables)
+    observation = data.iloc[0]
+    return lambda: gower_distances(data, observation), None
+
+
+def _select_neighbours(rows, variables, n):
+    data = make_data(rows, variables)
+    observation = data.iloc[0]
+    return lambda: select_neighbours(data, observation, n=n), None
+
+
+def _select_neighbours_batch(rows, variables, observations, n):
+    data = make_data(rows, variables)
+    return lambda: select_neighbours_batch(data, data.iloc[:observations], n=n, n_jobs=-1), None
+
+
+def _select_sample(rows, variables, n):
+    data = make_data(rows, variables)
+    return lambda: select_sample(data, n=n), None
+
+
+def _dump_profiles(rows, variables, grid_points, observations):
+    data = make_data(rows, variables)
+    explainer = explain(CountingModel(), data=data, label='counting_model')
+    cp = individual_variable_profile(explainer, data.iloc[:observations], grid_points=grid_points)
+    filename = os.path.join(tempfile.mkdtemp(), 'profile.js')
+
+    def run():
+        save_profiles([cp], filename, orient='columns', indent=None)
+
+    return run, None
+
+
+BENCHMARKS = {
+    'profile': _profile,
+    'gower_distances': _gower_distances,
+    'select_neighbours': _select_neighbours,
+    'select_neighbours_batch': _select_neighbours_batch,
+    'select_sample': _select_sample,
+    'dump_profiles': _dump_profiles,
+}
+
+
+def measure(name, params, repeat=5):
+    """
+    Measure a single benchmark
+
+    :return: dict with the benchmark name, parameters, the median and the best wall time in seconds, peak memory in bytes and predict calls per run
+    """
+    run, model = BENCHMARKS[name](**params)
+    seconds = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        run()
+        seconds.append(time.perf_counter() - start)
+
+    # memory is measured in a separate run, as tracing slows down the execution
+    tracemalloc.start()
+    run()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    result = dict(benchmark=name, params=params, seconds=float(np.median(seconds)), seconds_min=min(seconds),
+                  peak_memory_bytes=peak)
+    if model is not None:
+        runs = repeat + 1
+        result['predict_calls'] = model.calls // runs
+        result['predicted_rows'] = model.rows // runs
+    return result
+
+
+def run_suite(suite, repeat=5, selected=None):
+    results = []
+    for name, runs in SUITES[suite].items():
+        if selected and name not in selected:
+            continue
+        for params in runs:
+            result = measure(name, params, repeat)
+            print("{:<24} {:<70} {:>10.4f}s {:>12.1f}MB".format(
+                name, json.dumps(params), result['seconds'], result['peak_memory_bytes'] / 2 ** 20))
+            results.append(result)
+    return results
+
+
+def metadata(suite):
+    return dict(suite=suite, python=platform.python_version(), numpy=np.__version__, pandas=pd.__version__,
+                platform=platform.platform(), processor=platform.processor(),
+                date=time.strftime('%Y-%m-%d %H:%M:%S'))
+
+
+def _key(result):
+    return result['benchmark'], json.dumps(result['params'], sort_keys=True)
+
+
+def compare(results, baseline, tolerance=0.3, min_seconds=0.05):
+    """
+    Compare results with the baseline
+
+    :param tolerance: allowed relative increase of time, memory or predict calls
+    :param min_seconds: allowed absolute increase of the median time, smaller changes are treated as noise
+    :return: list of descriptions of regressions
+    """
+    baseline = dict((_key(result), result) for result in baseline['results'])
+    regressions = []
+    for result in results:
+        reference = baseline.get(_key(result))
+        if reference is None:
+            continue
+        for metric in ['seconds', 'peak_memory_bytes', 'predict_calls']:
+            if metric not in result or not reference.get(metric):
+                continue
+            ratio = result[metric] / reference[metric]
+            if metric == 'seconds' and result[metric] - reference[metric] <= min_seconds:
+                continue
+            if ratio > 1 + tolerance:
+                regressions.append("{} {} {}: {:.3g} -> {:.3g} ({:.2f}x)".format(
+                    result['benchmark'], json.dumps(result['params']), metric, reference[metric], result[metric],
+                    ratio))
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmarks of pyCeterisParibus')
+    parser.add_argument('--suite', choices=sorted(SUITES), default='small')
+    parser.add_argument('--benchmarks', nargs='*', choices=sorted(BENCHMARKS), help='run only selected benchmarks')
+    parser.add_argument('--repeat', type=int, default=5, help='number of timed runs, the median is reported')
+    parser.add_argument('--output', help='json file for the results')
+    parser.add_argument('--baseline', help='json file with results to compare with')
+    parser.add_argument('--tolerance', type=float, default=0.3, help='allowed relative regression')
+    parser.add_argument('--min-seconds', type=float, default=0.05,
+                        help='allowed absolute regression of the median time in seconds')
+    args = parser.parse_args(argv)
+    # warnings of pandas about object columns of the synthetic data are not relevant here
+    warnings.simplefilter('ignore', FutureWarning)
+
+    results = run_suite(args.suite, args.repeat, args.benchmarks)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(dict(metadata=metadata(args.suite), results=results), f, indent=2)
+    if args.baseline:
+        with open(args.baseline, 'r') as f:
+            regressions = compare(results, json.load(f), args.tolerance, args.min_seconds)
+        for regression in regressions:
+            print("Regression: " + regression)
+        return 1 if regressions else 0
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
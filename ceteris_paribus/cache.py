@@ -0,0 +1,295 @@
+""" This is the module for caching predictions of the model and splits of variables """
+import hashlib
+import pickle
+import threading
+import weakref
+from collections import OrderedDict, namedtuple
+
+import numpy as np
+import pandas as pd
+
+from ceteris_paribus.data import ChunkedData, _is_sparse_matrix
+
+CacheStats = namedtuple("CacheStats", "hits misses entries bytes")
+
+# marks rows that are not in the cache
+_MISSING = object()
+
+
+class PredictionCache:
+
+    def __init__(self, predict_function, max_entries=1000000, max_bytes=None):
+        """
+        Creates LRU cache of predictions, which can be used in place of the predict function
+
+        Predictions are cached for single rows of the data, identified by 64-bit hashes of their values
+        calculated with `pandas.util.hash_pandas_object`. Only rows not found in the cache are passed
+        to the predict function, each of them once per call.
+
+        :param predict_function: function that takes the data and returns predictions
+        :param max_entries: maximal number of cached rows
+        :param max_bytes: maximal size of cached predictions in bytes (with 8 bytes of a key per row), if None then not limited
+        """
+        self._predict_function = predict_function
+        self._max_entries = max_entries
+        self._max_bytes = max_bytes
+        self._cache = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def __call__(self, X):
+        """
+        Predict with the cached values for rows scored before
+
+        :param X: DataFrame or array with the data
+        :return: array of predictions
+        """
+        keys = _hash_rows(X)
+        with self._lock:
+            values = [self._get(key) for key in keys]
+        missing = [i for i, value in enumerate(values) if value is _MISSING]
+        if missing:
+            # identical rows are scored only once
+            missing_keys, first, inverse = np.unique(keys[missing], return_index=True, return_inverse=True)
+            rows = np.asarray(missing)[first]
+            predictions = np.asarray(self._predict_function(X.iloc[rows] if isinstance(X, pd.DataFrame) else X[rows]))
+            with self._lock:
+                for key, prediction in zip(missing_keys, predictions):
+                    self._put(key, prediction)
+            for i, position in zip(missing, inverse):
+                values[i] = predictions[position]
+        with self._lock:
+            self.hits += len(values) - len(missing)
+            self.misses += len(missing)
+        return np.array(values)
+
+    def __getstate__(self):
+        # workers of a process pool get an empty cache of their own
+        state = self.__dict__.copy()
+        del state['_lock']
+        state.update(_cache=OrderedDict(), _bytes=0, hits=0, misses=0)
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+
+    def _get(self, key):
+        value = self._cache.get(key, _MISSING)
+        if value is not _MISSING:
+            self._cache.move_to_end(key)
+        return value
+
+    def _put(self, key, value):
+        if key in self._cache:
+            return
+        self._cache[key] = value
+        self._bytes += _entry_size(value)
+        while len(self._cache) > self._max_entries or (self._max_bytes is not None and self._bytes > self._max_bytes):
+            _, evicted = self._cache.popitem(last=False)
+            self._bytes -= _entry_size(evicted)
+
+    def stats(self):
+        """
+        :return: CacheStats with numbers of hits and misses, number of cached rows and their size in bytes
+        """
+        with self._lock:
+            return CacheStats(self.hits, self.misses, len(self._cache), self._bytes)
+
+    def clear(self):
+        """
+        Remove all cached predictions and reset statistics
+        """
+        with self._lock:
+            self._cache.clear()
+            self._bytes = 0
+            self.hits = 0
+            self.misses = 0
+
+
+def _hash_rows(X):
+    """
+    Return array of 64-bit hashes of rows
+    """
+    if _is_sparse_matrix(X):
+        return _hash_sparse_rows(X)
+    if not isinstance(X, pd.DataFrame):
+        X = pd.DataFrame(np.asarray(X))
+    return pd.util.hash_pandas_object(X, index=False).values
+
+
+def _hash_sparse_rows(X):
+    """
+    Return array of 64-bit hashes of rows of a SciPy sparse matrix without densifying it
+
+    Hashes of nonzero elements (column and value) are summed within rows, so the order of stored elements
+    and explicit zeros do not matter.
+    """
+    X = X.tocsr()
+    nonzero = X.data != 0
+    rows = np.repeat(np.arange(X.shape[0]), np.diff(X.indptr))[nonzero]
+    elements = pd.DataFrame({'column': X.indices[nonzero], 'value': X.data[nonzero]})
+    hashes = np.zeros(X.shape[0], dtype=np.uint64)
+    np.add.at(hashes, rows, pd.util.hash_pandas_object(elements, index=False).values)
+    return pd.util.hash_array(hashes)
+
+
+def _entry_size(value):
+    return np.asarray(value).nbytes + 8
+
+
+def cached_explainer(explainer, max_entries=1000000, max_bytes=None):
+    """
+    Wrap the predict function of the explainer with PredictionCache
+
+    The cache is shared by all profiles calculated with the returned explainer.
+    It is not shared between workers of a process pool, every worker starts with an empty copy
+    and predictions calculated by workers are not cached in the main process.
+
+    :param explainer: Explainer object
+    :param max_entries: maximal number of cached rows
+    :param max_bytes: maximal size of cached predictions in bytes, if None then not limited
+    :return: Explainer object with cached predict function, available as `explainer.predict_fun`
+    """
+    return explainer._replace(predict_fun=PredictionCache(explainer.predict_fun, max_entries, max_bytes))
+
+
+# number of rows sampled from the data to detect its changes
+_FINGERPRINT_ROWS = 1000
+
+# caches of splits for DataFrames alive, indexed by id of the DataFrame
+_SPLITS_CACHES = {}
+
+
+class SplitsCache:
+
+    def __init__(self):
+        """
+        Creates cache of variable splits calculated from the data of the explainer
+
+        Splits are identified by the variable name and options of the split (e.g. number of grid points).
+        The cache is bound to a fingerprint of the data - its shape, columns, types and hashes of
+        evenly spaced sample of rows. All splits are dropped when the fingerprint changes.
+        Changes of rows outside of the sample are not detected, so call `invalidate` after such changes.
+        """
+        self._fingerprint = None
+        self._splits = {}
+        self._lock = threading.Lock()
+
+    def get(self, data, variables, options=()):
+        """
+        Get cached splits for the data
+
+        :param data: DataFrame the splits are calculated from
+        :param variables: collection of variables
+        :param options: tuple with options of the split
+        :return: mapping of variables found in the cache into their splits
+        """
+        fingerprint = _data_fingerprint(data)
+        with self._lock:
+            if fingerprint != self._fingerprint:
+                self._splits.clear()
+                self._fingerprint = fingerprint
+            return dict((var, self._splits[(var, options)]) for var in variables if (var, options) in self._splits)
+
+    def update(self, data, variable_splits, options=()):
+        """
+        Store splits calculated from the data
+
+        :param data: DataFrame the splits are calculated from
+        :param variable_splits: mapping of variables into splits
+        :param options: tuple with options of the split
+        """
+        fingerprint = _data_fingerprint(data)
+        with self._lock:
+            if fingerprint != self._fingerprint:
+                self._splits.clear()
+                self._fingerprint = fingerprint
+            for var, split in variable_splits.items():
+                self._splits[(var, options)] = split
+
+    def invalidate(self):
+        """
+        Remove all cached splits
+        """
+        with self._lock:
+            self._splits.clear()
+            self._fingerprint = None
+
+    def __len__(self):
+        return len(self._splits)
+
+    def save(self, filename):
+        """
+        Save the cache with pickle, so it might be reloaded by another process
+
+        :param filename: path to the file
+        """
+        with self._lock:
+            state = dict(fingerprint=self._fingerprint, splits=dict(self._splits))
+        with open(filename, 'wb') as f:
+            pickle.dump(state, f)
+
+    @classmethod
+    def load(cls, filename):
+        """
+        Load the cache saved with `save`
+
+        Loaded splits are used only if the fingerprint of the data matches.
+
+        :param filename: path to the file
+        :return: SplitsCache object
+        """
+        with open(filename, 'rb') as f:
+            state = pickle.load(f)
+        cache = cls()
+        cache._fingerprint = state['fingerprint']
+        cache._splits = state['splits']
+        return cache
+
+
+def _data_fingerprint(data):
+    """
+    Return fingerprint of the DataFrame based on its shape, columns, types and a sample of rows
+    """
+    if isinstance(data, ChunkedData):
+        # reading a sample of out-of-core data is expensive
+        return data.fingerprint()
+    step = max(1, len(data) // _FINGERPRINT_ROWS)
+    hashes = pd.util.hash_pandas_object(data.iloc[::step], index=False).values
+    return (data.shape, tuple(data.columns), tuple(str(dtype) for dtype in data.dtypes),
+            hashlib.sha1(hashes.tobytes()).hexdigest())
+
+
+def _data_splits_cache(data, cache=None):
+    """
+    Get cache of splits bound to the DataFrame, if `cache` is given then it replaces the current one
+    """
+    key = id(data)
+    entry = _SPLITS_CACHES.get(key)
+    if entry is not None and entry[0]() is data and cache is None:
+        return entry[1]
+    if cache is None:
+        cache = SplitsCache()
+    # the entry is removed together with the DataFrame
+    _SPLITS_CACHES[key] = (weakref.ref(data, lambda _: _SPLITS_CACHES.pop(key, None)), cache)
+    return cache
+
+
+def splits_cache(explainer, cache=None):
+    """
+    Get cache of variable splits shared by all profiles calculated with the explainer
+
+    The cache is bound to the data of the explainer and it is filled automatically when the profiles are calculated.
+    It might be saved with `SplitsCache.save` and attached again to an explainer in another process,
+    so that the splits are not calculated from the data again.
+
+    :param explainer: Explainer object
+    :param cache: SplitsCache object to be attached to the explainer, e.g. loaded with `SplitsCache.load`
+    :return: SplitsCache object used by the explainer
+    """
+    if explainer.data is None:
+        raise ValueError("Explainer has no data to calculate splits from")
+    return _data_splits_cache(explainer.data, cache)
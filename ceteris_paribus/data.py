@@ -0,0 +1,180 @@
+""" This is the module for data which does not fit in memory and is processed chunk by chunk """
+import os
+
+import numpy as np
+import pandas as pd
+
+
+class ChunkedData:
+
+    def __init__(self, source, columns=None, chunk_size=100000):
+        """
+        Creates a view of out-of-core data read chunk by chunk
+
+        Supported sources are 2D numpy arrays (in particular `np.memmap`), `pyarrow.Table` and paths to Parquet files.
+        Arrow and Parquet sources require pyarrow. Rows are read only when iterating over chunks or taking selected rows.
+
+        :param source: numpy array, pyarrow Table or path to a Parquet file
+        :param columns: names of columns of an array, for Arrow and Parquet sources a subset of columns to be used
+        :param chunk_size: number of rows in a single chunk
+        """
+        self._source = source
+        self.chunk_size = chunk_size
+        if isinstance(source, str):
+            self.kind = 'parquet'
+            parquet = _import_pyarrow('parquet')
+            self._file = parquet.ParquetFile(source)
+            names = list(self._file.schema_arrow.names)
+            self._n_rows = self._file.metadata.num_rows
+        elif isinstance(source, np.ndarray):
+            self.kind = 'array'
+            if source.ndim != 2:
+                raise ValueError("Array data has to be 2D")
+            names = list(columns) if columns is not None else list(range(source.shape[1]))
+            if len(names) != source.shape[1]:
+                raise ValueError("Incorrect number of variables given.")
+            self._n_rows = source.shape[0]
+        elif _is_arrow_table(source):
+            self.kind = 'arrow'
+            names = list(source.column_names)
+            self._n_rows = source.num_rows
+        else:
+            raise ValueError("Unsupported data source {}".format(type(source)))
+        if columns is not None and self.kind != 'array':
+            if not set(columns).issubset(names):
+                raise ValueError("Columns {} not found in the data".format(set(columns) - set(names)))
+            names = list(columns)
+        self.columns = names
+
+    @property
+    def shape(self):
+        return self._n_rows, len(self.columns)
+
+    def __len__(self):
+        return self._n_rows
+
+    def iter_chunks(self, columns=None, chunk_size=None):
+        """
+        Iterate over subsequent rows of the data
+
+        :param columns: columns to be read, if None then all columns
+        :param chunk_size: number of rows in a single chunk, if None then `self.chunk_size`
+        :return: generator of DataFrames indexed by positions of rows
+        """
+        columns = self.columns if columns is None else list(columns)
+        chunk_size = chunk_size or self.chunk_size
+        if self.kind == 'parquet':
+            start = 0
+            for batch in self._file.iter_batches(batch_size=chunk_size, columns=columns):
+                chunk = batch.to_pandas()
+                chunk.index = pd.RangeIndex(start, start + len(chunk))
+                start += len(chunk)
+                yield chunk[columns]
+            return
+        for start in range(0, self._n_rows, chunk_size):
+            yield self._slice(start, min(start + chunk_size, self._n_rows), columns)
+
+    def _slice(self, start, stop, columns):
+        if self.kind == 'array':
+            positions = [self.columns.index(column) for column in columns]
+            chunk = pd.DataFrame(np.asarray(self._source[start:stop][:, positions]), columns=columns)
+        else:
+            chunk = self._source.select(columns).slice(start, stop - start).to_pandas()
+        chunk.index = pd.RangeIndex(start, stop)
+        return chunk
+
+    def take(self, positions, columns=None):
+        """
+        Read selected rows
+
+        :param positions: positions of rows
+        :param columns: columns to be read, if None then all columns
+        :return: DataFrame with the rows in the order of positions, indexed by the positions
+        """
+        columns = self.columns if columns is None else list(columns)
+        positions = np.asarray(positions, dtype=np.int64)
+        if self.kind == 'array':
+            column_positions = [self.columns.index(column) for column in columns]
+            order = np.argsort(positions, kind='mergesort')
+            rows = np.empty((len(positions), len(columns)), dtype=self._source.dtype)
+            # sorted reads of a memory map are sequential
+            rows[order] = np.asarray(self._source[positions[order]][:, column_positions])
+            return pd.DataFrame(rows, columns=columns, index=positions)
+        if self.kind == 'arrow':
+            return self._source.select(columns).take(positions).to_pandas().set_index(pd.Index(positions))
+        unique = np.unique(positions)
+        selected = [chunk.loc[unique[(unique >= chunk.index[0]) & (unique <= chunk.index[-1])]]
+                    for chunk in self.iter_chunks(columns) if len(chunk)]
+        return pd.concat(selected or [pd.DataFrame(columns=columns)]).loc[positions]
+
+    def __getitem__(self, column):
+        """
+        Read a single column
+
+        :return: pandas Series with all values of the column
+        """
+        return pd.concat([chunk[column] for chunk in self.iter_chunks([column])])
+
+    def fingerprint(self):
+        """
+        Identify the source of the data, changes of files are detected by their modification times and sizes
+        """
+        if self.kind == 'parquet':
+            stat = os.stat(self._source)
+            source = (os.path.abspath(self._source), stat.st_mtime, stat.st_size)
+        elif isinstance(self._source, np.memmap) and self._source.filename is not None:
+            stat = os.stat(self._source.filename)
+            source = (self._source.filename, self._source.offset, stat.st_mtime, stat.st_size)
+        else:
+            source = (self.kind, id(self._source))
+        return self.shape, tuple(self.columns), source
+
+
+def _is_arrow_table(data):
+    return type(data).__module__.startswith('pyarrow') and type(data).__name__ == 'Table'
+
+
+def _is_sparse_matrix(data):
+    return type(data).__module__.startswith('scipy.sparse') and hasattr(data, 'tocsr')
+
+
+def _is_sparse_frame(data):
+    """
+    Check whether all columns of a DataFrame are sparse, as in frames created from SciPy sparse matrices
+    """
+    return isinstance(data, pd.DataFrame) and len(data.columns) > 0 and \
+        all(isinstance(dtype, pd.SparseDtype) for dtype in data.dtypes)
+
+
+def _import_scipy_sparse():
+    try:
+        import scipy.sparse
+        return scipy.sparse
+    except ImportError:
+        raise ImportError("scipy is required for sparse data, install it with `pip install scipy`")
+
+
+def _import_pyarrow(module=None):
+    try:
+        import pyarrow
+        if module == 'parquet':
+            import pyarrow.parquet
+            return pyarrow.parquet
+        return pyarrow
+    except ImportError:
+        raise ImportError("pyarrow is required for Arrow and Parquet data, install it with `pip install pyarrow`")
+
+
+def as_chunked_data(data, columns=None):
+    """
+    Wrap out-of-core data with ChunkedData
+
+    :param data: data passed to the explainer
+    :param columns: names of columns
+    :return: ChunkedData object or None if the data should be loaded into memory
+    """
+    if isinstance(data, ChunkedData):
+        return data
+    if isinstance(data, np.memmap) or isinstance(data, str) or _is_arrow_table(data):
+        return ChunkedData(data, columns)
+    return None
@@ -5,27 +5,48 @@ from collections import namedtuple
 import numpy as np
 import pandas as pd
 
+from ceteris_paribus.data import as_chunked_data, _is_sparse_matrix
+
 Explainer = namedtuple("Explainer", "model var_names data y predict_fun label")
 
 
+class _ValuesPredictFunction:
+
+    def __init__(self, model):
+        """
+        Predict function passing values of DataFrames to a model fitted on arrays
+
+        Unlike a lambda it can be pickled, so profiles can be scored in a process pool.
+
+        :param model: model with the `predict` method
+        """
+        self.model = model
+
+    def __call__(self, df):
+        return self.model.predict(df.values)
+
+
 def explain(model, variable_names=None, data=None, y=None, predict_function=None, label=None):
     """
     This function creates a unified representation of a model, which can be further processed by various explainers
 
     :param model: a model to be explained
     :param variable_names: names of variables, if not supplied then derived from data
-    :param data: data that was used for fitting
+    :param data: data that was used for fitting, data not fitting in memory might be given as `np.memmap`, `pyarrow.Table`, path to a Parquet file or `ChunkedData`, for SciPy sparse matrices the predict function takes sparse matrices as well
     :param y: labels for the data
     :param predict_function: function that takes the data and returns predictions
     :param label: label of the model, if not supplied the function will try to infer it from the model object, otherwise unset
     :return: Explainer object
     """
+    chunked_data = as_chunked_data(data, variable_names)
     if not predict_function:
         if hasattr(model, 'predict'):
-            if isinstance(data, pd.core.frame.DataFrame):
+            # models fitted on Arrow or Parquet data take DataFrames
+            frame_data = chunked_data is not None and chunked_data.kind != 'array'
+            if isinstance(data, pd.core.frame.DataFrame) or frame_data or _is_sparse_matrix(data):
                 predict_function = model.predict
             else:
-                predict_function = lambda df: model.predict(df.values)
+                predict_function = _ValuesPredictFunction(model)
         else:
             raise ValueError('Unable to find predict function')
     if not label:
@@ -35,14 +56,23 @@ def explain(model, variable_names=None, data=None, y=None, predict_function=None
             label = label_items[0]
         else:
             label = 'unlabeled_model'
+    if chunked_data is not None:
+        # data is read chunk by chunk when needed
+        data = chunked_data
+        variable_names = chunked_data.columns
     if variable_names is None:
         if isinstance(data, pd.core.frame.DataFrame):
             variable_names = list(data)
         else:
             raise ValueError("Unable to impute the variable names. Those must be supplied directly!")
 
-    if data is not None:
-        if not isinstance(data, pd.core.frame.DataFrame):
+    if data is not None and chunked_data is None:
+        if _is_sparse_matrix(data):
+            if len(variable_names) != data.shape[1]:
+                raise ValueError("Incorrect number of variables given.")
+            # profiles are scored on sparse grids, see `CeterisParibus._scoring_grid`
+            data = pd.DataFrame.sparse.from_spmatrix(data, columns=variable_names)
+        elif not isinstance(data, pd.core.frame.DataFrame):
             data = np.array(data)
             if data.ndim == 1:
                 # make 1D array 2D
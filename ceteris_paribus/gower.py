@@ -1,8 +1,14 @@
 """ This is the module for calculating gower's distance/dissimilarity """
+from collections import namedtuple
 
 import numpy as np
 import pandas as pd
 
+# Data prepared for distance calculations:
+# numeric columns as a column-major float matrix with their minima and maxima,
+# remaining columns as integer codes (-1 for missing values) with the mapping of values into codes
+_EncodedData = namedtuple("_EncodedData", "numeric_mask numeric mins maxs codes categories")
+
 
 # Normalize the array
 def _normalize_mixed_data_columns(arr):
@@ -27,6 +33,7 @@ def _calc_range_mixed_data_columns(data, observation, dtypes):
 def _gower_dist(xi, xj, ranges, dtypes):
     """
     Return gower's distance between xi and xj
+    Reference implementation for a single pair, `gower_distances` computes the same values for whole columns at once
 
     :param ranges: ranges of values for each column
     :param dtypes: types of each column
@@ -55,7 +62,173 @@ def _gower_dist(xi, xj, ranges, dtypes):
     return sum_sij / sum_wij
 
 
-def gower_distances(data, observation):
+def _numeric_mask(dtypes):
+    """ Return boolean mask of numeric columns, the remaining columns are treated as categorical """
+    return np.array([not isinstance(dtype, pd.api.types.CategoricalDtype) and np.issubdtype(dtype, np.number)
+                     for dtype in dtypes], dtype=bool)
+
+
+def _encode_mixed_data(data, dtype=np.float64):
+    """
+    Prepare the data for vectorized distance calculations
+
+    :type data: DataFrame
+    :param dtype: floating point type of the numeric matrix
+    :return: _EncodedData
+    """
+    numeric_mask = _numeric_mask(data.dtypes)
+    numeric = np.asfortranarray(data.iloc[:, np.flatnonzero(numeric_mask)].values, dtype=dtype)
+    if len(numeric):
+        mins = np.fmin.reduce(numeric, axis=0)
+        maxs = np.fmax.reduce(numeric, axis=0)
+    else:
+        mins = maxs = np.full(numeric.shape[1], np.nan, dtype=dtype)
+    codes = np.empty((data.shape[0], np.count_nonzero(~numeric_mask)), dtype=np.int64, order='F')
+    categories = []
+    for i, col in enumerate(np.flatnonzero(~numeric_mask)):
+        codes[:, i], uniques = pd.factorize(data.iloc[:, col])
+        categories.append(pd.Index(uniques))
+    return _EncodedData(numeric_mask, numeric, mins, maxs, codes, categories)
+
+
+def _encode_observation(encoded, observation):
+    """
+    Encode the observation in the same way as the data in `encoded`
+
+    Missing categorical values are coded as -1, values not present in the data as -2.
+
+    :return: numeric values (with NaNs for missing values) and categorical codes
+    """
+    observation = _normalize_mixed_data_columns(observation)
+    numeric = np.array([np.nan if pd.isnull(value) else value for value in observation[encoded.numeric_mask]],
+                       dtype=np.float64)
+    codes = np.empty(len(encoded.categories), dtype=np.int64)
+    for i, value in enumerate(observation[~encoded.numeric_mask]):
+        if pd.isnull(value):
+            codes[i] = -1
+        else:
+            position = encoded.categories[i].get_indexer([value])[0]
+            codes[i] = position if position >= 0 else -2
+    return numeric, codes
+
+
+def _gower_distances_encoded(encoded, numeric, codes, dtype=np.float64):
+    """
+    Return an array of distances between all rows of the encoded data and a single encoded observation
+
+    Columns are processed one by one in their original order,
+    so the sums are accumulated exactly as in `_gower_dist`.
+    """
+    rows = encoded.codes.shape[0]
+    ranges = np.fmax(encoded.maxs, numeric) - np.fmin(encoded.mins, numeric)
+    sum_sij = np.zeros(rows, dtype=dtype)
+    sum_wij = np.zeros(rows, dtype=dtype)
+    buffer = np.empty(rows, dtype=dtype)
+    numeric_col, categorical_col = 0, 0
+    for is_numeric in encoded.numeric_mask:
+        if is_numeric:
+            col_range = ranges[numeric_col]
+            value = numeric[numeric_col]
+            column = encoded.numeric[:, numeric_col]
+            numeric_col += 1
+            if np.isnan(value) or np.isclose(0, col_range):
+                continue
+            np.subtract(column, value, out=buffer)
+            np.abs(buffer, out=buffer)
+            buffer /= col_range
+            valid = ~np.isnan(buffer)
+            sum_sij += np.where(valid, buffer, 0)
+            sum_wij += valid
+        else:
+            value = codes[categorical_col]
+            column = encoded.codes[:, categorical_col]
+            categorical_col += 1
+            sum_sij += column != value
+            if value == -1:
+                # pairs of missing values are skipped
+                sum_wij += column != -1
+            else:
+                sum_wij += 1
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return sum_sij / sum_wij
+
+
+def _encode_observations(encoded, observations):
+    """
+    Encode many observations at once in the same way as `_encode_observation`
+
+    :param observations: 2D array or DataFrame with observations in rows
+    :return: matrix of numeric values (with NaNs for missing values) and matrix of categorical codes
+    """
+    observations = np.array(observations, dtype=object)
+    values = observations[:, encoded.numeric_mask]
+    numeric = np.where(pd.isnull(values), np.nan, values).astype(np.float64)
+    codes = np.empty((len(observations), len(encoded.categories)), dtype=np.int64)
+    for i, col in enumerate(np.flatnonzero(~encoded.numeric_mask)):
+        values = observations[:, col]
+        positions = encoded.categories[i].get_indexer(values)
+        codes[:, i] = np.where(pd.isnull(values), -1, np.where(positions >= 0, positions, -2))
+    return numeric, codes
+
+
+def _gower_distances_block(encoded, numeric, codes, rows=slice(None), dtype=np.float64):
+    """
+    Return a matrix of distances between encoded observations (in rows) and a block of rows of the encoded data
+
+    Element-wise operations are the same as in `_gower_distances_encoded`, so the distances are equal.
+
+    :param numeric: matrix of numeric values of the observations
+    :param codes: matrix of categorical codes of the observations
+    :param rows: slice with the block of rows of the data
+    """
+    block_numeric = encoded.numeric[rows]
+    block_codes = encoded.codes[rows]
+    shape = (codes.shape[0], block_codes.shape[0])
+    ranges = np.fmax(encoded.maxs, numeric) - np.fmin(encoded.mins, numeric)
+    sum_sij = np.zeros(shape, dtype=dtype)
+    sum_wij = np.zeros(shape, dtype=dtype)
+    buffer = np.empty(shape, dtype=dtype)
+    weight = 0
+    numeric_col, categorical_col = 0, 0
+    with np.errstate(divide='ignore', invalid='ignore'):
+        for is_numeric in encoded.numeric_mask:
+            if is_numeric:
+                col_range = ranges[:, numeric_col]
+                values = numeric[:, numeric_col]
+                column = block_numeric[:, numeric_col]
+                numeric_col += 1
+                # columns are skipped for observations with missing values or constant columns
+                active = ~np.isnan(values) & ~np.isclose(0, col_range)
+                if not active.any():
+                    continue
+                np.subtract(column[np.newaxis, :], values[:, np.newaxis], out=buffer)
+                np.abs(buffer, out=buffer)
+                buffer /= col_range[:, np.newaxis]
+                if active.all() and not np.isnan(column).any():
+                    # masks are not needed when there are no missing values
+                    sum_sij += buffer
+                    weight += 1
+                else:
+                    valid = ~np.isnan(buffer) & active[:, np.newaxis]
+                    sum_sij += np.where(valid, buffer, 0)
+                    sum_wij += valid
+            else:
+                values = codes[:, categorical_col]
+                column = block_codes[:, categorical_col]
+                categorical_col += 1
+                sum_sij += column[np.newaxis, :] != values[:, np.newaxis]
+                # pairs of missing values are skipped
+                if (values == -1).any():
+                    sum_wij += np.where((values == -1)[:, np.newaxis], column[np.newaxis, :] != -1, True)
+                else:
+                    weight += 1
+        # weights of columns without missing values are added at once
+        sum_wij += weight
+        return sum_sij / sum_wij
+
+
+def gower_distances(data, observation, dtype=np.float64):
     """
     Return an array of distances between all observations and a chosen one
     Based on:
@@ -64,9 +237,8 @@ def gower_distances(data, observation):
     
     :type data: DataFrame
     :type observation: pandas Series
+    :param dtype: floating point type used for the calculations, np.float32 halves the memory usage
     """
-    dtypes = data.dtypes
-    data = _normalize_mixed_data_columns(data)
-    observation = _normalize_mixed_data_columns(observation)
-    ranges = _calc_range_mixed_data_columns(data, observation, dtypes)
-    return np.array([_gower_dist(row, observation, ranges, dtypes) for row in data])
+    encoded = _encode_mixed_data(data, dtype)
+    numeric, codes = _encode_observation(encoded, observation)
+    return _gower_distances_encoded(encoded, numeric, codes, dtype)
@@ -569,6 +569,13 @@
             this.aggregate_profiles_ = null;
         }
 
+        // aggregated profiles calculated in python, used when profiles are downsampled before plotting
+        if (options.hasOwnProperty('aggregated_profiles') && options.aggregated_profiles !== null) {
+            this.aggregated_profiles_ = options.aggregated_profiles;
+        } else {
+            this.aggregated_profiles_ = null;
+        }
+
 
         try {
             this.scaleColorPrepare_();
@@ -786,15 +793,21 @@
 
         var scaleY = d3.scaleLinear().rangeRound([this.heightAvail_ - this.length_rugs_ - 5, 0]);
 
+        var aggregated = this.aggregated_profiles_ || [];
+
         var minScaleY = d3.min([d3.min(data, function (d) {
                 return d["_yhat_"];
             }), d3.min(dataObs, function (d) {
                 return d["_y_"];
+            }), d3.min(aggregated, function (d) {
+                return d3.min(d["_yhat_"]);
             })]),
             maxScaleY = d3.max([d3.max(data, function (d) {
                 return d["_yhat_"];
             }), d3.max(dataObs, function (d) {
                 return d["_y_"];
+            }), d3.max(aggregated, function (d) {
+                return d3.max(d["_yhat_"]);
             })]);
 
         scaleY.domain([minScaleY, maxScaleY]).nice();
@@ -1642,6 +1655,17 @@
                 })
                 .entries(dataVar);
         }
+        if (this.aggregated_profiles_ !== null) {
+            var nested_data = this.aggregated_profiles_.filter(function (d) {
+                return d['_vname_'] == variable;
+            }).map(function (d) {
+                return {
+                    key: d['_label_'], values: d['x'].map(function (x, i) {
+                        return {key: x, value: d['_yhat_'][i]};
+                    })
+                };
+            });
+        }
 
 
         if (typeof scaleX.domain()[0] == 'number') {
@@ -1,27 +1,209 @@
+import html
 import json
 import logging
 import os
+import re
 import sys
+import time
+import uuid
 import webbrowser
-from shutil import copyfile
+from collections import namedtuple
+from shutil import copyfileobj
 
-from flask import Flask, render_template
+import numpy as np
 
 from ceteris_paribus.plots import PLOTS_DIR
-from ceteris_paribus.utils import save_observations, save_profiles
+from ceteris_paribus.utils import save_observations, save_profiles, dump_observations, dump_profiles_columns, \
+    dump_profiles_compressed, default, atomic_open
 
-app = Flask(__name__, template_folder=PLOTS_DIR)
+EvictionPolicy = namedtuple("EvictionPolicy", "max_files max_bytes max_age")
 
-MAX_PLOTS_PER_SESSION = 10000
+# limits of the output directory, by default plots are never removed
+_EVICTION_POLICY = EvictionPolicy(None, None, None)
 
-# generates ids for subsequent plots
-_PLOT_NUMBER = iter(range(MAX_PLOTS_PER_SESSION))
-
-# directory with all files produced in plot generation process
+# directory with all files produced in plot generation process, it is created with the first plot
 _DATA_PATH = '_plot_files'
-os.makedirs(_DATA_PATH, exist_ok=True)
 _D3_engine_filename = 'ceterisParibusD3.js'
-copyfile(os.path.join(PLOTS_DIR, _D3_engine_filename), os.path.join(_DATA_PATH, _D3_engine_filename))
+
+# directories the engine has been already copied into
+_PREPARED_PATHS = set()
+
+# files of a plot are named with the kind of the content followed by the plot id
+_PLOT_FILE = re.compile(r"^(plots|params|obs|profile)([0-9a-f]{32})\.(html|js)$")
+
+# placeholders of templates: {{name}} is escaped, {{name|safe}} is inserted as it is
+_PLACEHOLDER = re.compile(r"{{\s*(\w+)\s*(\|\s*safe\s*)?}}")
+
+# libraries embedded in single file plots are read from this directory, see `set_vendor_directory`
+_VENDOR_PATH = os.path.join(PLOTS_DIR, 'vendor')
+
+# files of the libraries, their urls and tags loading them from CDNs
+_LIBRARIES = [
+    ('d3.v5.min.js', 'https://d3js.org/d3.v5.min.js',
+     '<script src="https://d3js.org/d3.v5.min.js" charset="utf-8"></script>'),
+    ('jquery-3.3.1.min.js', 'https://code.jquery.com/jquery-3.3.1.min.js',
+     '<script src="https://code.jquery.com/jquery-3.3.1.min.js" '
+     'integrity="sha256-FgpCb/KJQlLNfOu91ta32o/NMZxltwRo8QtmkMRdAu8=" crossorigin="anonymous"></script>'),
+    ('jquery.dataTables.css', 'https://cdn.datatables.net/1.10.19/css/jquery.dataTables.css',
+     '<link rel="stylesheet" type="text/css" href="https://cdn.datatables.net/1.10.19/css/jquery.dataTables.css">'),
+    ('jquery.dataTables.js', 'https://cdn.datatables.net/1.10.19/js/jquery.dataTables.js',
+     '<script type="text/javascript" charset="utf8" '
+     'src="https://cdn.datatables.net/1.10.19/js/jquery.dataTables.js"></script>'),
+]
+
+
+def set_vendor_directory(path):
+    """
+    Set the directory libraries embedded in single file plots are read from and downloaded into
+
+    By default it is `ceteris_paribus/plots/vendor` in the installed package, which might be read-only.
+
+    :param path: path of the directory
+    """
+    global _VENDOR_PATH
+    _VENDOR_PATH = path
+
+
+def fetch_vendor_libraries(overwrite=False, timeout=30):
+    """
+    Download the libraries embedded in single file plots into the vendor directory, see `set_vendor_directory`
+
+    It needs internet access once, afterwards plots written with `plot(..., bundle=True)` render offline.
+    On machines without internet access the files might be copied into the directory by hand.
+
+    :param overwrite: whether to download libraries already present in the directory
+    :param timeout: timeout of a single download in seconds
+    :return: list of paths of the downloaded files
+    """
+    from urllib.request import urlopen
+
+    os.makedirs(_VENDOR_PATH, exist_ok=True)
+    downloaded = []
+    for filename, url, _ in _LIBRARIES:
+        path = os.path.join(_VENDOR_PATH, filename)
+        if os.path.exists(path) and not overwrite:
+            continue
+        with urlopen(url, timeout=timeout) as response, atomic_open(path, 'wb') as f:
+            copyfileobj(response, f)
+        downloaded.append(path)
+    return downloaded
+
+
+def set_output_directory(path):
+    """
+    Set the directory plots are written into, by default it is `_plot_files` in the working directory
+
+    The directory is created with the first plot written into it.
+
+    :param path: path of the directory
+    """
+    global _DATA_PATH
+    _DATA_PATH = path
+
+
+def set_eviction_policy(max_files=None, max_bytes=None, max_age=None):
+    """
+    Limit the size of the output directory, the oldest plots are removed after a new one is written
+
+    Files of a plot are always removed together and the plot written last is kept regardless of the limits.
+    Only files of plots are taken into account, other files in the directory are never removed.
+
+    :param max_files: maximal number of files of plots
+    :param max_bytes: maximal total size of files of plots in bytes
+    :param max_age: maximal age of plots in seconds
+    """
+    global _EVICTION_POLICY
+    for name, limit in [('max_files', max_files), ('max_bytes', max_bytes), ('max_age', max_age)]:
+        if limit is not None and limit < 0:
+            raise ValueError("Limit {} should not be negative, got {}".format(name, limit))
+    _EVICTION_POLICY = EvictionPolicy(max_files, max_bytes, max_age)
+
+
+def _prepare_output_directory():
+    """
+    Create the output directory and copy the plotting engine into it
+    """
+    if _DATA_PATH in _PREPARED_PATHS:
+        return
+    os.makedirs(_DATA_PATH, exist_ok=True)
+    # other processes might be reading the engine
+    with open(os.path.join(PLOTS_DIR, _D3_engine_filename), 'rb') as source, \
+            atomic_open(os.path.join(_DATA_PATH, _D3_engine_filename), 'wb') as target:
+        copyfileobj(source, target)
+    _PREPARED_PATHS.add(_DATA_PATH)
+
+
+def _new_plot_id():
+    """
+    Random id of a plot, unique across processes sharing the output directory
+    """
+    return uuid.uuid4().hex
+
+
+def _evict_plots(path, policy, keep=()):
+    """
+    Remove the oldest plots from the directory exceeding the limits of the policy
+
+    Files might be concurrently removed by other processes, missing ones are skipped.
+
+    :param path: directory with plots
+    :param policy: EvictionPolicy
+    :param keep: ids of plots which are never removed
+    :return: list of ids of removed plots
+    """
+    if all(limit is None for limit in policy):
+        return []
+    plots = dict()
+    for entry in os.scandir(path):
+        match = _PLOT_FILE.match(entry.name)
+        if match is None:
+            continue
+        try:
+            stat = entry.stat()
+        except FileNotFoundError:
+            continue
+        files, size, modified = plots.get(match.group(2), ([], 0, 0))
+        plots[match.group(2)] = (files + [entry.path], size + stat.st_size, max(modified, stat.st_mtime))
+
+    now = time.time()
+    n_files, n_bytes, full = 0, 0, False
+    evicted = []
+    # the newest plots are kept first
+    for plot_id, (files, size, modified) in sorted(plots.items(), key=lambda item: item[1][2], reverse=True):
+        if plot_id not in keep:
+            full = full or (policy.max_files is not None and n_files + len(files) > policy.max_files) or \
+                   (policy.max_bytes is not None and n_bytes + size > policy.max_bytes)
+            if full or (policy.max_age is not None and now - modified > policy.max_age):
+                for filename in files:
+                    try:
+                        os.remove(filename)
+                    except FileNotFoundError:
+                        pass
+                evicted.append(plot_id)
+                continue
+        n_files += len(files)
+        n_bytes += size
+    return evicted
+
+
+def _render_template(name, **context):
+    """
+    Render a template from the plots directory
+
+    Only placeholders of variables are supported, which is all the plot template needs.
+
+    :param name: filename of the template
+    :param context: values of the placeholders
+    :return: rendered template
+    """
+    with open(os.path.join(PLOTS_DIR, name), 'r', encoding='utf-8') as f:
+        template = f.read()
+
+    def substitute(match):
+        value = str(context.get(match.group(1), ''))
+        return value if match.group(2) else html.escape(value)
+
+    return _PLACEHOLDER.sub(substitute, template)
 
 
 def _calculate_plot_variables(cp_profile, selected_variables):
@@ -74,7 +256,7 @@ def plot(cp_profile, *args, destination="browser",
          color_residuals=None, size_residuals=None, alpha_residuals=None,
          height=500, width=600,
          plot_title='', yaxis_title='y',
-         print_observations=True,
+         print_observations=True, bundle=False, compress=True, max_profiles=None,
          **kwargs):
     """
     Plot ceteris paribus profile
@@ -105,6 +287,9 @@ def plot(cp_profile, *args, destination="browser",
     :param plot_title: Title of the plot displayed above
     :param yaxis_title: Label for the y axis
     :param print_observations: whether to print the table with observations values
+    :param bundle: whether to write the plot as a single html file with embedded data and libraries, which renders offline, the libraries have to be placed in the vendor directory first with `fetch_vendor_libraries`, see `set_vendor_directory`
+    :param compress: whether to compress profiles embedded in a single file, decompression requires a browser supporting `DecompressionStream` (Chrome 80, Firefox 113, Safari 16.4 or newer), older browsers need `compress=False`
+    :param max_profiles: maximal number of observations whose profiles are plotted, if exceeded then observations representative for the range of predictions are selected, the aggregated profiles are still calculated from all of them
     :param kwargs: other options passed to the plot
     """
 
@@ -137,21 +322,32 @@ def plot(cp_profile, *args, destination="browser",
         params['aggregate_profiles'] = None
 
     all_profiles = [cp_profile] + list(args)
+    simplify = max_profiles is not None
+    if simplify:
+        if params['aggregate_profiles'] is not None:
+            params['aggregated_profiles'] = _aggregated_profiles(all_profiles, params['aggregate_profiles'],
+                                                                 params['variables'])
+        all_profiles = _downsampled_profiles(all_profiles, max_profiles)
 
-    plot_id = str(next(_PLOT_NUMBER))
+    _prepare_output_directory()
+    plot_id = _new_plot_id()
     plot_path, params_path, obs_path, profile_path = _get_data_paths(plot_id)
 
-    with open(params_path, 'w') as f:
-        f.write("params = " + json.dumps(params, indent=2) + ";")
+    if bundle:
+        scripts = _bundle_scripts(all_profiles, params, compress, simplify)
+    else:
+        with atomic_open(params_path) as f:
+            f.write("params = " + json.dumps(params, indent=2) + ";")
 
-    save_observations(all_profiles, obs_path)
-    save_profiles(all_profiles, profile_path)
+        save_observations(all_profiles, obs_path, indent=None)
+        save_profiles(all_profiles, profile_path, orient='columns', indent=None, simplify=simplify)
+        scripts = _file_scripts(plot_id)
 
-    with app.app_context():
-        data = render_template("plot_template.html", i=plot_id, params=params)
+    data = _render_template("plot_template.html", **scripts)
 
-    with open(plot_path, 'w') as f:
+    with atomic_open(plot_path) as f:
         f.write(data)
+    _evict_plots(_DATA_PATH, _EVICTION_POLICY, keep=(plot_id,))
 
     destination = _detect_plot_destination(destination)
     if destination == "notebook":
@@ -164,6 +360,113 @@ def plot(cp_profile, *args, destination="browser",
         webbrowser.open(plot_path)
 
 
+def _representative_positions(predictions, n):
+    """
+    Positions of `n` observations evenly spread over the ranks of their predictions, including the extremes
+
+    :return: sorted array of positions
+    """
+    order = np.argsort(np.asarray(predictions), kind='mergesort')
+    if n >= len(order):
+        return np.arange(len(order))
+    ranks = np.unique(np.round(np.linspace(0, len(order) - 1, n)).astype(int))
+    return np.sort(order[ranks])
+
+
+def _downsampled_profiles(profiles, max_profiles):
+    """
+    Select at most `max_profiles` observations of every profile
+
+    Observations are stratified by predictions of the first profile, profiles of other models explaining the same
+    observations keep the same ones, so their curves can still be compared.
+    """
+    if max_profiles < 1:
+        raise ValueError("Maximal number of profiles should be positive, got {}".format(max_profiles))
+    selected, reference = [], None
+    for cp_profile in profiles:
+        if len(cp_profile.new_observation) <= max_profiles:
+            selected.append(cp_profile)
+            continue
+        index = cp_profile.new_observation.index
+        if reference is None or not reference[0].equals(index):
+            reference = index, _representative_positions(cp_profile.new_observation_predictions, max_profiles)
+        selected.append(cp_profile.select_observations(reference[1]))
+    return selected
+
+
+def _aggregated_profiles(profiles, aggregate, variables):
+    """
+    Aggregate profiles of all observations into the format used by the plot
+    """
+    aggregated = []
+    for cp_profile in profiles:
+        df = cp_profile.aggregate_profiles(aggregate)
+        for var_name in variables:
+            rows = df[df['_vname_'] == var_name]
+            aggregated.append({'_label_': cp_profile._label, '_vname_': var_name,
+                               'x': rows[var_name].tolist(), '_yhat_': rows['_yhat_'].tolist()})
+    return aggregated
+
+
+def _file_scripts(plot_id):
+    """
+    Tags of the plot loading data and libraries from separate files and CDNs
+    """
+    datasets = ['<script src="{}{}.js" charset="utf-8" lang="js"></script>'.format(name, plot_id)
+                for name in ['profile', 'obs', 'params']]
+    return dict(libraries="\n    ".join(tag for _, _, tag in _LIBRARIES),
+                datasets="\n    ".join(datasets),
+                engine='<script src="./{}" charset="utf-8" lang="js"></script>'.format(_D3_engine_filename))
+
+
+def _bundle_scripts(profiles, params, compress=True, simplify=False):
+    """
+    Tags of the plot with embedded data and libraries
+
+    Profiles are embedded in the column oriented format, compressed with gzip and encoded with base64 if `compress`.
+    Libraries are read from the vendor directory, see `fetch_vendor_libraries`.
+    """
+    missing = [filename for filename, _, _ in _LIBRARIES if not os.path.exists(os.path.join(_VENDOR_PATH, filename))]
+    if missing:
+        raise ValueError("Libraries {} not found in {}, download them with fetch_vendor_libraries(), copy them "
+                         "there by hand or choose another directory with set_vendor_directory()".format(missing,
+                                                                                                      _VENDOR_PATH))
+    if compress:
+        profile = 'profileGzip = "{}";'.format(dump_profiles_compressed(profiles, simplify))
+    else:
+        profile = 'profile = {};'.format(_json(dump_profiles_columns(profiles, simplify)))
+    data = "\n".join([profile,
+                      'observation = {};'.format(_json(dump_observations(profiles))),
+                      'params = {};'.format(_json(params))])
+    libraries = [_inline_tag(os.path.join(_VENDOR_PATH, filename)) for filename, _, _ in _LIBRARIES]
+    return dict(libraries="\n".join(libraries),
+                datasets='<script charset="utf-8">\n{}\n</script>'.format(data),
+                engine=_inline_tag(os.path.join(PLOTS_DIR, _D3_engine_filename)))
+
+
+def _json(obj):
+    """
+    Dump an object into json which is safe to be embedded in a script tag
+    """
+    return _escape(json.dumps(obj, separators=(',', ':'), default=default))
+
+
+def _escape(text):
+    # closing tags would end the embedding script
+    return text.replace("</", "<\\/")
+
+
+def _inline_tag(path):
+    """
+    Embed a javascript or css file in a tag
+    """
+    with open(path, 'r', encoding='utf-8') as f:
+        content = _escape(f.read())
+    if path.endswith('.css'):
+        return '<style>\n{}\n</style>'.format(content)
+    return '<script charset="utf-8">\n{}\n</script>'.format(content)
+
+
 def _get_data_paths(plot_id):
     plot_path = os.path.join(_DATA_PATH, "plots{}.html".format(plot_id))
     params_path = os.path.join(_DATA_PATH, "params{}.js".format(plot_id))
@@ -1,14 +1,27 @@
+import asyncio
+import copy
+import inspect
 import logging
+import os
 from collections import OrderedDict
+from concurrent.futures import Executor, ThreadPoolExecutor, ProcessPoolExecutor
+from functools import partial
+from itertools import repeat, groupby
 
 import numpy as np
 import pandas as pd
 
+from ceteris_paribus.cache import _data_splits_cache
+from ceteris_paribus.data import ChunkedData, _is_sparse_matrix, _is_sparse_frame, _import_scipy_sparse
+from ceteris_paribus.sketches import SplitSketch, capped_split, sketch_splits
+from ceteris_paribus.trees import model_thresholds, threshold_split
 from ceteris_paribus.utils import transform_into_Series
 
 
 def individual_variable_profile(explainer, new_observation, y=None, variables=None, grid_points=101,
-                                variable_splits=None):
+                                variable_splits=None, batch_size=None, n_jobs=None, executor='thread', lazy=False,
+                                chunk_size=None, split_method=None, max_categories=None, adaptive=False,
+                                max_predictions=None, engine='grid'):
     """
     Calculate ceteris paribus profile
 
@@ -18,27 +31,171 @@ def individual_variable_profile(explainer, new_observation, y=None, variables=No
     :param variables: collection of variables selected for calculating profiles
     :param grid_points: number of points for profile
     :param variable_splits: dictionary of splits for variables, in most cases created with `_calculate_variable_splits()`. If None then it will be calculated based on validation data avaliable in the `explainer`.
+    :param batch_size: maximal number of rows passed to the predict function in a single call, if None then the whole grid is scored at once
+    :param n_jobs: number of workers scoring grids of different variables in parallel, -1 means all processors, if None then the grid is scored in the main thread
+    :param executor: *thread* - pool of threads, suitable for models releasing the GIL, *process* - pool of processes, requires picklable predict function, or an instance of `concurrent.futures.Executor` to be used
+    :param lazy: if True then the profile is not calculated upfront, but chunk by chunk with `CeterisParibus.iter_profile` or as a whole at the first access to `CeterisParibus.profile`
+    :param chunk_size: maximal number of observations in a single chunk of a lazy profile, if None then a chunk contains all observations for a single variable
+    :param split_method: *exact* - splits calculated with exact quantiles and unique values, *sketch* - approximate splits calculated with mergeable sketches in a single pass over the data, if None then *exact* for data in memory and *sketch* for `ChunkedData`
+    :param max_categories: maximal number of points in splits of integer and categorical variables, integers are binned by quantiles and categories limited to the most frequent ones, if None then all unique values are used
+    :param adaptive: if True then profiles of numerical variables start with a coarse grid, which is refined only in intervals where predictions change sharply, e.g. around split points of tree models
+    :param max_predictions: maximal number of grid rows scored by an adaptive profile, if None then the number of rows of the uniform grid with `grid_points` points
+    :param engine: *grid* - profiles calculated on splits of the data, *tree* - splits of numerical variables replaced with points around split thresholds read from the model (scikit-learn trees and ensembles, XGBoost or LightGBM), which gives exact profiles of tree models
     :return: instance of CeterisParibus class
     """
     variables = _get_variables(variables, explainer)
+    new_observation = _observation_df(new_observation, explainer.var_names)
+
+    if y is not None:
+        y = transform_into_Series(y)
+
+    cp_profile = CeterisParibus(explainer, new_observation, y, variables, grid_points, variable_splits, batch_size,
+                                n_jobs, executor, lazy, chunk_size, split_method, max_categories, adaptive,
+                                max_predictions, engine)
+    return cp_profile
+
+
+async def individual_variable_profile_async(explainer, new_observation, y=None, variables=None, grid_points=101,
+                                            variable_splits=None, batch_size=None, max_concurrency=8,
+                                            split_method=None, max_categories=None):
+    """
+    Calculate ceteris paribus profile without blocking the event loop
+
+    Grids are scored in chunks of `batch_size` rows (or a chunk per variable) and up to `max_concurrency`
+    predict calls are awaited at once. The predict function of the explainer might be a coroutine function,
+    a regular function is called in the default executor of the loop. Splits are calculated in the executor as well.
+
+    :param explainer: a model to be explained
+    :param new_observation: a new observation for which the profiles are calculated
+    :param y: y true labels for `new_observation`
+    :param variables: collection of variables selected for calculating profiles
+    :param grid_points: number of points for profile
+    :param variable_splits: dictionary of splits for variables, if None then calculated based on data avaliable in the `explainer`
+    :param batch_size: maximal number of rows passed to the predict function in a single call, if None then a single call per variable
+    :param max_concurrency: maximal number of predict calls awaited at once
+    :param split_method: 'exact' or 'sketch' - method of calculating the splits, if None then chosen by the type of the data
+    :param max_categories: maximal number of points in splits of integer and categorical variables
+    :return: instance of CeterisParibus class, the same as calculated by `individual_variable_profile`
+    """
+    variables = _get_variables(variables, explainer)
+    new_observation = _observation_df(new_observation, explainer.var_names)
+    if y is not None:
+        y = transform_into_Series(y)
+
+    cp_profile = CeterisParibus.__new__(CeterisParibus)
+    await asyncio.get_event_loop().run_in_executor(None, partial(
+        cp_profile._setup, explainer, new_observation, y, variables, grid_points, variable_splits, batch_size, None,
+        'thread', None, split_method, max_categories))
+    await cp_profile._calculate_predictions_async(max_concurrency)
+    return cp_profile
+
+
+def individual_variable_profiles(explainers, new_observation, y=None, variables=None, grid_points=101,
+                                 variable_splits=None, batch_size=None, n_jobs=None, executor='thread',
+                                 split_method=None, max_categories=None):
+    """
+    Calculate ceteris paribus profiles of many models sharing variables and data
+
+    Splits and the grid are built once and every model is scored on the same grid, in parallel if `n_jobs` is given.
+    The profiles share the observations and splits, only predictions are stored separately.
+
+    :param explainers: list of explainers with the same variables, splits are calculated from the data of the first one
+    :param new_observation: a new observation for which the profiles are calculated
+    :param y: y true labels for `new_observation`
+    :param variables: collection of variables selected for calculating profiles
+    :param grid_points: number of points for profile
+    :param variable_splits: dictionary of splits for variables, if None then calculated based on data avaliable in the first explainer
+    :param batch_size: maximal number of rows passed to a predict function in a single call
+    :param n_jobs: number of workers scoring different models in parallel, -1 means all processors, if None then the models are scored in the main thread
+    :param executor: 'thread', 'process' or an instance of `concurrent.futures.Executor` used when scoring in parallel
+    :param split_method: 'exact' or 'sketch' - method of calculating the splits, if None then chosen by the type of the data
+    :param max_categories: maximal number of points in splits of integer and categorical variables
+    :return: OrderedDict mapping labels of the explainers into instances of CeterisParibus class
+    """
+    if not explainers:
+        raise ValueError("At least one explainer is required")
+    explainer = explainers[0]
+    if any(list(other.var_names) != list(explainer.var_names) for other in explainers[1:]):
+        raise ValueError("Explainers have to share the variables")
+    labels = [other.label for other in explainers]
+    if len(set(labels)) != len(labels):
+        raise ValueError("Labels of the explainers have to be unique, use `set_label` or `label` in `explain`")
+    variables = _get_variables(variables, explainer)
+    new_observation = _observation_df(new_observation, explainer.var_names)
+    if y is not None:
+        y = transform_into_Series(y)
+
+    profiles = [CeterisParibus(explainer, new_observation, y, variables, grid_points, variable_splits, batch_size,
+                               lazy=True, split_method=split_method, max_categories=max_categories)]
+    variable_splits = profiles[0]._variable_splits
+    profiles.extend(CeterisParibus(other, new_observation, y, variables, grid_points, variable_splits, batch_size,
+                                   lazy=True, split_method=split_method, max_categories=max_categories)
+                    for other in explainers[1:])
+    grid, bounds = profiles[0]._scoring_grid(variable_splits)
+    predict_functions = [cp._predict_function for cp in profiles]
+    if _is_parallel(n_jobs, executor):
+        predictions = _predict_in_parallel(predict_functions, [grid] * len(profiles), batch_size, n_jobs, executor)
+    else:
+        predictions = [_predict_in_batches(predict_function, grid, batch_size) for predict_function in predict_functions]
+    for cp, yhat in zip(profiles, predictions):
+        cp._predictions = OrderedDict((var_name, np.reshape(var_yhat, (len(new_observation), -1)))
+                                      for var_name, var_yhat in zip(variable_splits.keys(),
+                                                                    np.split(np.asarray(yhat), bounds[1:-1])))
+    return OrderedDict(zip(labels, profiles))
+
+
+def _observation_df(new_observation, var_names):
+    """
+    Convert observations into DataFrame with the given variables
+    """
+    if _is_sparse_matrix(new_observation):
+        new_observation = new_observation.toarray()
+    if _is_sparse_frame(new_observation):
+        new_observation = new_observation.sparse.to_dense()
     if not isinstance(new_observation, pd.core.frame.DataFrame):
         new_observation = np.array(new_observation)
         if new_observation.ndim == 1:
             # make 1D array 2D
             new_observation = new_observation.reshape((1, -1))
-        new_observation = pd.DataFrame(new_observation, columns=explainer.var_names)
+        new_observation = pd.DataFrame(new_observation, columns=var_names)
     else:
         try:
-            new_observation.columns = explainer.var_names
+            new_observation.columns = var_names
         except ValueError as e:
             raise ValueError("Mismatched number of variables {} instead of {}".format(len(new_observation.columns),
-                                                                                      len(explainer.var_names)))
+                                                                                      len(var_names)))
+    return new_observation
 
-    if y is not None:
-        y = transform_into_Series(y)
 
-    cp_profile = CeterisParibus(explainer, new_observation, y, variables, grid_points, variable_splits)
-    return cp_profile
+def _appended_index(index, new_index):
+    """
+    Index of observations appended to the ones with `index`, ids of observations have to stay unique
+
+    The new index is kept if it does not overlap, otherwise integer ids are continued after the largest one.
+    """
+    if not new_index.has_duplicates and index.intersection(new_index).empty:
+        return new_index
+    if not pd.api.types.is_integer_dtype(index):
+        raise ValueError("Index of new observations overlaps the index of the present ones")
+    start = index.max() + 1 if len(index) else 0
+    return pd.RangeIndex(start, start + len(new_index))
+
+
+_SPLIT_METHODS = ('exact', 'sketch')
+
+_ENGINES = ('grid', 'tree')
+
+# number of rows of the data processed at once when calculating approximate splits
+_SKETCH_CHUNK_SIZE = 100000
+
+# number of points of the coarse grid an adaptive profile starts with
+_ADAPTIVE_INITIAL_POINTS = 11
+
+# intervals are refined while their score exceeds this fraction of the range of predictions
+_ADAPTIVE_TOLERANCE = 0.01
+
+# intervals narrower than the range of the variable divided by this number are not refined
+_ADAPTIVE_RESOLUTION = 2 ** 12
 
 
 def _get_variables(variables, explainer):
@@ -68,9 +225,300 @@ def _valid_variable_splits(variable_splits, variables):
         return False
 
 
+def _predict_in_batches(predict_function, X, batch_size=None):
+    """
+    Score the data with the predict function in chunks
+
+    :param predict_function: function that takes the data and returns predictions
+    :param X: DataFrame with the data to be scored
+    :param batch_size: maximal number of rows in a single call, if None then the data is scored at once
+    :return: numpy array with predictions
+    """
+    n_rows = X.shape[0]
+    if batch_size is None or n_rows <= batch_size:
+        return np.asarray(predict_function(X))
+    return np.concatenate([np.asarray(predict_function(_grid_rows(X, start, start + batch_size)))
+                           for start in range(0, n_rows, batch_size)])
+
+
+def _grid_rows(X, start, stop):
+    """
+    Select subsequent rows of a DataFrame or a sparse matrix
+    """
+    return X.iloc[start:stop] if isinstance(X, pd.DataFrame) else X[start:stop]
+
+
+def _stacked_grid(observations, variable_splits, columns=None):
+    """
+    Build what-if grids of the given variables stacked one after another
+
+    In the grid of a variable every observation is repeated once per split value, with the variable replaced by
+    subsequent split values. Columns keep dtypes of the observations, e.g. integers or categoricals, and every column
+    is allocated once for all the grids, which are filled in place.
+
+    :param observations: DataFrame with observations
+    :param variable_splits: mapping of variables into split values
+    :param columns: names of subsequent columns of the observations, if None then the names of the observations
+    :return: DataFrame with the grids and array of bounds of subsequent grids
+    """
+    n_observations = len(observations)
+    lengths = [len(var_split) for var_split in variable_splits.values()]
+    positions = [np.repeat(np.arange(n_observations), length) for length in lengths]
+    grid = observations.take(np.concatenate(positions) if positions else np.array([], dtype=int))
+    grid.index = pd.RangeIndex(len(grid))
+    if columns is not None:
+        grid.columns = columns
+    bounds = np.cumsum([0] + [n_observations * length for length in lengths])
+    for (var_name, var_split), start, stop in zip(variable_splits.items(), bounds[:-1], bounds[1:]):
+        grid[var_name] = _filled_column(grid[var_name], np.tile(var_split, n_observations), start, stop)
+    return grid, bounds
+
+
+def _filled_column(column, values, start, stop):
+    """
+    Replace rows of a column with split values, keeping the dtype of the column if the values fit in it
+
+    :return: array of the column
+    """
+    dtype = column.dtype
+    if isinstance(dtype, pd.SparseDtype):
+        column = column.sparse.to_dense()
+        dtype = column.dtype
+    if isinstance(dtype, pd.CategoricalDtype):
+        new_categories = pd.Index(values).unique().difference(dtype.categories)
+        categories = dtype.categories.append(new_categories)
+        codes = np.array(column.cat.codes, dtype=np.int64)
+        codes[start:stop] = categories.get_indexer(values)
+        return pd.Categorical.from_codes(codes, categories=categories, ordered=dtype.ordered)
+    values = np.asarray(values)
+    if not isinstance(dtype, np.dtype):
+        # extension arrays, e.g. nullable integers
+        array = column.array.copy()
+        try:
+            array[start:stop] = values
+            return array
+        except (TypeError, ValueError):
+            dtype = np.dtype(object)
+    array = column.to_numpy(dtype=dtype, copy=True)
+    if not np.can_cast(values.dtype, array.dtype, 'same_kind'):
+        numeric = array.dtype.kind in 'biuf' and values.dtype.kind in 'biuf'
+        array = array.astype(np.result_type(array, values) if numeric else object)
+    array[start:stop] = values
+    return array
+
+
+def _as_csr(observations):
+    """
+    Convert a DataFrame into a SciPy CSR matrix
+    """
+    if _is_sparse_frame(observations):
+        return observations.sparse.to_coo().tocsr()
+    return _import_scipy_sparse().csr_matrix(observations.to_numpy(dtype=np.float64))
+
+
+def _sparse_grid(observations, variable_splits, columns):
+    """
+    Build what-if grids of the given variables stacked one after another as a sparse matrix
+
+    Rows of the observations are repeated as sparse rows, only the column of the variable is replaced.
+
+    :param observations: DataFrame with observations
+    :param variable_splits: mapping of variables into numerical split values
+    :param columns: all variables in the order of columns of the matrix
+    :return: CSR matrix with the grids and array of bounds of subsequent grids
+    """
+    sparse = _import_scipy_sparse()
+    X = _as_csr(observations[columns])
+    n_observations = X.shape[0]
+    blocks = []
+    for var_name, var_split in variable_splits.items():
+        column = columns.index(var_name)
+        rows = np.repeat(np.arange(n_observations), len(var_split))
+        mask = np.ones(len(columns))
+        mask[column] = 0
+        block = X[rows] @ sparse.diags(mask)
+        block = block + sparse.csr_matrix((np.tile(np.asarray(var_split, dtype=np.float64), n_observations),
+                                           (np.arange(len(rows)), np.full(len(rows), column))), shape=block.shape)
+        block.eliminate_zeros()
+        blocks.append(block.tocsr())
+    bounds = np.cumsum([0] + [block.shape[0] for block in blocks])
+    grid = sparse.vstack(blocks, format='csr') if blocks else sparse.csr_matrix((0, len(columns)))
+    return grid, bounds
+
+
+def _is_parallel(n_jobs, executor):
+    """
+    Check whether the grids should be scored in a pool of workers
+    """
+    return isinstance(executor, Executor) or (n_jobs is not None and n_jobs != 1)
+
+
+def _predict_in_parallel(predict_function, grids, batch_size=None, n_jobs=None, executor='thread'):
+    """
+    Score the grids in a pool of workers
+
+    :param predict_function: function that takes the data and returns predictions, or a list of functions - one for every grid
+    :param grids: list of DataFrames to be scored
+    :param batch_size: maximal number of rows in a single call
+    :param n_jobs: number of workers, -1 means all processors
+    :param executor: 'thread', 'process' or an instance of `concurrent.futures.Executor`
+    :return: list of arrays with predictions, in the order of grids
+    """
+    functions = repeat(predict_function) if callable(predict_function) else predict_function
+    args = (functions, grids, repeat(batch_size))
+    if isinstance(executor, Executor):
+        return list(executor.map(_predict_in_batches, *args))
+    if executor == 'thread':
+        pool_class = ThreadPoolExecutor
+    elif executor == 'process':
+        pool_class = ProcessPoolExecutor
+    else:
+        raise ValueError('Executor has to be "thread", "process" or an instance of concurrent.futures.Executor')
+    if n_jobs == -1:
+        n_jobs = os.cpu_count()
+    with pool_class(max_workers=n_jobs) as pool:
+        return list(pool.map(_predict_in_batches, *args))
+
+
+async def _predict_async(predict_function, X, semaphore):
+    """
+    Await predictions of a coroutine function or call a regular function in the default executor
+    """
+    async with semaphore:
+        if _is_coroutine_function(predict_function):
+            return await predict_function(X)
+        result = await asyncio.get_event_loop().run_in_executor(None, predict_function, X)
+        if inspect.isawaitable(result):
+            # e.g. a partial of a coroutine function
+            result = await result
+        return result
+
+
+def _coarse_split(split, points=_ADAPTIVE_INITIAL_POINTS):
+    """
+    Select evenly spaced points of a split including its ends, repeated values are dropped
+    """
+    split = np.unique(split)
+    positions = np.unique(np.linspace(0, len(split) - 1, points).round().astype(int))
+    return split[positions]
+
+
+def _is_refinable(split):
+    return split.dtype != bool and np.issubdtype(split.dtype, np.number) and len(split) > _ADAPTIVE_INITIAL_POINTS
+
+
+def _interval_scores(split, predictions):
+    """
+    Score intervals between subsequent split points by how badly predictions are approximated by neighbouring slopes
+
+    Change of predictions over an interval is compared with the change expected from slopes of the neighbouring
+    intervals (missing neighbours are flat), the better of the two approximations is taken. The score is zero
+    for linear and constant profiles and equals the height of a jump within an otherwise flat profile.
+    Intervals of zero width have zero slopes.
+
+    :param split: sorted numerical split
+    :param predictions: matrix of predictions with a row for every observation
+    :return: array with the maximal score over observations for every interval
+    """
+    widths = np.diff(split.astype(np.float64))
+    changes = np.diff(predictions, axis=1)
+    slopes = np.divide(changes, widths, out=np.zeros(changes.shape), where=widths > 0)
+    left = np.zeros_like(changes)
+    left[:, 1:] = slopes[:, :-1] * widths[1:]
+    right = np.zeros_like(changes)
+    right[:, :-1] = slopes[:, 1:] * widths[:-1]
+    scores = np.minimum(np.abs(changes - left), np.abs(changes - right))
+    return scores.max(axis=0) if len(scores) else np.zeros(len(widths))
+
+
+def _midpoints(split, intervals):
+    """
+    Calculate middle points of selected intervals, integers are rounded down
+
+    :return: array of midpoints and a mask of intervals which could be divided
+    """
+    lower, upper = split[intervals], split[intervals + 1]
+    if np.issubdtype(split.dtype, np.integer):
+        return lower + (upper - lower) // 2, upper - lower > 1
+    resolution = (split[-1] - split[0]) / _ADAPTIVE_RESOLUTION
+    return lower + (upper - lower) / 2, upper - lower > resolution
+
+
+def _simplified_mask(var_split, yhat):
+    """
+    Mask of points of profiles which are not collinear with their neighbours
+
+    Dropping the other points does not change the polylines, e.g. flat segments of step profiles are reduced
+    to their ends. Profiles of categorical variables are not simplified.
+
+    :param var_split: split values of the variable
+    :param yhat: matrix of predictions with a row for every observation
+    :return: boolean matrix of the points to be kept
+    """
+    var_split = np.asarray(var_split)
+    mask = np.ones(np.shape(yhat), dtype=bool)
+    if len(var_split) < 3 or var_split.dtype == bool or not np.issubdtype(var_split.dtype, np.number):
+        return mask
+    x = var_split.astype(np.float64)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        weights = (x[1:-1] - x[:-2]) / (x[2:] - x[:-2])
+        interpolated = yhat[:, :-2] + (yhat[:, 2:] - yhat[:, :-2]) * weights
+    mask[:, 1:-1] = ~np.isclose(yhat[:, 1:-1], interpolated, rtol=1e-9, atol=0)
+    return mask
+
+
+def _is_coroutine_function(function):
+    return inspect.iscoroutinefunction(function) or inspect.iscoroutinefunction(getattr(function, '__call__', None))
+
+
+class _ProfilesReduction:
+
+    def __init__(self, aggregate, quantiles, n_groups):
+        """
+        Streaming reduction of profiles of a single variable, separately for groups of observations
+
+        :param aggregate: 'mean' or 'median'
+        :param quantiles: pair of quantiles of the band or None
+        :param n_groups: number of groups
+        """
+        self.quantiles = quantiles
+        self.count = np.zeros(n_groups, dtype=int)
+        self._aggregate = aggregate
+        self._sum = None
+        # predictions are kept only if the median or quantiles are needed
+        self._values = [[] for _ in range(n_groups)] if aggregate == 'median' or quantiles is not None else None
+
+    def update(self, yhat, groups):
+        """
+        Update the reduction with predictions for a chunk of observations
+
+        :param yhat: array of predictions with a row for every observation
+        :param groups: group of every observation, -1 for observations without a group
+        """
+        valid = groups >= 0
+        yhat, groups = yhat[valid], groups[valid]
+        if self._sum is None:
+            self._sum = np.zeros((len(self.count), yhat.shape[1]))
+        np.add.at(self._sum, groups, yhat)
+        self.count += np.bincount(groups, minlength=len(self.count))
+        if self._values is not None:
+            for group in np.unique(groups):
+                self._values[group].append(yhat[groups == group])
+
+    def aggregate(self, group):
+        if self._aggregate == 'mean':
+            return self._sum[group] / self.count[group]
+        return np.median(np.concatenate(self._values[group]), axis=0)
+
+    def band(self, group):
+        return np.quantile(np.concatenate(self._values[group]), self.quantiles, axis=0)
+
+
 class CeterisParibus:
 
-    def __init__(self, explainer, new_observation, y, selected_variables, grid_points, variable_splits):
+    def __init__(self, explainer, new_observation, y, selected_variables, grid_points, variable_splits,
+                 batch_size=None, n_jobs=None, executor='thread', lazy=False, chunk_size=None, split_method=None,
+                 max_categories=None, adaptive=False, max_predictions=None, engine='grid'):
         """
         Creates Ceteris Paribus object
 
@@ -80,38 +528,420 @@ class CeterisParibus:
         :param selected_variables: variables for which the profiles are calculated
         :param grid_points: number of points in a single variable split if calculated automatically
         :param variable_splits: mapping of variables into points the profile will be calculated, if None then calculate with the function `_calculate_variable_splits`
+        :param batch_size: maximal number of rows scored in a single call of the predict function, if None then the whole grid is scored at once
+        :param n_jobs: number of workers scoring grids of different variables in parallel, if None then the grid is scored in the main thread
+        :param executor: 'thread', 'process' or an instance of `concurrent.futures.Executor` used when scoring in parallel
+        :param lazy: if True then the profile is calculated on demand - chunk by chunk in `iter_profile` or as a whole at the first access to `profile`
+        :param chunk_size: maximal number of observations in a single chunk yielded by `iter_profile`
+        :param split_method: 'exact' or 'sketch' - method of calculating the splits, if None then chosen by the type of the data
+        :param max_categories: maximal number of points in splits of integer and categorical variables
+        :param adaptive: if True then the splits are refined adaptively, see `_refine_splits`
+        :param max_predictions: maximal number of grid rows scored by an adaptive profile
+        :param engine: 'grid' or 'tree' - 'tree' replaces splits of numerical variables with points around split thresholds of the model
+        """
+        self._setup(explainer, new_observation, y, selected_variables, grid_points, variable_splits, batch_size, n_jobs,
+                    executor, chunk_size, split_method, max_categories, engine)
+        if adaptive:
+            if lazy:
+                logging.warning("Adaptive profiles are calculated upfront, parameter lazy is ignored")
+            self._refine_splits(max_predictions)
+        else:
+            # profiles are stored compactly as a matrix of predictions (observations x split values) for every variable
+            self._predictions = None if lazy else self._calculate_predictions(self._variable_splits)
+        self.new_observation_predictions = self._predict_observations(self.new_observation)
+
+    def _setup(self, explainer, new_observation, y, selected_variables, grid_points, variable_splits, batch_size,
+               n_jobs, executor, chunk_size, split_method, max_categories, engine='grid'):
+        """
+        Set all attributes apart from predictions, the parameters are the same as in the constructor
         """
+        if split_method is None:
+            split_method = 'sketch' if isinstance(explainer.data, ChunkedData) else 'exact'
+        if split_method not in _SPLIT_METHODS:
+            raise ValueError("Unknown split method {}, use one of {}".format(split_method, _SPLIT_METHODS))
+        if engine not in _ENGINES:
+            raise ValueError("Unknown engine {}, use one of {}".format(engine, _ENGINES))
+        # thresholds are read once, splits of the data in the cache are shared with other models
+        self._thresholds = model_thresholds(explainer.model, explainer.var_names) if engine == 'tree' else None
         self._data = explainer.data
+        # models fitted on sparse data are scored on sparse grids
+        self._sparse = _is_sparse_frame(explainer.data)
         self._predict_function = explainer.predict_fun
         self._grid_points = grid_points
+        self._split_method = split_method
+        self._max_categories = max_categories
+        self._batch_size = batch_size
+        self._n_jobs = n_jobs
+        self._executor = executor
+        self._chunk_size = chunk_size
         self._label = explainer.label
         self.all_variable_names = explainer.var_names
         self.new_observation = new_observation
         self.selected_variables = list(selected_variables)
-        variable_splits = self._get_variable_splits(variable_splits)
-        self.profile = self._calculate_profile(variable_splits)
+        self._variable_splits = self._get_variable_splits(variable_splits)
+        self._predictions = None
+        self._profile = None
         self.new_observation_values = self.new_observation[self.selected_variables]
-        self.new_observation_predictions = self._predict_function(self.new_observation)
         self.new_observation_true = y
 
-    def _get_variable_splits(self, variable_splits):
+    @property
+    def profile(self):
+        """
+        DataFrame with the profile, built from the stored predictions at the first access
+        """
+        if self._profile is None:
+            if self._predictions is None:
+                self._predictions = self._calculate_predictions(self._variable_splits)
+            self._profile = self._profile_from_predictions(self._variable_splits, self._predictions)
+        return self._profile
+
+    @profile.setter
+    def profile(self, profile):
+        self._profile = profile
+
+    def iter_profile(self, chunk_size=None, simplify=False):
+        """
+        Iterate over the profile in chunks
+
+        Chunks are built from the stored predictions or, for lazy profiles, calculated on demand,
+        so the whole profile is never held in memory.
+        A profile that is already materialized is yielded as a single chunk.
+
+        :param chunk_size: maximal number of observations in a chunk, if None then the value given at creation is used
+        :param simplify: if True then points collinear with their neighbours are dropped, see `_simplified_mask`
+        :return: generator of DataFrames, concatenated they give the profile
+        """
+        if self._profile is not None and not simplify:
+            yield self._profile
+            return
+        variables = list(self._variable_splits.keys())
+        for var_name, var_split, start, observations, yhat in self._iter_predictions(chunk_size):
+            df = self._label_grid(self._variable_grid(var_name, var_split, observations), var_name, var_split, yhat,
+                                  observations, variables)
+            yield df[_simplified_mask(var_split, yhat).ravel()] if simplify else df
+
+    def select_observations(self, positions):
+        """
+        Select a subset of observations, the predictions are reused
+
+        :param positions: positions of the observations
+        :return: new CeterisParibus object with the selected observations sharing the splits with this one
+        """
+        positions = np.asarray(positions, dtype=int)
+        cp = copy.copy(self)
+        cp.new_observation = self.new_observation.iloc[positions]
+        cp.new_observation_values = cp.new_observation[self.selected_variables]
+        cp.new_observation_predictions = np.asarray(self.new_observation_predictions)[positions]
+        if self.new_observation_true is not None:
+            cp.new_observation_true = pd.Series(self.new_observation_true).iloc[positions].reset_index(drop=True)
+        if self._predictions is not None:
+            cp._predictions = OrderedDict((var_name, yhat[positions]) for var_name, yhat in self._predictions.items())
+        cp._profile = None
+        return cp
+
+    def _iter_predictions(self, chunk_size=None):
+        """
+        Iterate over predictions for chunks of observations, variable by variable
+
+        Predictions are taken from the stored ones or, for lazy profiles, calculated on demand.
+
+        :param chunk_size: maximal number of observations in a chunk, if None then the value given at creation is used
+        :return: generator of tuples: variable name, split values, position of the first observation in the chunk, observations, array of predictions with a row for every observation
+        """
+        chunk_size = chunk_size or self._chunk_size or len(self.new_observation)
+        for var_name, var_split in self._variable_splits.items():
+            for start in range(0, len(self.new_observation), chunk_size):
+                observations = self.new_observation.iloc[start:start + chunk_size]
+                if self._predictions is None:
+                    grid, _ = self._scoring_grid({var_name: var_split}, observations)
+                    yhat = np.reshape(self._predict(grid), (len(observations), -1))
+                else:
+                    yhat = self._predictions[var_name][start:start + chunk_size]
+                yield var_name, var_split, start, observations, yhat
+
+    def aggregate_profiles(self, aggregate='mean', quantiles=None, group_by=None, chunk_size=None):
+        """
+        Calculate aggregated profiles, for the mean these are partial dependence profiles
+
+        Profiles are reduced variable by variable while iterating over chunks of predictions,
+        so for lazy profiles only the aggregates are kept.
+        The mean is calculated online, while the median and quantiles
+        need predictions for a single variable at a time.
+
+        :param aggregate: aggregation function, available values: `mean`, `median`
+        :param quantiles: pair of quantiles, e.g. (0.1, 0.9), of the band around the aggregated profile, stored in columns `_yhat_lower_` and `_yhat_upper_`
+        :param group_by: variable used to group observations, profiles are aggregated separately for every group and labeled with `label_group`
+        :param chunk_size: maximal number of observations in a chunk for lazy profiles
+        :return: DataFrame with aggregated profiles
+        """
+        if aggregate not in {'mean', 'median'}:
+            raise ValueError("Incorrect function for profile aggregation: {}. "
+                             "Available values are: 'mean' and 'median'".format(aggregate))
+        if group_by is None:
+            groups, group_values = np.zeros(len(self.new_observation), dtype=int), [None]
+        else:
+            groups, group_values = pd.factorize(self.new_observation[group_by], sort=True)
+
+        frames = []
+        for var_name, chunks in groupby(self._iter_predictions(chunk_size), key=lambda chunk: chunk[0]):
+            reduction = _ProfilesReduction(aggregate, quantiles, len(group_values))
+            for _, var_split, start, observations, yhat in chunks:
+                reduction.update(yhat, groups[start:start + len(observations)])
+            frames.append(self._aggregated_df(var_name, var_split, reduction, group_values))
+        return pd.concat(frames, ignore_index=True, sort=False)
+
+    def _aggregated_df(self, var_name, var_split, reduction, group_values):
+        """
+        Build DataFrame with aggregated profiles of a variable for subsequent groups
+        """
+        frames = []
+        for group, group_value in enumerate(group_values):
+            if not reduction.count[group]:
+                continue
+            df = pd.DataFrame(OrderedDict([(var_name, var_split)]))
+            df['_yhat_'] = reduction.aggregate(group)
+            if reduction.quantiles is not None:
+                df['_yhat_lower_'], df['_yhat_upper_'] = reduction.band(group)
+            df['_vname_'] = var_name
+            df['_label_'] = self._label if group_value is None else "{}_{}".format(self._label, group_value)
+            df['_ids_'] = 0
+            if group_value is not None:
+                df['_groups_'] = group_value
+            frames.append(df)
+        return pd.concat(frames, ignore_index=True)
+
+    def _get_variable_splits(self, variable_splits, variables=None):
         """
         Helper function for calculating variable splits
+
+        :param variables: variables the splits are calculated for, if None then the selected variables
+        """
+        variables = self.selected_variables if variables is None else variables
+        if variable_splits is None or not _valid_variable_splits(variable_splits, variables):
+            # splits are calculated once for the data and reused by subsequent profiles
+            cache = _data_splits_cache(self._data)
+            options = self._split_options()
+            cached_splits = cache.get(self._data, variables, options)
+            missing = [var for var in variables if var not in cached_splits]
+            if missing:
+                if self._split_method == 'sketch':
+                    # a single pass over chunks of the data
+                    calculated_splits = sketch_splits(self._data_chunks(missing), missing, self._grid_points,
+                                                      self._max_categories)
+                else:
+                    calculated_splits = self._calculate_variable_splits(
+                        dict((var, self._data[var]) for var in missing))
+                cache.update(self._data, calculated_splits, options)
+                cached_splits.update(calculated_splits)
+            return dict((var, self._model_split(var, cached_splits[var])) for var in variables)
+        if all(isinstance(split, np.ndarray) for split in variable_splits.values()):
+            return variable_splits
+        # splits given by the user might be lists
+        return dict((var, np.asarray(split)) for var, split in variable_splits.items())
+
+    def _model_split(self, var_name, split):
+        """
+        Replace a numerical split with points around thresholds of the model when the tree engine is used
+
+        Variables not used by the model get only the ends of their splits, their profiles are flat.
+        """
+        if self._thresholds is None or split.dtype == bool or not np.issubdtype(split.dtype, np.number):
+            return split
+        return threshold_split(self._thresholds.get(var_name, np.array([])), split)
+
+    def _data_chunks(self, variables):
+        """
+        Iterate over chunks of the data with the given variables
         """
-        if variable_splits is None or not _valid_variable_splits(variable_splits, self.selected_variables):
-            variables_dict = self._data.to_dict(orient='series')
-            chosen_variables_dict = dict((var, variables_dict[var]) for var in self.selected_variables)
-            variable_splits = self._calculate_variable_splits(chosen_variables_dict)
-        return variable_splits
+        if isinstance(self._data, ChunkedData):
+            for chunk in self._data.iter_chunks(variables):
+                yield chunk
+            return
+        for start in range(0, len(self._data), _SKETCH_CHUNK_SIZE):
+            yield self._data.iloc[start:start + _SKETCH_CHUNK_SIZE][variables]
 
-    def _calculate_profile(self, variable_splits):
+    def _split_options(self):
         """
-        Calculate DataFrame profile
+        Options the splits depend on, used as a part of the key in the cache of splits
         """
-        profiles_list = [self._single_variable_df(var_name, var_split)
-                         for var_name, var_split in variable_splits.items()]
-        profile = pd.concat(profiles_list, ignore_index=True)
-        return profile
+        return self._grid_points, self._split_method, self._max_categories
+
+    def _calculate_predictions(self, variable_splits, observations=None):
+        """
+        Calculate predictions for the profiles
+
+        The grids for all variables and observations are stacked into a single block and
+        scored with one call of the predict function (or a few calls of `batch_size` rows).
+        In parallel mode grids of subsequent variables are scored by separate workers.
+
+        :param observations: DataFrame with observations, if None then all observations are used
+        :return: mapping of variables into arrays of predictions with a row for every observation
+        """
+        if observations is None:
+            observations = self.new_observation
+        grid, bounds = self._scoring_grid(variable_splits, observations)
+        if _is_parallel(self._n_jobs, self._executor):
+            grids = [_grid_rows(grid, start, stop) for start, stop in zip(bounds[:-1], bounds[1:])]
+            predictions = _predict_in_parallel(self._predict_function, grids, self._batch_size, self._n_jobs,
+                                               self._executor)
+        else:
+            predictions = np.split(self._predict(grid), bounds[1:-1])
+        return OrderedDict((var_name, np.reshape(yhat, (len(observations), -1)))
+                           for var_name, yhat in zip(variable_splits.keys(), predictions))
+
+    async def _calculate_predictions_async(self, max_concurrency=8):
+        """
+        Calculate predictions for the profiles and the observations with concurrent calls of the predict function
+
+        :param max_concurrency: maximal number of predict calls awaited at once
+        """
+        grid, bounds = self._scoring_grid(self._variable_splits)
+        batch_size = self._batch_size or max(bounds[-1], 1)
+        chunks = [[_grid_rows(grid, start, min(start + batch_size, stop)) for start in range(start, stop, batch_size)]
+                  for start, stop in zip(bounds[:-1], bounds[1:])]
+        semaphore = asyncio.Semaphore(max_concurrency)
+        results = await asyncio.gather(*([_predict_async(self._predict_function, chunk, semaphore)
+                                          for grid_chunks in chunks for chunk in grid_chunks] +
+                                         [_predict_async(self._predict_function,
+                                                         self._observations_input(self.new_observation), semaphore)]))
+        self.new_observation_predictions = results.pop()
+        # predictions of the chunks are grouped back by variables
+        results = iter(results)
+        self._predictions = OrderedDict(
+            (var_name, np.reshape(np.concatenate([np.asarray(next(results)) for _ in grid_chunks]),
+                                  (len(self.new_observation), -1)))
+            for var_name, grid_chunks in zip(self._variable_splits.keys(), chunks))
+
+    def add_observations(self, new_observation, y=None):
+        """
+        Extend the profile with new observations
+
+        Only the grids of the new observations are scored, predictions for the present observations are kept.
+
+        :param new_observation: observations in the same format as in `individual_variable_profile`
+        :param y: labels for the new observations
+        :return: the profile
+        """
+        new_observation = _observation_df(new_observation, self.all_variable_names)
+        new_observation = new_observation.set_axis(_appended_index(self.new_observation.index, new_observation.index),
+                                                   axis=0)
+        if self._predictions is not None:
+            predictions = self._calculate_predictions(self._variable_splits, new_observation)
+            self._predictions = OrderedDict((var_name, np.concatenate([yhat, predictions[var_name]]))
+                                            for var_name, yhat in self._predictions.items())
+        if self.new_observation_true is not None or y is not None:
+            # missing labels are filled with NaNs
+            true = [pd.Series(np.full(len(observations), np.nan)) if labels is None else transform_into_Series(labels)
+                    for labels, observations in [(self.new_observation_true, self.new_observation),
+                                                 (y, new_observation)]]
+            self.new_observation_true = pd.concat(true, ignore_index=True)
+        self.new_observation_predictions = np.concatenate([np.asarray(self.new_observation_predictions),
+                                                           np.asarray(self._predict_observations(new_observation))])
+        self.new_observation = pd.concat([self.new_observation, new_observation])
+        self.new_observation_values = self.new_observation[self.selected_variables]
+        self._profile = None
+        return self
+
+    def add_variables(self, variables, variable_splits=None):
+        """
+        Extend the profile with new variables
+
+        :param variables: collection of variables, the ones already in the profile are skipped
+        :param variable_splits: dictionary of splits for the new variables, if None then calculated as in the constructor
+        :return: the profile
+        """
+        if not set(variables).issubset(self.all_variable_names):
+            raise ValueError('Invalid variable names')
+        variables = [var for var in OrderedDict.fromkeys(variables) if var not in self._variable_splits]
+        if not variables:
+            return self
+        new_splits = self._get_variable_splits(variable_splits, variables)
+        if self._predictions is not None:
+            self._predictions.update(self._calculate_predictions(new_splits))
+        self._variable_splits = OrderedDict(list(self._variable_splits.items()) + list(new_splits.items()))
+        self.selected_variables = self.selected_variables + variables
+        self.new_observation_values = self.new_observation[self.selected_variables]
+        self._profile = None
+        return self
+
+    def add_grid_points(self, variable_splits):
+        """
+        Extend splits of variables with new values
+
+        Only the new values are scored, the splits are kept sorted.
+
+        :param variable_splits: mapping of variables in the profile into collections of new split values
+        :return: the profile
+        """
+        if not set(variable_splits).issubset(self._variable_splits):
+            raise ValueError('Variables not present in the profile')
+        new_splits = OrderedDict()
+        for var_name, values in variable_splits.items():
+            values = pd.unique(np.asarray(values))
+            values = values[~np.isin(values, self._variable_splits[var_name])]
+            if len(values):
+                new_splits[var_name] = values
+        predictions = self._calculate_predictions(new_splits) if self._predictions is not None else None
+        splits = OrderedDict(self._variable_splits)
+        for var_name, values in new_splits.items():
+            split = np.concatenate([splits[var_name], values])
+            order = np.argsort(split, kind='mergesort')
+            splits[var_name] = split[order]
+            if predictions is not None:
+                self._predictions[var_name] = np.concatenate([self._predictions[var_name], predictions[var_name]],
+                                                             axis=1)[:, order]
+        self._variable_splits = splits
+        self._profile = None
+        return self
+
+    def _refine_splits(self, max_predictions=None):
+        """
+        Calculate predictions on adaptively refined splits
+
+        Numerical variables start with a coarse grid of points from their splits. In every round intervals scored by
+        `_interval_scores` above the tolerance are divided in halves, starting from the highest scores, as long as the
+        budget of scored grid rows allows. Profiles of step functions are refined only around their jumps.
+
+        :param max_predictions: maximal number of scored grid rows, if None then the size of the uniform grid
+        """
+        n_observations = len(self.new_observation)
+        if max_predictions is None:
+            max_predictions = n_observations * sum(len(split) for split in self._variable_splits.values())
+        refinable = [var_name for var_name, split in self._variable_splits.items() if _is_refinable(split)]
+        splits = OrderedDict(self._variable_splits)
+        for var_name in refinable:
+            splits[var_name] = _coarse_split(splits[var_name])
+        self._variable_splits = splits
+        self._predictions = self._calculate_predictions(splits)
+        budget = max_predictions - n_observations * sum(len(split) for split in splits.values())
+        while n_observations and budget >= n_observations:
+            predictions = np.concatenate([yhat.ravel() for yhat in self._predictions.values()])
+            tolerance = _ADAPTIVE_TOLERANCE * np.ptp(predictions) if len(predictions) else 0
+            candidates = []
+            for var_name in refinable:
+                split = self._variable_splits[var_name]
+                scores = _interval_scores(split, self._predictions[var_name])
+                intervals = np.flatnonzero(scores > tolerance)
+                midpoints, divisible = _midpoints(split, intervals)
+                candidates.extend(zip(scores[intervals][divisible], repeat(var_name), midpoints[divisible]))
+            if not candidates:
+                break
+            candidates.sort(key=lambda candidate: -candidate[0])
+            selected = candidates[:budget // n_observations]
+            new_points = OrderedDict()
+            for score, var_name, point in selected:
+                new_points.setdefault(var_name, []).append(point)
+            self.add_grid_points(new_points)
+            budget -= n_observations * len(selected)
+
+    def _profile_from_predictions(self, variable_splits, predictions):
+        """
+        Build DataFrame profile with the grids labeled with predictions, variable names and observation ids
+        """
+        variables = list(variable_splits.keys())
+        return pd.concat([self._label_grid(self._variable_grid(var_name, var_split), var_name, var_split,
+                                           predictions[var_name], variables=variables)
+                          for var_name, var_split in variable_splits.items()], ignore_index=True)
 
     def _calculate_single_split(self, X_var):
         """
@@ -120,10 +950,16 @@ class CeterisParibus:
         :param X_var: variable data - pandas Series
         :return: selected subset of values for the variable
         """
+        if isinstance(X_var.dtype, pd.SparseDtype):
+            X_var = X_var.sparse.to_dense()
+        if self._split_method == 'sketch':
+            return SplitSketch(self._grid_points, self._max_categories).update(X_var).split()
         if np.issubdtype(X_var.dtype, np.floating):
             # grid points might be larger than the number of unique values
             quantiles = np.linspace(0, 1, self._grid_points)
             return np.quantile(X_var, quantiles)
+        elif self._max_categories is not None:
+            return capped_split(X_var, self._max_categories)
         else:
             return np.unique(X_var)
 
@@ -139,38 +975,76 @@ class CeterisParibus:
             for (var, X_var) in chosen_variables_dict.items()
         )
 
-    def _single_variable_df(self, var_name, var_split):
+    def _label_grid(self, df, var_name, var_split, yhat, observations=None, variables=None):
         """
-        Calculate profiles for a given variable
+        Add predictions, variable name, label and observation ids to the grid
 
-        :param var_name: variable name
-        :param var_split: split values for the variable
-        :return: DataFrame with profiles for a given variable
+        :param df: DataFrame with the grid built with `_variable_grid`
+        :param yhat: predictions for the grid
+        :param variables: categories of the variable names column, if None then only the given variable
+        :return: DataFrame with the profiles
         """
-        return pd.concat([self._single_observation_df(observation, var_name, var_split, profile_id)
-                          for profile_id, observation in self.new_observation.iterrows()], ignore_index=True)
+        variables = variables or [var_name]
+        df['_yhat_'] = np.ravel(yhat)
+        df['_vname_'] = pd.Categorical.from_codes(np.full(len(df), variables.index(var_name)), categories=variables)
+        df['_label_'] = pd.Categorical.from_codes(np.zeros(len(df), dtype=int), categories=[self._label])
+        df['_ids_'] = self._grid_ids(var_split, observations)
+        return df
 
-    def _single_observation_df(self, observation, var_name, var_split, profile_id):
+    def _variable_grid(self, var_name, var_split, observations=None):
         """
-        Calculates the single profile
+        Build the what-if grid for a given variable
+
+        Every observation is repeated once per split value, with the variable replaced by subsequent split values.
 
-        :param observation: observation for which the profile is calculated
         :param var_name: variable name
         :param var_split: split values for the variable
-        :param profile_id: profile id
-        :return: DataFrame with the calculated profile values
-        """
-        # grid_points and self._grid_point might differ for categorical variables
-        grid_points = len(var_split)
-        X = np.tile(observation, (grid_points, 1))
-        X_dict = OrderedDict(zip(self.all_variable_names, X.T))
-        df = pd.DataFrame.from_dict(X_dict)
-        df[var_name] = var_split
-        df['_yhat_'] = self._predict_function(df)
-        df['_vname_'] = np.repeat(var_name, grid_points)
-        df['_label_'] = self._label
-        df['_ids_'] = profile_id
-        return df
+        :param observations: DataFrame with observations, if None then all observations are used
+        :return: DataFrame with the grid - only the variables columns
+        """
+        if observations is None:
+            observations = self.new_observation
+        return _stacked_grid(observations, {var_name: var_split}, self.all_variable_names)[0]
+
+    def _scoring_grid(self, variable_splits, observations=None):
+        """
+        Build the grids of the given variables stacked into a single block passed to the predict function
+
+        :param variable_splits: mapping of variables into split values
+        :param observations: DataFrame with observations, if None then all observations are used
+        :return: DataFrame, or a SciPy CSR matrix for sparse data, and array of bounds of subsequent grids
+        """
+        if observations is None:
+            observations = self.new_observation
+        if self._sparse:
+            return _sparse_grid(observations, variable_splits, self.all_variable_names)
+        return _stacked_grid(observations, variable_splits, self.all_variable_names)
+
+    def _observations_input(self, observations):
+        """
+        Observations in the form taken by the predict function
+        """
+        return _as_csr(observations[self.all_variable_names]) if self._sparse else observations
+
+    def _predict_observations(self, observations):
+        """
+        Score the observations with the predict function
+        """
+        return self._predict_function(self._observations_input(observations))
+
+    def _grid_ids(self, var_split, observations=None):
+        """
+        Ids of observations for subsequent rows of the grid built with `_variable_grid`
+        """
+        if observations is None:
+            observations = self.new_observation
+        return np.repeat(observations.index.values, len(var_split))
+
+    def _predict(self, X):
+        """
+        Score the grid with the predict function
+        """
+        return _predict_in_batches(self._predict_function, X, self._batch_size)
 
     def split_by(self, column):
         """
@@ -178,7 +1052,7 @@ class CeterisParibus:
 
         :return: sorted mapping of values to dataframes
         """
-        return OrderedDict(sorted(list(self.profile.groupby(column, sort=False))))
+        return OrderedDict(sorted(list(self.profile.groupby(column, sort=False, observed=True))))
 
     def set_label(self, label):
         self._label = label
@@ -1,9 +1,13 @@
 import logging
+import os
+from concurrent.futures import ThreadPoolExecutor
 
 import numpy as np
 import pandas as pd
 
-from ceteris_paribus.gower import gower_distances
+from ceteris_paribus.data import ChunkedData
+from ceteris_paribus.gower import _encode_mixed_data, _encode_observation, _gower_distances_encoded, _numeric_mask, \
+    _encode_observations, _gower_distances_block
 from ceteris_paribus.utils import transform_into_Series
 
 
@@ -11,19 +15,23 @@ def select_sample(data, y=None, n=15, seed=42):
     """
     Select sample from dataset.
 
-    :param data: array or dataframe with observations
+    :param data: array, dataframe or ChunkedData with observations
     :param y: labels for observations
     :param n: size of the sample
     :param seed: seed for random number generator
     :return: selected observations and corresponding labels if provided
     """
-    np.random.seed(seed)
+    # local generator does not affect the global state, results are the same as for `np.random.seed`
+    random_state = np.random.RandomState(seed)
     if n > data.shape[0]:
         logging.warning("Given n ({}) is larger than data size ({})".format(n, data.shape[0]))
         n = data.shape[0]
-    indices = np.random.choice(data.shape[0], n, replace=False)
+    indices = random_state.choice(data.shape[0], n, replace=False)
 
-    if isinstance(data, pd.core.frame.DataFrame):
+    if isinstance(data, ChunkedData):
+        # only the sampled rows are read
+        sampled_x = data.take(indices).reset_index(drop=True)
+    elif isinstance(data, pd.core.frame.DataFrame):
         sampled_x = data.iloc[indices]
         sampled_x.reset_index(drop=True, inplace=True)
     else:
@@ -36,28 +44,133 @@ def select_sample(data, y=None, n=15, seed=42):
         return sampled_x
 
 
-def _select_columns(data, observation, variable_names=None, selected_variables=None):
+def select_sample_stream(chunks, y=None, n=15, stratify=None, seed=42):
     """
-    Select data with specified columns
+    Select sample from a stream of data in a single pass
+
+    Every row gets a random key and the rows with the smallest keys are kept (reservoir sampling),
+    so only the sample and a single chunk are in memory. In the stratified mode the sample of every stratum
+    is kept separately and finally the strata are represented proportionally to their sizes.
+
+    :param chunks: iterable of DataFrames or 2D arrays with subsequent rows, a single DataFrame or array, ChunkedData or path to a Parquet file
+    :param y: labels for all observations or name of the column with labels, which is then removed from the sample
+    :param n: size of the sample
+    :param stratify: None, 'y' for stratification on labels or name of the column to stratify on
+    :param seed: seed or `np.random.Generator`, the generator is local so the global state is not changed
+    :return: selected observations and corresponding labels if provided
+    """
+    rng = np.random.default_rng(seed)
+    if isinstance(chunks, str):
+        chunks = ChunkedData(chunks)
+    if isinstance(chunks, ChunkedData):
+        chunks = chunks.iter_chunks()
+    elif isinstance(chunks, (pd.core.frame.DataFrame, np.ndarray)):
+        chunks = [chunks]
+    if stratify == 'y' and y is None:
+        raise ValueError("Labels are required for stratification on y")
+    label_column = y if isinstance(y, str) else None
+    if y is not None and label_column is None:
+        y = transform_into_Series(y)
+
+    sample = None
+    counts = {}
+    start = 0
+    for chunk in chunks:
+        if not isinstance(chunk, pd.core.frame.DataFrame):
+            chunk = pd.DataFrame(np.asarray(chunk))
+        chunk = chunk.reset_index(drop=True)
+        keys = pd.DataFrame({'_position_': np.arange(start, start + len(chunk)), '_key_': rng.random(len(chunk))})
+        start += len(chunk)
+        if stratify is None:
+            keys['_stratum_'] = 0
+        elif stratify == 'y':
+            keys['_stratum_'] = chunk[label_column].values if label_column else y.iloc[keys['_position_']].values
+        else:
+            keys['_stratum_'] = chunk[stratify].values
+        for stratum, count in keys['_stratum_'].value_counts(dropna=False).items():
+            counts[stratum] = counts.get(stratum, 0) + count
+        chunk_sample = _smallest_keys(pd.concat([keys, chunk], axis=1), n)
+        if sample is not None:
+            chunk_sample = _smallest_keys(pd.concat([sample, chunk_sample], ignore_index=True), n)
+        sample = chunk_sample
+
+    if sample is None:
+        raise ValueError("Empty data")
+    if n > start:
+        logging.warning("Given n ({}) is larger than data size ({})".format(n, start))
+        n = start
+    if stratify is not None:
+        allocation = _allocate(counts, n)
+        sample = sample[sample.groupby('_stratum_', dropna=False).cumcount().values <
+                        sample['_stratum_'].map(allocation).values]
+    sample = sample.iloc[:n]
+
+    positions = sample['_position_'].values
+    sampled_x = sample.drop(columns=['_position_', '_key_', '_stratum_']).reset_index(drop=True)
+    if label_column is not None:
+        return sampled_x.drop(columns=[label_column]), sampled_x[label_column]
+    if y is not None:
+        return sampled_x, y.iloc[positions].reset_index(drop=True)
+    return sampled_x
+
+
+def _smallest_keys(sample, n):
+    """
+    Keep n rows with the smallest keys in every stratum, they are uniform sample of the stratum
+    """
+    sample = sample.sort_values('_key_', kind='mergesort')
+    return sample[sample.groupby('_stratum_', dropna=False).cumcount().values < n]
+
+
+def _allocate(counts, n):
+    """
+    Split n between strata proportionally to their sizes with the largest remainder method
+    """
+    total = sum(counts.values())
+    quotas = dict((stratum, n * count / total) for stratum, count in counts.items())
+    allocation = dict((stratum, int(np.floor(quota))) for stratum, quota in quotas.items())
+    remainders = sorted(quotas, key=lambda stratum: quotas[stratum] - allocation[stratum], reverse=True)
+    for stratum in remainders[:n - sum(allocation.values())]:
+        allocation[stratum] += 1
+    return allocation
+
+
+def _selected_indices(data, variable_names=None, selected_variables=None):
+    """
+    Find positions of the selected columns
 
     :param data: DataFrame with observations
-    :param observation: pandas Series with reference observation for neighbours selection
     :param variable_names: names of all variables
     :param selected_variables: names of selected variables
-    :return: DataFrame with observations and pandas Series with referenced observation, with selected columns
+    :return: list of positions of the selected columns or None if all columns should be used
     """
     if selected_variables is None:
-        return data, observation
+        return None
     try:
         if variable_names is None:
             if isinstance(data, pd.core.frame.DataFrame):
                 variable_names = data.columns
             else:
                 raise ValueError("Impossible to detect variable names")
-        indices = [list(variable_names).index(var) for var in selected_variables]
+        return [list(variable_names).index(var) for var in selected_variables]
     except ValueError:
         logging.warning("Selected variables: {} is not a subset of variables: {}".format(
             selected_variables, variable_names))
+        return None
+
+
+def _select_columns(data, observation, variable_names=None, selected_variables=None):
+    """
+    Select data with specified columns
+
+    :param data: DataFrame with observations
+    :param observation: pandas Series with reference observation for neighbours selection
+    :param variable_names: names of all variables
+    :param selected_variables: names of selected variables
+    :return: DataFrame with observations and pandas Series with referenced observation, with selected columns
+    """
+    indices = _selected_indices(data, variable_names, selected_variables)
+    if indices is None:
         return data, observation
 
     subset_data = data.iloc[:, indices]
@@ -68,42 +181,343 @@ def select_neighbours(data, observation, y=None, variable_names=None, selected_v
     """
     Select observations from dataset, that are similar to a given observation
 
-    :param data: array or DataFrame with observations
+    :param data: array, DataFrame or ChunkedData with observations, ChunkedData is processed chunk by chunk
     :param observation: reference observation for neighbours selection
     :param y: labels for observations
     :param variable_names: names of variables
     :param selected_variables: selected variables - require supplying variable names along with data
     :param dist_fun: 'gower' or distance function, as pairwise distances in sklearn, gower works with missing data
     :param n: size of the sample
-    :return: DataFrame with selected observations and pandas Series with corresponding labels if provided
+    :return: DataFrame with selected observations and pandas Series with corresponding labels if provided, sorted by the distance
+    """
+    if isinstance(data, ChunkedData):
+        return _select_neighbours_chunked(data, observation, y, variable_names, selected_variables, dist_fun, n)
+    index = NeighbourIndex(data, y, variable_names, selected_variables, dist_fun)
+    return index.select(observation, n)
+
+
+def _select_neighbours_chunked(data, observation, y=None, variable_names=None, selected_variables=None,
+                               dist_fun='gower', n=20):
+    """
+    Select neighbours from out-of-core data keeping only the closest observations of the chunks processed so far
+
+    Gower distance requires ranges of numeric columns, so the data is read twice.
     """
+    if dist_fun != 'gower' and not callable(dist_fun):
+        raise ValueError('Distance has to be "gower" or a custom function')
     if n > data.shape[0]:
         logging.warning("Given n ({}) is larger than data size ({})".format(n, data.shape[0]))
         n = data.shape[0]
+    indices = _selected_indices(data, data.columns if variable_names is None else variable_names, selected_variables)
+    observation = transform_into_Series(observation)
+    columns = data.columns
+    if indices is not None:
+        columns = [columns[i] for i in indices]
+        observation = observation.iloc[indices]
+    ranges = _numeric_ranges(data.iter_chunks(columns)) if dist_fun == 'gower' else None
 
-    if not isinstance(data, pd.core.frame.DataFrame):
-        data = pd.DataFrame(data)
+    positions = np.empty(0, dtype=np.int64)
+    distances = np.empty(0)
+    for chunk in data.iter_chunks(columns):
+        if dist_fun == 'gower':
+            encoded = _encode_mixed_data(chunk)._replace(mins=ranges[0], maxs=ranges[1])
+            chunk_distances = _gower_distances_encoded(encoded, *_encode_observation(encoded, observation))
+        else:
+            chunk_distances = dist_fun([observation], chunk)[0]
+        positions = np.concatenate([positions, chunk.index.values])
+        distances = np.concatenate([distances, chunk_distances])
+        best = _top_n(distances, min(n, len(distances)))
+        positions, distances = positions[best], distances[best]
 
-    observation = transform_into_Series(observation)
+    selected_points = data.take(positions).reset_index(drop=True)
+    if y is not None:
+        return selected_points, transform_into_Series(y).iloc[positions].reset_index(drop=True)
+    else:
+        return selected_points
+
+
+def _numeric_ranges(chunks):
+    """
+    Return minima and maxima of numeric columns over all chunks
+    """
+    mins = maxs = None
+    for chunk in chunks:
+        numeric = chunk.iloc[:, np.flatnonzero(_numeric_mask(chunk.dtypes))].values.astype(np.float64)
+        if not len(numeric):
+            continue
+        chunk_mins, chunk_maxs = np.fmin.reduce(numeric, axis=0), np.fmax.reduce(numeric, axis=0)
+        mins = chunk_mins if mins is None else np.fmin(mins, chunk_mins)
+        maxs = chunk_maxs if maxs is None else np.fmax(maxs, chunk_maxs)
+    return mins, maxs
+
+
+def select_neighbours_batch(data, observations, variable_names=None, selected_variables=None, dist_fun='gower', n=20,
+                            query_block_size=16, data_block_size=8192, n_jobs=None):
+    """
+    Find neighbours of many observations at once
+
+    Distances are calculated for blocks of observations and blocks of the data, with bounded memory.
+    Only the n closest observations are kept for every query. ChunkedData is read once, chunk by chunk.
 
-    # columns are selected for the purpose of distance calculation
-    selected_data, observation = _select_columns(data, observation, variable_names, selected_variables)
+    :param data: array, DataFrame or ChunkedData with observations
+    :param observations: 2D array or DataFrame with reference observations
+    :param variable_names: names of variables
+    :param selected_variables: selected variables - require supplying variable names along with data
+    :param dist_fun: 'gower' or distance function, as pairwise distances in sklearn, gower works with missing data
+    :param n: number of neighbours
+    :param query_block_size: number of observations in a single block
+    :param data_block_size: number of rows of the data in a single block
+    :param n_jobs: number of threads processing blocks of observations, -1 means all processors, if None then blocks are processed in the main thread
+    :return: 2D array with positions of neighbours in the data sorted by distance, a row for every observation
+    """
+    if isinstance(data, ChunkedData):
+        return _select_neighbours_batch_chunked(data, observations, variable_names, selected_variables, dist_fun, n,
+                                                query_block_size, n_jobs)
+    index = NeighbourIndex(data, variable_names=variable_names, selected_variables=selected_variables,
+                           dist_fun=dist_fun)
+    return index.query(np.array(observations, dtype=object).reshape((len(observations), -1)), n, query_block_size,
+                       data_block_size, n_jobs)
+
+
+def _select_neighbours_batch_chunked(data, observations, variable_names=None, selected_variables=None,
+                                     dist_fun='gower', n=20, query_block_size=16, n_jobs=None):
+    """
+    Find neighbours of many observations in out-of-core data, every chunk is a block of the data
+    """
+    if dist_fun != 'gower' and not callable(dist_fun):
+        raise ValueError('Distance has to be "gower" or a custom function')
+    if n > data.shape[0]:
+        logging.warning("Given n ({}) is larger than data size ({})".format(n, data.shape[0]))
+        n = data.shape[0]
+    observations = np.array(observations, dtype=object).reshape((len(observations), -1))
+    indices = _selected_indices(data, data.columns if variable_names is None else variable_names, selected_variables)
+    columns = data.columns
+    if indices is not None:
+        columns = [columns[i] for i in indices]
+        observations = observations[:, indices]
+    ranges = _numeric_ranges(data.iter_chunks(columns)) if dist_fun == 'gower' else None
+
+    best_distances = np.empty((len(observations), 0))
+    best_positions = np.empty((len(observations), 0), dtype=np.int64)
+    for chunk in data.iter_chunks(columns):
+        if dist_fun == 'gower':
+            encoded = _encode_mixed_data(chunk)._replace(mins=ranges[0], maxs=ranges[1])
+            numeric, codes = _encode_observations(encoded, observations)
+
+            def block_distances(queries, rows):
+                return _gower_distances_block(encoded, numeric[queries], codes[queries], rows)
+        else:
+            def block_distances(queries, rows):
+                return dist_fun(observations[queries], chunk.iloc[rows])
+
+        chunk_distances, chunk_positions = _blockwise_top_n(block_distances, len(observations), len(chunk), n,
+                                                            query_block_size, len(chunk), n_jobs, sort=False)
+        best_distances, best_positions = _merge_top_n(best_distances, best_positions, chunk_distances,
+                                                      chunk_positions + chunk.index[0], n)
+    return _sorted_positions(best_distances, best_positions)
 
-    if dist_fun == 'gower':
-        distances = gower_distances(selected_data, observation)
+
+def _blockwise_top_n(block_distances, n_queries, n_rows, n, query_block_size, data_block_size, n_jobs=None,
+                     sort=True):
+    """
+    Find n smallest distances for every query, processing blocks of queries in parallel
+
+    :param block_distances: function calculating distances between a slice of queries and a slice of rows
+    :param sort: if True then return positions sorted by distance, otherwise unsorted distances and positions
+    """
+    def query_block(start):
+        queries = slice(start, min(start + query_block_size, n_queries))
+        best_distances = np.empty((queries.stop - start, 0))
+        best_positions = np.empty((queries.stop - start, 0), dtype=np.int64)
+        for row_start in range(0, n_rows, data_block_size):
+            rows = slice(row_start, min(row_start + data_block_size, n_rows))
+            distances = block_distances(queries, rows)
+            positions = np.broadcast_to(np.arange(rows.start, rows.stop), distances.shape)
+            best_distances, best_positions = _merge_top_n(best_distances, best_positions, distances, positions, n)
+        return best_distances, best_positions
+
+    starts = range(0, n_queries, query_block_size)
+    if n_jobs is None or n_jobs == 1:
+        blocks = [query_block(start) for start in starts]
     else:
-        if not callable(dist_fun):
-            raise ValueError('Distance has to be "gower" or a custom function')
-        distances = dist_fun([observation], selected_data)[0]
+        # numpy releases the GIL in the element-wise operations
+        with ThreadPoolExecutor(max_workers=os.cpu_count() if n_jobs == -1 else n_jobs) as pool:
+            blocks = list(pool.map(query_block, starts))
+    distances = np.concatenate([block[0] for block in blocks]) if blocks else np.empty((0, n))
+    positions = np.concatenate([block[1] for block in blocks]) if blocks else np.empty((0, n), dtype=np.int64)
+    if sort:
+        return _sorted_positions(distances, positions)
+    return distances, positions
+
+
+def _merge_top_n(best_distances, best_positions, distances, positions, n):
+    """
+    Keep n smallest distances in every row of both matrices
+    """
+    distances = np.concatenate([best_distances, distances], axis=1)
+    positions = np.concatenate([best_positions, positions], axis=1)
+    if distances.shape[1] <= n:
+        return distances, positions
+    selected = np.argpartition(distances, n - 1, axis=1)[:, :n]
+    return np.take_along_axis(distances, selected, axis=1), np.take_along_axis(positions, selected, axis=1)
+
+
+def _sorted_positions(distances, positions):
+    """
+    Sort positions in every row by distance, ties are resolved by position
+    """
+    order = np.lexsort((positions, distances), axis=-1)
+    return np.take_along_axis(positions, order, axis=1)
 
+
+def _top_n(distances, n):
+    """
+    Return indices of n smallest distances sorted by the distance
+    """
     indices = np.argpartition(distances, n - 1)[:n]
+    return indices[np.argsort(distances[indices], kind='mergesort')]
 
-    # selected points have all variables
-    selected_points = data.iloc[indices]
-    selected_points.reset_index(drop=True, inplace=True)
 
-    if y is not None:
-        y = transform_into_Series(y)
-        return selected_points, y.iloc[indices].reset_index(drop=True)
-    else:
-        return selected_points
+class NeighbourIndex:
+
+    def __init__(self, data, y=None, variable_names=None, selected_variables=None, dist_fun='gower', tree=None):
+        """
+        Creates index of observations for repeated neighbours selection
+
+        Ranges of numeric columns and codes of categorical columns are calculated once,
+        so every query only compares the encoded observation with the stored data.
+
+        :param data: array or DataFrame with observations
+        :param y: labels for observations
+        :param variable_names: names of variables
+        :param selected_variables: selected variables - require supplying variable names along with data
+        :param dist_fun: 'gower' or distance function, as pairwise distances in sklearn, gower works with missing data
+        :param tree: 'kd_tree' or 'ball_tree' - answer gower queries with a tree from sklearn.neighbors built on range-scaled data, available only for numeric data without missing values. For observations outside of the data ranges the result is approximate.
+        """
+        if isinstance(data, ChunkedData):
+            raise ValueError("Index requires data in memory, use select_neighbours for ChunkedData")
+        if not isinstance(data, pd.core.frame.DataFrame):
+            data = pd.DataFrame(data)
+        if dist_fun != 'gower' and not callable(dist_fun):
+            raise ValueError('Distance has to be "gower" or a custom function')
+        self.data = data
+        self.y = transform_into_Series(y) if y is not None else None
+        self._dist_fun = dist_fun
+        self._indices = _selected_indices(data, variable_names, selected_variables)
+        # columns are selected for the purpose of distance calculation
+        self._selected_data = data if self._indices is None else data.iloc[:, self._indices]
+        self._encoded = _encode_mixed_data(self._selected_data) if dist_fun == 'gower' else None
+        self._tree = self._build_tree(tree) if tree else None
+
+    def _build_tree(self, tree):
+        """
+        Build a tree on numeric data scaled to [0, 1], where gower distance is the scaled manhattan distance
+        """
+        if self._dist_fun != 'gower':
+            logging.warning("Tree is supported only for gower distance. Parameter is ignored")
+            return None
+        if not self._encoded.numeric_mask.all() or np.isnan(self._encoded.numeric).any():
+            logging.warning("Tree requires numeric data without missing values. Parameter is ignored")
+            return None
+        try:
+            from sklearn.neighbors import KDTree, BallTree
+        except ImportError:
+            logging.warning("scikit-learn not found. Tree is not used")
+            return None
+        if tree not in {'kd_tree', 'ball_tree'}:
+            raise ValueError('Tree has to be "kd_tree" or "ball_tree"')
+        tree_class = KDTree if tree == 'kd_tree' else BallTree
+        return tree_class(self._scale(self._encoded.numeric), metric='manhattan')
+
+    def _scale(self, numeric):
+        ranges = self._encoded.maxs - self._encoded.mins
+        # columns with constant values do not contribute to the distance
+        ranges[np.isclose(0, ranges)] = np.inf
+        return (numeric - self._encoded.mins) / ranges
+
+    def _select_observation(self, observation):
+        observation = transform_into_Series(observation)
+        if self._indices is None:
+            return observation
+        return observation.iloc[self._indices]
+
+    def distances(self, observation):
+        """
+        Calculate distances between the observation and all indexed observations
+
+        :param observation: reference observation
+        :return: array of distances
+        """
+        observation = self._select_observation(observation)
+        if self._dist_fun == 'gower':
+            return _gower_distances_encoded(self._encoded, *_encode_observation(self._encoded, observation))
+        return self._dist_fun([observation], self._selected_data)[0]
+
+    def query(self, observations, n=20, query_block_size=16, data_block_size=8192, n_jobs=None):
+        """
+        Find positions of observations closest to the given ones
+
+        Many observations are compared with the data in blocks of `query_block_size` x `data_block_size` distances,
+        keeping only the n closest observations found so far, so the memory does not depend on the data size.
+
+        :param observations: a single observation or a 2D array / DataFrame with many observations
+        :param n: number of neighbours
+        :param query_block_size: number of observations in a single block
+        :param data_block_size: number of rows of the data in a single block
+        :param n_jobs: number of threads processing blocks of observations, -1 means all processors, if None then blocks are processed in the main thread
+        :return: positions of neighbours sorted by distance - an array for a single observation or a 2D array with a row for every observation
+        """
+        if n > self.data.shape[0]:
+            logging.warning("Given n ({}) is larger than data size ({})".format(n, self.data.shape[0]))
+            n = self.data.shape[0]
+
+        single = not isinstance(observations, pd.core.frame.DataFrame) and np.ndim(observations) < 2
+        if single:
+            observations = [observations]
+        elif isinstance(observations, pd.core.frame.DataFrame):
+            observations = [row for _, row in observations.iterrows()]
+
+        if self._tree is not None:
+            numeric = np.array([_encode_observation(self._encoded, self._select_observation(observation))[0]
+                                for observation in observations])
+            result = self._tree.query(self._scale(numeric), k=n, return_distance=False)
+        elif single:
+            result = np.array([_top_n(self.distances(observations[0]), n)])
+        else:
+            result = self._query_blocks(observations, n, query_block_size, data_block_size, n_jobs)
+        return result[0] if single else result
+
+    def _query_blocks(self, observations, n, query_block_size, data_block_size, n_jobs):
+        observations = np.array(observations, dtype=object)
+        if self._indices is not None:
+            observations = observations[:, self._indices]
+        if self._dist_fun == 'gower':
+            numeric, codes = _encode_observations(self._encoded, observations)
+
+            def block_distances(queries, rows):
+                return _gower_distances_block(self._encoded, numeric[queries], codes[queries], rows)
+        else:
+            def block_distances(queries, rows):
+                return self._dist_fun(observations[queries], self._selected_data.iloc[rows])
+
+        return _blockwise_top_n(block_distances, len(observations), self.data.shape[0], n, query_block_size,
+                                data_block_size, n_jobs)
+
+    def select(self, observation, n=20):
+        """
+        Select observations similar to a given observation
+
+        :param observation: reference observation for neighbours selection
+        :param n: size of the sample
+        :return: DataFrame with selected observations and pandas Series with corresponding labels if provided
+        """
+        indices = self.query(observation, n)
+
+        # selected points have all variables
+        selected_points = self.data.iloc[indices]
+        selected_points.reset_index(drop=True, inplace=True)
+
+        if self.y is not None:
+            return selected_points, self.y.iloc[indices].reset_index(drop=True)
+        else:
+            return selected_points
@@ -0,0 +1,243 @@
+""" This is the module with mergeable sketches for calculating variable splits in a single streaming pass """
+import numpy as np
+import pandas as pd
+
+
+class QuantileSketch:
+
+    def __init__(self, k=200, seed=42):
+        """
+        Creates KLL-style sketch of quantiles of a numerical variable
+
+        Values are kept in levels of compactors, an item on level h stands for 2^h values.
+        A level exceeding its capacity is sorted and every second item (starting at random offset) is
+        promoted to the next level. The memory is O(k log(n / k)) and sketches of separate chunks might be merged.
+
+        :param k: size of the top level compactor, larger values give more accurate quantiles
+        :param seed: seed of the local random number generator used for compactions
+        """
+        self._k = k
+        self._random_state = np.random.RandomState(seed)
+        self._levels = [np.empty(0)]
+        self.count = 0
+        self.min = np.inf
+        self.max = -np.inf
+
+    def update(self, values):
+        """
+        Add values to the sketch, missing values are skipped
+
+        :param values: array of values
+        :return: the sketch
+        """
+        values = np.asarray(values, dtype=np.float64).ravel()
+        values = values[~np.isnan(values)]
+        if len(values):
+            self.count += len(values)
+            self.min = min(self.min, values.min())
+            self.max = max(self.max, values.max())
+            self._levels[0] = np.concatenate([self._levels[0], values])
+            self._compress()
+        return self
+
+    def merge(self, other):
+        """
+        Merge other sketch into this one
+
+        :param other: QuantileSketch object
+        :return: the sketch
+        """
+        while len(self._levels) < len(other._levels):
+            self._levels.append(np.empty(0))
+        for level, items in enumerate(other._levels):
+            self._levels[level] = np.concatenate([self._levels[level], items])
+        self.count += other.count
+        self.min = min(self.min, other.min)
+        self.max = max(self.max, other.max)
+        self._compress()
+        return self
+
+    def _capacity(self, level):
+        depth = len(self._levels) - level - 1
+        return max(2, int(np.ceil(self._k * (2. / 3) ** depth)))
+
+    def _compress(self):
+        level = 0
+        while level < len(self._levels):
+            items = self._levels[level]
+            if len(items) <= self._capacity(level):
+                level += 1
+                continue
+            if level + 1 == len(self._levels):
+                self._levels.append(np.empty(0))
+            items = np.sort(items)
+            # an odd item stays on its level
+            n_even = len(items) - len(items) % 2
+            promoted = items[self._random_state.randint(2):n_even:2]
+            self._levels[level] = items[n_even:]
+            self._levels[level + 1] = np.concatenate([self._levels[level + 1], promoted])
+            # capacities of lower levels shrink when a new level is added
+            level = 0
+
+    def quantiles(self, q):
+        """
+        Approximate quantiles, minimum and maximum are exact
+
+        :param q: array of probabilities in [0, 1]
+        :return: array of quantiles
+        """
+        q = np.asarray(q, dtype=np.float64)
+        if not self.count:
+            return np.full(q.shape, np.nan)
+        items = np.concatenate(self._levels)
+        weights = np.concatenate([np.full(len(level_items), 2. ** level)
+                                  for level, level_items in enumerate(self._levels)])
+        order = np.argsort(items, kind='mergesort')
+        items = items[order]
+        cumulative = np.cumsum(weights[order])
+        positions = np.searchsorted(cumulative, q * cumulative[-1], side='left')
+        result = items[np.clip(positions, 0, len(items) - 1)]
+        result[q <= 0] = self.min
+        result[q >= 1] = self.max
+        return result
+
+
+class SplitSketch:
+
+    def __init__(self, grid_points=101, max_categories=None, k=200, seed=42):
+        """
+        Creates sketch of a single variable for calculating its split in a streaming pass
+
+        Floating point variables are split by approximate quantiles. Integer variables are split by
+        their unique values, or by binned quantiles if there are more than `max_categories` of them.
+        Other variables are split by categories, at most `max_categories` most frequent ones.
+        Frequencies of categories are approximate when the number of categories exceeds `10 * max_categories`.
+
+        :param grid_points: number of points in the split of floating point variables
+        :param max_categories: maximal number of points in the split of integer and categorical variables, if None then not limited
+        :param k: accuracy parameter of the quantile sketch
+        :param seed: seed of the quantile sketch
+        """
+        self._grid_points = grid_points
+        self._max_categories = max_categories
+        self._quantiles = QuantileSketch(k, seed)
+        self._counts = {}
+        self._overflow = False
+        self._dtype = None
+
+    def update(self, values):
+        """
+        Add values of the variable
+
+        :param values: pandas Series or array with values
+        :return: the sketch
+        """
+        values = pd.Series(values)
+        if self._dtype is None:
+            self._dtype = values.dtype
+        if _is_numerical(self._dtype):
+            self._quantiles.update(values.values)
+        if not pd.api.types.is_float_dtype(self._dtype) and not self._overflow:
+            self._count(values.value_counts(dropna=False).items())
+        return self
+
+    def merge(self, other):
+        """
+        Merge other sketch of the same variable into this one
+
+        :param other: SplitSketch object
+        :return: the sketch
+        """
+        if self._dtype is None:
+            self._dtype = other._dtype
+        self._quantiles.merge(other._quantiles)
+        self._overflow = self._overflow or other._overflow
+        if not self._overflow:
+            self._count(other._counts.items())
+        return self
+
+    def _count(self, counts):
+        for value, count in counts:
+            self._counts[value] = self._counts.get(value, 0) + count
+        if self._max_categories is not None and len(self._counts) > self._max_categories:
+            if _is_numerical(self._dtype):
+                # integers are binned by quantiles, so the counts are not needed anymore
+                self._overflow = True
+                self._counts = {}
+            elif len(self._counts) > 10 * self._max_categories:
+                self._counts = dict(_top_categories(self._counts, 10 * self._max_categories))
+
+    def split(self):
+        """
+        :return: array with the split of the variable
+        """
+        if pd.api.types.is_float_dtype(self._dtype):
+            return self._quantiles.quantiles(np.linspace(0, 1, self._grid_points))
+        if self._overflow:
+            return _binned_integers(self._quantiles.quantiles(np.linspace(0, 1, self._max_categories)), self._dtype)
+        if self._max_categories is not None and len(self._counts) > self._max_categories:
+            values = [value for value, _ in _top_categories(self._counts, self._max_categories)]
+        else:
+            values = list(self._counts.keys())
+        return np.unique(np.array(values, dtype=_numpy_dtype(self._dtype)))
+
+
+def _is_numerical(dtype):
+    return pd.api.types.is_float_dtype(dtype) or pd.api.types.is_integer_dtype(dtype)
+
+
+def _numpy_dtype(dtype):
+    return dtype if isinstance(dtype, np.dtype) else object
+
+
+def _top_categories(counts, k):
+    """
+    Return k most frequent items of the mapping of values into counts
+    """
+    return sorted(counts.items(), key=lambda item: item[1], reverse=True)[:k]
+
+
+def _binned_integers(quantiles, dtype):
+    """
+    Round quantiles of an integer variable into unique integer split points
+    """
+    return np.unique(np.round(quantiles)).astype(_numpy_dtype(dtype))
+
+
+def capped_split(X_var, max_categories):
+    """
+    Calculate exact split of an integer or categorical variable with at most `max_categories` points
+
+    Integer variables with more unique values are binned by quantiles, other variables are
+    limited to the most frequent categories.
+
+    :param X_var: variable data - pandas Series or array
+    :param max_categories: maximal number of points in the split
+    :return: selected subset of values for the variable
+    """
+    X_var = pd.Series(X_var)
+    counts = X_var.value_counts(dropna=False)
+    if len(counts) <= max_categories:
+        return np.unique(X_var.values)
+    if _is_numerical(X_var.dtype):
+        return _binned_integers(np.quantile(X_var.values, np.linspace(0, 1, max_categories)), X_var.dtype)
+    return np.unique(np.array(list(counts.index[:max_categories]), dtype=_numpy_dtype(X_var.dtype)))
+
+
+def sketch_splits(chunks, variables, grid_points=101, max_categories=None, k=200, seed=42):
+    """
+    Calculate approximate splits of variables in a single pass over chunks of the data
+
+    :param chunks: iterable of DataFrames with subsequent rows of the data
+    :param variables: collection of variables
+    :param grid_points: number of points in the split of floating point variables
+    :param max_categories: maximal number of points in the split of integer and categorical variables, if None then not limited
+    :param k: accuracy parameter of the quantile sketch
+    :param seed: seed of the quantile sketch
+    :return: mapping of variables into their splits
+    """
+    sketches = dict((var, SplitSketch(grid_points, max_categories, k, seed)) for var in variables)
+    for chunk in chunks:
+        for var in variables:
+            sketches[var].update(chunk[var])
+    return dict((var, sketches[var].split()) for var in variables)
@@ -0,0 +1,119 @@
+""" This is the module for reading split thresholds of fitted tree models """
+import numpy as np
+
+
+def model_thresholds(model, variable_names):
+    """
+    Read split thresholds of numerical variables from a fitted tree model
+
+    Supported are scikit-learn decision trees and their ensembles (including histogram gradient boosting),
+    XGBoost and LightGBM models - both the scikit-learn wrappers and raw boosters. XGBoost and LightGBM are not
+    imported, models are recognised by their modules. Features are matched with variables by names stored in the
+    model or by positions otherwise.
+
+    :param model: fitted tree model
+    :param variable_names: names of variables in the order the model takes them
+    :return: mapping of variables into sorted arrays of unique thresholds, variables not used by the model are skipped
+    """
+    module = type(model).__module__
+    if module.startswith('xgboost'):
+        features, thresholds = _xgboost_thresholds(model)
+    elif module.startswith('lightgbm'):
+        features, thresholds = _lightgbm_thresholds(model)
+    else:
+        trees = _sklearn_trees(model)
+        if trees is None:
+            raise ValueError("Unable to read split thresholds from the model {}".format(type(model).__name__))
+        features, thresholds = _sklearn_thresholds(trees)
+    names = getattr(model, 'feature_names_in_', None)
+    names = list(variable_names) if names is None else list(names)
+    features = np.asarray([_feature_name(feature, names) for feature in features], dtype=object)
+    thresholds = np.asarray(thresholds, dtype=np.float64)
+    return dict((var, np.unique(thresholds[features == var])) for var in variable_names if (features == var).any())
+
+
+def _feature_name(feature, names):
+    """
+    Map a position or a generic name like `f3` or `Column_3` into the name of a variable
+    """
+    if isinstance(feature, str):
+        if feature in names:
+            return feature
+        for prefix in ('f', 'Column_'):
+            if feature.startswith(prefix) and feature[len(prefix):].isdigit():
+                feature = int(feature[len(prefix):])
+                break
+        else:
+            return feature
+    return names[feature] if 0 <= feature < len(names) else None
+
+
+def _sklearn_trees(model):
+    """
+    Collect fitted trees of a scikit-learn model, None for other models
+    """
+    if hasattr(model, 'tree_'):
+        return [model.tree_]
+    if hasattr(model, '_predictors'):
+        # histogram gradient boosting keeps a list of predictors for every iteration
+        return [predictor for predictors in model._predictors for predictor in predictors]
+    if hasattr(model, 'estimators_'):
+        estimators = np.ravel(np.asarray(model.estimators_, dtype=object))
+        trees = [_sklearn_trees(estimator) for estimator in estimators]
+        if trees and all(tree is not None for tree in trees):
+            return [tree for estimator_trees in trees for tree in estimator_trees]
+    return None
+
+
+def _sklearn_thresholds(trees):
+    features, thresholds = [], []
+    for tree in trees:
+        if hasattr(tree, 'nodes'):
+            nodes = tree.nodes[~tree.nodes['is_leaf'].astype(bool) & ~tree.nodes['is_categorical'].astype(bool)]
+            features.extend(nodes['feature_idx'])
+            thresholds.extend(nodes['num_threshold'])
+        else:
+            # leaves have negative features
+            split_nodes = tree.feature >= 0
+            features.extend(tree.feature[split_nodes])
+            thresholds.extend(tree.threshold[split_nodes])
+    return features, thresholds
+
+
+def _xgboost_thresholds(model):
+    booster = model.get_booster() if hasattr(model, 'get_booster') else model
+    trees = booster.trees_to_dataframe()
+    nodes = trees[(trees['Feature'] != 'Leaf') & trees['Split'].notnull()]
+    return list(nodes['Feature']), list(nodes['Split'])
+
+
+def _lightgbm_thresholds(model):
+    booster = model.booster_ if hasattr(model, 'booster_') else model
+    trees = booster.trees_to_dataframe()
+    # categorical splits compare with sets of categories
+    nodes = trees[trees['split_feature'].notnull() & (trees['decision_type'] != '==')]
+    return list(nodes['split_feature']), list(nodes['threshold'].astype(np.float64))
+
+
+def threshold_split(thresholds, split):
+    """
+    Calculate a split on which a profile of a tree model is exact
+
+    Profiles of tree models are piecewise constant and change only at thresholds. Every threshold within the range
+    of the split is represented by its closest neighbours from both sides. Neighbours are float32 values, as trees
+    compare variables cast to float32, or integers for integer variables. Ends of the split are kept.
+
+    :param thresholds: sorted thresholds of the variable
+    :param split: sorted numerical split calculated from the data
+    :return: array of points with the dtype of the split
+    """
+    lower, upper = split[0], split[-1]
+    thresholds = thresholds[(thresholds >= lower) & (thresholds < upper)]
+    if np.issubdtype(split.dtype, np.integer):
+        neighbours = [np.floor(thresholds), np.ceil(thresholds), np.ceil(thresholds) - 1, np.floor(thresholds) + 1]
+    else:
+        single = thresholds.astype(np.float32)
+        neighbours = [np.nextafter(single, np.float32(-np.inf)), np.nextafter(single, np.float32(np.inf))]
+    points = np.concatenate([[lower, upper]] + [np.asarray(points, dtype=np.float64) for points in neighbours])
+    points = points[(points >= lower) & (points <= upper)]
+    return np.unique(points).astype(split.dtype)
@@ -1,13 +1,40 @@
+import base64
 import json
+import logging
+import os
+import time
+import uuid
+import zlib
+from collections import namedtuple, OrderedDict
+from contextlib import contextmanager
 
 import numpy as np
 import pandas as pd
 
+ExportStats = namedtuple("ExportStats", "bytes seconds")
 
-def save_profiles(profiles, filename):
-    data = dump_profiles(profiles)
-    with open(filename, 'w') as f:
-        f.write("profile = {};".format(json.dumps(data, indent=2, default=default)))
+
+def save_profiles(profiles, filename, orient='records', indent=2, simplify=False):
+    """
+    Save profiles into a js file, profiles are written chunk by chunk without materializing them as a whole
+
+    :param orient: *records* - list of points, *columns* - list of chunks with a list of values for every column, it is more compact and much faster to write
+    :param indent: indentation of the json, if None then the output is compact
+    :param simplify: if True then points collinear with their neighbours are dropped from the profiles
+    :return: ExportStats with the number of bytes written and elapsed time in seconds
+    """
+    start = time.time()
+    if orient == 'records':
+        items = _iter_profile_records(profiles, simplify)
+    elif orient == 'columns':
+        items = _iter_profile_columns(profiles, simplify)
+    else:
+        raise ValueError("Available orients are: 'records' and 'columns'")
+    with atomic_open(filename) as f:
+        f.write("profile = ")
+        _write_json_list(f, items, indent)
+        f.write(";")
+    return _export_stats(filename, start)
 
 
 def dump_profiles(profiles):
@@ -16,11 +43,140 @@ def dump_profiles(profiles):
 
     :return: list of dicts representing points in the profiles
     """
-    data = []
+    return list(_iter_profile_records(profiles))
+
+
+def dump_profiles_columns(profiles, simplify=False):
+    """
+    Dump profiles into column oriented json format
+
+    :param simplify: if True then points collinear with their neighbours are dropped from the profiles
+    :return: list of dicts mapping columns into lists of values, one for every chunk of the profiles
+    """
+    return list(_iter_profile_columns(profiles, simplify))
+
+
+def dump_profiles_compressed(profiles, simplify=False):
+    """
+    Dump profiles into column oriented json format compressed with gzip and encoded with base64
+
+    Chunks are compressed one by one, so neither the profiles nor the json are materialized as a whole.
+
+    :param simplify: if True then points collinear with their neighbours are dropped from the profiles
+    :return: string with base64 encoded gzip of the json, the same as for `dump_profiles_columns`
+    """
+    buffer = _GzipBuffer()
+    _write_json_list(buffer, _iter_profile_columns(profiles, simplify), indent=None)
+    return base64.b64encode(buffer.getvalue()).decode('ascii')
+
+
+class _GzipBuffer:
+    """
+    File-like object compressing written text with gzip
+    """
+
+    def __init__(self, level=6):
+        self._compressor = zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+        self._parts = []
+
+    def write(self, text):
+        self._parts.append(self._compressor.compress(text.encode('utf-8')))
+
+    def getvalue(self):
+        return b''.join(self._parts + [self._compressor.flush()])
+
+
+def _columns(df):
+    """
+    Convert DataFrame into a mapping of columns into lists of values with native python types
+    """
+    return OrderedDict((column, df[column].tolist()) for column in df.columns)
+
+
+def _records(df):
+    """
+    Convert DataFrame into a list of dicts with native python types
+    """
+    columns = _columns(df)
+    return [dict(zip(columns.keys(), row)) for row in zip(*columns.values())]
+
+
+def _iter_profile_records(profiles, simplify=False):
+    """
+    Iterate over points in the profiles, chunk by chunk
+    """
     for cp_profile in profiles:
-        for i, row in cp_profile.profile.iterrows():
-            data.append(dict(zip(cp_profile.profile.columns, row)))
-    return data
+        for chunk in _iter_chunks(cp_profile, simplify):
+            for record in _records(chunk):
+                yield record
+
+
+def _iter_profile_columns(profiles, simplify=False):
+    """
+    Iterate over chunks of the profiles in the column oriented format
+    """
+    for cp_profile in profiles:
+        for chunk in _iter_chunks(cp_profile, simplify):
+            yield _columns(chunk)
+
+
+def _iter_chunks(cp_profile, simplify=False):
+    # profiles might be mocked with objects having only `iter_profile()`
+    return cp_profile.iter_profile(simplify=True) if simplify else cp_profile.iter_profile()
+
+
+def _write_json_list(f, items, indent=2):
+    """
+    Write items into a file as a json list one by one
+    The result is the same as for `json.dumps(list(items), indent=indent, default=default)`,
+    for indent None the most compact separators are used
+    """
+    if indent is None:
+        separator = "["
+        for item in items:
+            f.write(separator)
+            f.write(json.dumps(item, separators=(',', ':'), default=default))
+            separator = ","
+        f.write("[]" if separator == "[" else "]")
+        return
+    prefix = "\n" + " " * indent
+    separator = "[" + prefix
+    for item in items:
+        f.write(separator)
+        f.write(json.dumps(item, indent=indent, default=default).replace("\n", prefix))
+        separator = "," + prefix
+    f.write("[]" if separator == "[" + prefix else "\n]")
+
+
+@contextmanager
+def atomic_open(filename, mode='w', **kwargs):
+    """
+    Open a file for writing, which appears under its name only when it is completely written
+
+    The content is written into a temporary file in the same directory, which replaces the target file when
+    closed, so readers never see a partially written file. The temporary file is removed if writing fails.
+
+    :param filename: path of the target file
+    :param mode: mode of writing, 'w' or 'wb'
+    :param kwargs: other arguments of `open`
+    :return: context manager yielding the opened temporary file
+    """
+    directory, name = os.path.split(filename)
+    tmp_filename = os.path.join(directory, ".{}.{}.tmp".format(name, uuid.uuid4().hex))
+    try:
+        with open(tmp_filename, mode, **kwargs) as f:
+            yield f
+        os.replace(tmp_filename, filename)
+    except BaseException:
+        if os.path.exists(tmp_filename):
+            os.remove(tmp_filename)
+        raise
+
+
+def _export_stats(filename, start):
+    stats = ExportStats(os.path.getsize(filename), time.time() - start)
+    logging.info("Saved {} bytes into {} in {:.3f}s".format(stats.bytes, filename, stats.seconds))
+    return stats
 
 
 def default(o):
@@ -34,10 +190,19 @@ def default(o):
     return float(o)
 
 
-def save_observations(profiles, filename):
-    data = dump_observations(profiles)
-    with open(filename, 'w') as f:
-        f.write("observation = {};".format(json.dumps(data, indent=2, default=default)))
+def save_observations(profiles, filename, indent=2):
+    """
+    Save observations into a js file
+
+    :param indent: indentation of the json, if None then the output is compact
+    :return: ExportStats with the number of bytes written and elapsed time in seconds
+    """
+    start = time.time()
+    with atomic_open(filename) as f:
+        f.write("observation = ")
+        _write_json_list(f, dump_observations(profiles), indent)
+        f.write(";")
+    return _export_stats(filename, start)
 
 
 def dump_observations(profiles):
@@ -48,13 +213,13 @@ def dump_observations(profiles):
     """
     data = []
     for profile in profiles:
-        for i, yhat in enumerate(profile.new_observation_predictions):
-            d = dict(zip(profile.all_variable_names, profile.new_observation.iloc[i]))
-            d['_yhat_'] = yhat
-            d['_label_'] = profile._label
-            d['_ids_'] = i
-            d['_y_'] = profile.new_observation_true[i] if profile.new_observation_true is not None else None
-            data.append(d)
+        df = pd.DataFrame(profile.new_observation.values, columns=profile.all_variable_names)
+        df['_yhat_'] = np.asarray(profile.new_observation_predictions)
+        df['_label_'] = profile._label
+        # the same ids as in the profiles
+        df['_ids_'] = profile.new_observation.index.values
+        df['_y_'] = list(profile.new_observation_true) if profile.new_observation_true is not None else None
+        data.extend(_records(df))
     return data
 
 
@@ -7,7 +7,7 @@ from sklearn.linear_model import LinearRegression
 from ceteris_paribus.datasets import DATASETS_DIR
 from ceteris_paribus.explainer import explain
 from ceteris_paribus.plots.plots import plot
-from ceteris_paribus.profiles import individual_variable_profile
+from ceteris_paribus.profiles import individual_variable_profile, individual_variable_profiles
 from ceteris_paribus.select_data import select_sample
 
 df = pd.read_csv(os.path.join(DATASETS_DIR, 'insurance.csv'))
@@ -63,3 +63,7 @@ if __name__ == "__main__":
     plot(cp3, show_residuals=True)
 
     plot(cp_profile, cp3, show_residuals=True)
+
+    # splits and the grid are built once and shared by all models
+    profiles = individual_variable_profiles([explainer_linear, explainer_gb, explainer_svm], sample_x, y=sample_y)
+    plot(*profiles.values(), selected_variables=["bmi", "age"])
@@ -25,16 +25,17 @@ setup(name=PACKAGE_NAME,
       url='https://github.com/ModelOriented/pyCeterisParibus',
       author='Michał Kuźba',
       author_email='michal.kuzba@students.mimuw.edu.pl',
-      packages=find_packages(exclude=['examples', 'tests']),
-      package_data={'ceteris_paribus': ['plots/ceterisParibusD3.js', 'plots/plot_template.html', 'datasets/*.csv']},
+      packages=find_packages(exclude=['benchmarks', 'examples', 'tests']),
+      package_data={'ceteris_paribus': ['plots/ceterisParibusD3.js', 'plots/plot_template.html', 'plots/vendor/*',
+                                        'datasets/*.csv']},
       install_requires=get_requirements(),
+      python_requires='>=3.6.1',
       classifiers=[
           'Intended Audience :: Science/Research',
           'Intended Audience :: Developers',
           'License :: OSI Approved :: Apache Software License',
           'Operating System :: OS Independent',
           'Programming Language :: Python :: 3',
-          'Programming Language :: Python :: 3.5',
           'Programming Language :: Python :: 3.6',
           'Programming Language :: Python :: 3.7',
           'Topic :: Scientific/Engineering :: Artificial Intelligence',
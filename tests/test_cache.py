@@ -0,0 +1,183 @@
+import os
+import pickle
+import tempfile
+import unittest
+from unittest.mock import MagicMock, patch
+
+import numpy as np
+import pandas as pd
+
+from ceteris_paribus.cache import PredictionCache, cached_explainer, SplitsCache, splits_cache
+from ceteris_paribus.explainer import explain
+from ceteris_paribus.profiles import individual_variable_profile
+
+
+def product_predict(df):
+    return (df['a'] * df['b']).values
+
+
+class TestPredictionCache(unittest.TestCase):
+
+    def setUp(self):
+        self.predict_function = MagicMock(side_effect=lambda df: df.sum(axis=1).values)
+        self.df = pd.DataFrame({'a': [1., 2., 3., 1.], 'b': [4, 5, 6, 4], 'c': ['x', 'y', 'z', 'x']})[['a', 'b']]
+
+    def test_cache_1(self):
+        cache = PredictionCache(self.predict_function)
+        np.testing.assert_array_equal(cache(self.df), [5, 7, 9, 5])
+        # duplicated row is scored once
+        self.assertEqual(len(self.predict_function.call_args[0][0]), 3)
+        self.assertEqual(cache.stats(), (0, 4, 3, 3 * 16))
+
+    def test_cache_2(self):
+        cache = PredictionCache(self.predict_function)
+        cache(self.df.iloc[:2])
+        np.testing.assert_array_equal(cache(self.df), [5, 7, 9, 5])
+        self.assertEqual(self.predict_function.call_count, 2)
+        self.assertEqual(len(self.predict_function.call_args[0][0]), 1)
+        stats = cache.stats()
+        self.assertEqual((stats.hits, stats.misses, stats.entries), (3, 3, 3))
+
+    def test_cache_3(self):
+        # all rows cached
+        cache = PredictionCache(self.predict_function)
+        cache(self.df)
+        np.testing.assert_array_equal(cache(self.df.iloc[::-1]), [5, 9, 7, 5])
+        self.assertEqual(self.predict_function.call_count, 1)
+
+    def test_cache_limits(self):
+        cache = PredictionCache(self.predict_function, max_entries=2)
+        cache(self.df)
+        self.assertEqual(cache.stats().entries, 2)
+        cache = PredictionCache(self.predict_function, max_bytes=40)
+        cache(self.df)
+        self.assertEqual(cache.stats().entries, 2)
+        self.assertLessEqual(cache.stats().bytes, 40)
+
+    def test_cache_lru(self):
+        cache = PredictionCache(self.predict_function, max_entries=2)
+        cache(self.df.iloc[[0]])
+        cache(self.df.iloc[[1]])
+        # first row is used recently, the second one is evicted
+        cache(self.df.iloc[[0]])
+        cache(self.df.iloc[[2]])
+        self.predict_function.reset_mock()
+        cache(self.df.iloc[[0, 2]])
+        self.assertEqual(self.predict_function.call_count, 0)
+        cache(self.df.iloc[[1]])
+        self.assertEqual(self.predict_function.call_count, 1)
+
+    def test_cache_array(self):
+        cache = PredictionCache(lambda X: X.sum(axis=1))
+        X = np.array([[1, 2], [3, 4], [1, 2]])
+        np.testing.assert_array_equal(cache(X), [3, 7, 3])
+        self.assertEqual(cache.stats().entries, 2)
+
+    def test_clear(self):
+        cache = PredictionCache(self.predict_function)
+        cache(self.df)
+        cache.clear()
+        self.assertEqual(cache.stats(), (0, 0, 0, 0))
+
+    def test_cached_explainer(self):
+        np.random.seed(42)
+        data = pd.DataFrame({'a': np.random.random(50), 'b': np.random.randint(0, 3, 50)})
+        model = MagicMock(predict=MagicMock(side_effect=lambda df: (df['a'] * df['b']).values))
+        explainer = cached_explainer(explain(model, data=data, label='model'))
+        cp = individual_variable_profile(explainer, data.iloc[:5], variables=['b'])
+        stats = explainer.predict_fun.stats()
+        # predictions for observations are already calculated in the grid
+        self.assertEqual((stats.hits, stats.misses), (5, 5 * 3))
+        # the same profile is calculated again without calls to the model
+        model.predict.reset_mock()
+        cp2 = individual_variable_profile(explainer, data.iloc[:5], variables=['b'])
+        self.assertEqual(model.predict.call_count, 0)
+        pd.testing.assert_frame_equal(cp.profile, cp2.profile)
+
+    def test_cache_sparse(self):
+        from scipy import sparse
+        X = sparse.csr_matrix(np.array([[1., 0., 2.], [0., 0., 0.], [1., 0., 2.], [0., 3., 0.]]))
+        cache = PredictionCache(lambda X: np.asarray(X.sum(axis=1)).ravel())
+        np.testing.assert_array_equal(cache(X), [3., 0., 3., 3.])
+        self.assertEqual(cache.stats().entries, 3)
+        # the same rows stored in another order with explicit zeros
+        Y = sparse.csr_matrix((np.array([2., 0., 1.]), np.array([2, 1, 0]), np.array([0, 3])), shape=(1, 3))
+        np.testing.assert_array_equal(cache(Y), [3.])
+        self.assertEqual(cache.stats().hits, 1)
+
+    def test_cached_explainer_sparse(self):
+        from scipy import sparse
+        np.random.seed(42)
+        X = sparse.random(50, 3, density=0.5, format='csr', random_state=42)
+        model = MagicMock(predict=MagicMock(side_effect=lambda X: np.asarray(X.sum(axis=1)).ravel()))
+        explainer = cached_explainer(explain(model, variable_names=['a', 'b', 'c'], data=X, label='model'))
+        cp = individual_variable_profile(explainer, X[:3], grid_points=5)
+        np.testing.assert_allclose(cp.profile['_yhat_'], cp.profile[['a', 'b', 'c']].sum(axis=1))
+        model.predict.reset_mock()
+        individual_variable_profile(explainer, X[:3], grid_points=5)
+        self.assertEqual(model.predict.call_count, 0)
+
+    def test_pickle(self):
+        cache = PredictionCache(product_predict, max_entries=10)
+        cache(pd.DataFrame({'a': [1., 2.], 'b': [3, 4]}))
+        copied = pickle.loads(pickle.dumps(cache))
+        self.assertEqual(copied.stats(), (0, 0, 0, 0))
+        self.assertEqual(copied._max_entries, 10)
+        np.testing.assert_array_equal(copied(pd.DataFrame({'a': [1.], 'b': [3]})), [3.])
+        self.assertEqual(cache.stats().entries, 2)
+
+    def test_cached_explainer_process_pool(self):
+        np.random.seed(42)
+        data = pd.DataFrame({'a': np.random.random(50), 'b': np.random.randint(0, 3, 50)})
+        explainer = cached_explainer(explain(MagicMock(), data=data, predict_function=product_predict, label='model'))
+        cp = individual_variable_profile(explainer, data.iloc[:5], grid_points=5, n_jobs=2, executor='process')
+        np.testing.assert_array_equal(cp.profile['_yhat_'], product_predict(cp.profile))
+
+
+class TestSplitsCache(unittest.TestCase):
+
+    def setUp(self):
+        np.random.seed(42)
+        self.data = pd.DataFrame({'a': np.random.random(100), 'b': np.random.randint(0, 3, 100)})
+        self.model = MagicMock(predict=MagicMock(side_effect=lambda df: (df['a'] * df['b']).values))
+        self.explainer = explain(self.model, data=self.data, label='model')
+
+    def test_splits_cache(self):
+        cache = SplitsCache()
+        self.assertEqual(cache.get(self.data, ['a', 'b'], (5,)), {})
+        cache.update(self.data, {'a': [1, 2]}, (5,))
+        self.assertEqual(cache.get(self.data, ['a', 'b'], (5,)), {'a': [1, 2]})
+        self.assertEqual(cache.get(self.data, ['a', 'b'], (7,)), {})
+        cache.invalidate()
+        self.assertEqual(len(cache), 0)
+
+    def test_splits_cache_data_changed(self):
+        cache = SplitsCache()
+        data = self.data.copy()
+        cache.update(data, {'a': [1, 2]}, (5,))
+        data.loc[0, 'a'] = 2.
+        self.assertEqual(cache.get(data, ['a'], (5,)), {})
+
+    def test_profiles_reuse_splits(self):
+        cp = individual_variable_profile(self.explainer, self.data.iloc[:2], grid_points=5)
+        self.assertEqual(len(splits_cache(self.explainer)), 2)
+        with patch('numpy.quantile') as quantile:
+            cp2 = individual_variable_profile(self.explainer, self.data.iloc[2:4], grid_points=5)
+            self.assertEqual(quantile.call_count, 0)
+        np.testing.assert_array_equal(cp._variable_splits['a'], cp2._variable_splits['a'])
+        # other number of grid points
+        cp3 = individual_variable_profile(self.explainer, self.data.iloc[:2], grid_points=3)
+        self.assertEqual(len(cp3._variable_splits['a']), 3)
+
+    def test_save_load(self):
+        individual_variable_profile(self.explainer, self.data.iloc[:2], grid_points=5)
+        filename = os.path.join(tempfile.mkdtemp(), 'splits.pkl')
+        splits_cache(self.explainer).save(filename)
+        explainer = explain(self.model, data=self.data.copy(), label='model')
+        cache = splits_cache(explainer, SplitsCache.load(filename))
+        self.assertIs(splits_cache(explainer), cache)
+        self.assertEqual(set(cache.get(explainer.data, ['a', 'b'], (5, 'exact', None))), {'a', 'b'})
+
+    def test_splits_cache_no_data(self):
+        with self.assertRaises(ValueError):
+            splits_cache(explain(self.model, variable_names=['a', 'b'], label='model'))
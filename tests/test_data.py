@@ -0,0 +1,148 @@
+import os
+import tempfile
+import unittest
+from unittest.mock import MagicMock
+
+import numpy as np
+import pandas as pd
+
+from ceteris_paribus.cache import splits_cache
+from ceteris_paribus.data import ChunkedData, as_chunked_data
+from ceteris_paribus.explainer import explain
+from ceteris_paribus.profiles import individual_variable_profile
+from ceteris_paribus.select_data import select_neighbours, select_sample, NeighbourIndex, select_neighbours_batch
+
+try:
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
+
+class TestChunkedArray(unittest.TestCase):
+
+    def setUp(self):
+        np.random.seed(42)
+        self.X = np.random.random((1000, 3))
+        self.filename = os.path.join(tempfile.mkdtemp(), 'data.npy')
+        memmap = np.lib.format.open_memmap(self.filename, mode='w+', dtype=np.float64, shape=self.X.shape)
+        memmap[:] = self.X
+        memmap.flush()
+        self.memmap = np.load(self.filename, mmap_mode='r')
+        self.data = ChunkedData(self.memmap, ['a', 'b', 'c'], chunk_size=300)
+
+    def test_shape(self):
+        self.assertEqual(self.data.shape, (1000, 3))
+        self.assertEqual(len(self.data), 1000)
+
+    def test_iter_chunks(self):
+        chunks = list(self.data.iter_chunks(['c', 'a']))
+        self.assertEqual([len(chunk) for chunk in chunks], [300, 300, 300, 100])
+        self.assertEqual(list(chunks[1].columns), ['c', 'a'])
+        self.assertEqual(chunks[1].index[0], 300)
+        np.testing.assert_array_equal(pd.concat(chunks)['a'], self.X[:, 0])
+
+    def test_take(self):
+        rows = self.data.take([500, 3, 500])
+        np.testing.assert_array_equal(rows.values, self.X[[500, 3, 500]])
+        np.testing.assert_array_equal(self.data['b'], self.X[:, 1])
+
+    def test_incorrect(self):
+        with self.assertRaises(ValueError):
+            ChunkedData(self.memmap, ['a', 'b'])
+        with self.assertRaises(ValueError):
+            ChunkedData([1, 2, 3])
+
+    def test_as_chunked_data(self):
+        self.assertIsNone(as_chunked_data(self.X))
+        self.assertIs(as_chunked_data(self.data), self.data)
+        self.assertEqual(as_chunked_data(self.memmap).kind, 'array')
+
+    def test_select_neighbours(self):
+        df = pd.DataFrame(self.X, columns=['a', 'b', 'c'])
+        y = np.arange(1000)
+        expected, expected_y = select_neighbours(df, self.X[10], y=y, n=15)
+        selected, selected_y = select_neighbours(self.data, self.X[10], y=y, n=15)
+        np.testing.assert_array_equal(selected.values, expected.values)
+        np.testing.assert_array_equal(selected_y, expected_y)
+        selected = select_neighbours(self.data, self.X[10], variable_names=['a', 'b', 'c'], selected_variables=['a'],
+                                     n=5)
+        np.testing.assert_array_equal(selected.values, select_neighbours(df, self.X[10], selected_variables=['a'],
+                                                                         n=5).values)
+        # names given as an index
+        selected = select_neighbours(self.data, self.X[10], variable_names=df.columns, selected_variables=['a'], n=5)
+        np.testing.assert_array_equal(selected.values, select_neighbours(df, self.X[10], selected_variables=['a'],
+                                                                         n=5).values)
+
+    def test_select_neighbours_batch(self):
+        df = pd.DataFrame(self.X, columns=['a', 'b', 'c'])
+        np.testing.assert_array_equal(select_neighbours_batch(self.data, self.X[:20], n=6),
+                                      select_neighbours_batch(df, self.X[:20], n=6))
+        neighbours = select_neighbours_batch(self.data, self.X[:20], variable_names=np.array(df.columns),
+                                             selected_variables=['a', 'b'], n=6)
+        np.testing.assert_array_equal(neighbours,
+                                      select_neighbours_batch(df, self.X[:20], selected_variables=['a', 'b'], n=6))
+
+    def test_select_sample(self):
+        df = pd.DataFrame(self.X, columns=['a', 'b', 'c'])
+        np.testing.assert_array_equal(select_sample(self.data, n=10).values, select_sample(df, n=10).values)
+
+    def test_neighbour_index(self):
+        with self.assertRaises(ValueError):
+            NeighbourIndex(self.data)
+
+    def test_explain_memmap(self):
+        model = MagicMock(predict=MagicMock(side_effect=lambda X: X.sum(axis=1)))
+        explainer = explain(model, ['a', 'b', 'c'], data=self.memmap, label='model')
+        self.assertIsInstance(explainer.data, ChunkedData)
+        cp = individual_variable_profile(explainer, self.X[:2], grid_points=5)
+        self.assertEqual(cp._split_method, 'sketch')
+        self.assertEqual(len(cp.profile), 2 * 3 * 5)
+        np.testing.assert_allclose(cp._variable_splits['a'], np.quantile(self.X[:, 0], np.linspace(0, 1, 5)),
+                                   atol=0.05)
+        # exact splits read a single column at once
+        cp = individual_variable_profile(explainer, self.X[:2], grid_points=5, split_method='exact')
+        np.testing.assert_array_equal(cp._variable_splits['a'], np.quantile(self.X[:, 0], np.linspace(0, 1, 5)))
+        self.assertEqual(len(splits_cache(explainer)), 6)
+
+
+@unittest.skipIf(pyarrow is None, "pyarrow not installed")
+class TestChunkedArrow(unittest.TestCase):
+
+    def setUp(self):
+        np.random.seed(42)
+        self.df = pd.DataFrame({'a': np.random.random(500), 'b': np.random.choice(['x', 'y', 'z'], 500),
+                                'c': np.random.randint(0, 10, 500)})
+        self.table = pyarrow.Table.from_pandas(self.df, preserve_index=False)
+        self.filename = os.path.join(tempfile.mkdtemp(), 'data.parquet')
+        pyarrow.parquet.write_table(self.table, self.filename, row_group_size=128)
+
+    def test_arrow(self):
+        data = ChunkedData(self.table, chunk_size=200)
+        self.assertEqual(data.shape, (500, 3))
+        pd.testing.assert_frame_equal(pd.concat(data.iter_chunks()), self.df)
+        pd.testing.assert_frame_equal(data.take([7, 2]), self.df.iloc[[7, 2]])
+
+    def test_parquet(self):
+        data = ChunkedData(self.filename, columns=['c', 'a'], chunk_size=100)
+        self.assertEqual(data.columns, ['c', 'a'])
+        pd.testing.assert_frame_equal(pd.concat(data.iter_chunks()), self.df[['c', 'a']])
+        pd.testing.assert_frame_equal(data.take([450, 2, 450]), self.df[['c', 'a']].iloc[[450, 2, 450]])
+
+    def test_select_neighbours(self):
+        expected = select_neighbours(self.df, self.df.iloc[3], n=10)
+        selected = select_neighbours(ChunkedData(self.filename, chunk_size=100), self.df.iloc[3], n=10)
+        pd.testing.assert_frame_equal(selected, expected)
+
+    def test_select_neighbours_batch(self):
+        neighbours = select_neighbours_batch(ChunkedData(self.filename, chunk_size=100), self.df.iloc[:5], n=10)
+        np.testing.assert_array_equal(neighbours, select_neighbours_batch(self.df, self.df.iloc[:5], n=10))
+
+    def test_explain_parquet(self):
+        model = MagicMock(predict=MagicMock(side_effect=lambda df: (df['a'] * df['c']).values))
+        explainer = explain(model, data=self.filename, label='model')
+        self.assertEqual(explainer.var_names, ['a', 'b', 'c'])
+        cp = individual_variable_profile(explainer, self.df.iloc[:2])
+        np.testing.assert_array_equal(cp._variable_splits['b'], ['x', 'y', 'z'])
+        np.testing.assert_array_equal(cp._variable_splits['c'], np.arange(10))
+        self.assertIsInstance(model.predict.call_args[0][0], pd.DataFrame)
@@ -6,6 +6,7 @@ import pandas as pd
 from sklearn import datasets, ensemble
 
 from ceteris_paribus.explainer import explain
+from ceteris_paribus.profiles import individual_variable_profile
 
 
 class TestExplain(unittest.TestCase):
@@ -110,3 +111,21 @@ class TestExplain(unittest.TestCase):
         boston_df = pd.DataFrame(self.X[:10])
         explainer = explain(self.rf_model, data=boston_df)
         self.assertEqual(len(explainer.predict_fun(boston_df)), 10)
+
+    def test_explainer_process_pool(self):
+        # the predict function for array data can be pickled
+        explainer = explain(self.rf_model, variable_names=self.var_names, data=self.X, label='rf')
+        expected = individual_variable_profile(explainer, self.X[:2], variables=['CRIM', 'AGE'], grid_points=5)
+        cp = individual_variable_profile(explainer, self.X[:2], variables=['CRIM', 'AGE'], grid_points=5, n_jobs=2,
+                                         executor='process')
+        pd.testing.assert_frame_equal(cp.profile, expected.profile)
+
+    def test_explainer_18(self):
+        # sparse data is kept sparse and the model takes sparse matrices
+        from scipy import sparse
+        X = sparse.csr_matrix(self.X[:10])
+        explainer = explain(self.rf_model, variable_names=self.var_names, data=X)
+        self.assertTrue(all(isinstance(dtype, pd.SparseDtype) for dtype in explainer.data.dtypes))
+        self.assertEqual(len(explainer.predict_fun(X)), 10)
+        with self.assertRaises(ValueError):
+            explain(self.rf_model, variable_names=["a", "b"], data=X)
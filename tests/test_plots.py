@@ -1,7 +1,44 @@
+import base64
+import gzip
+import io
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
 import unittest
-from unittest.mock import MagicMock
+from unittest.mock import MagicMock, patch
 
-from ceteris_paribus.plots.plots import _calculate_plot_variables, _params_update, _get_data_paths
+import numpy as np
+import pandas as pd
+
+from ceteris_paribus.plots import plots
+from ceteris_paribus.plots.plots import _calculate_plot_variables, _params_update, _get_data_paths, \
+    _bundle_scripts, _file_scripts, _escape, _representative_positions, _downsampled_profiles, _render_template, \
+    _evict_plots, EvictionPolicy
+from ceteris_paribus.profiles import individual_variable_profile
+from ceteris_paribus.utils import dump_profiles_columns, dump_profiles_compressed
+
+
+def output_directory_patch(test):
+    """
+    Write plots of the test into a temporary directory
+    """
+    previous = plots._DATA_PATH
+    plots.set_output_directory(tempfile.mkdtemp())
+    test.addCleanup(plots.set_output_directory, previous)
+
+
+def vendor_patch():
+    """
+    Patch the vendor directory with a temporary one holding placeholders of the libraries
+    """
+    vendor = tempfile.mkdtemp()
+    for filename, _, _ in plots._LIBRARIES:
+        with open(os.path.join(vendor, filename), 'w') as f:
+            f.write("/* {} */".format(filename))
+    return patch.object(plots, '_VENDOR_PATH', vendor)
 
 
 class TestPlots(unittest.TestCase):
@@ -28,3 +65,239 @@ class TestPlots(unittest.TestCase):
         self.assertTrue(params_path.endswith('.js'))
         self.assertTrue(obs_path.endswith('.js'))
         self.assertTrue(profile_path.endswith('.js'))
+
+    def test_import(self):
+        # importing plots neither loads heavy dependencies nor writes files
+        cwd = tempfile.mkdtemp()
+        code = "import sys; import ceteris_paribus.plots.plots; print('flask' in sys.modules)"
+        env = dict(os.environ, PYTHONPATH=os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+        output = subprocess.check_output([sys.executable, "-c", code], cwd=cwd, env=env)
+        self.assertEqual(output.decode().strip(), "False")
+        self.assertEqual(os.listdir(cwd), [])
+
+    def test_render_template(self):
+        content = _render_template("plot_template.html", libraries="<b>", datasets="a & b", engine="")
+        self.assertIn("<b>", content)
+        self.assertNotIn("{{", content)
+        templates = tempfile.mkdtemp()
+        with open(os.path.join(templates, "template.html"), 'w') as f:
+            f.write("<p>{{ title }}</p>{{script|safe}}{{missing}}")
+        with patch.object(plots, "PLOTS_DIR", templates):
+            content = _render_template("template.html", title="a & b", script="<script></script>")
+        self.assertEqual(content, "<p>a &amp; b</p><script></script>")
+
+    def test_output_directory(self):
+        path = os.path.join(tempfile.mkdtemp(), "plots")
+        previous = plots._DATA_PATH
+        try:
+            plots.set_output_directory(path)
+            self.assertFalse(os.path.exists(path))
+            profile = MagicMock(iter_profile=MagicMock(return_value=iter([])), selected_variables=["a"],
+                                new_observation_true=None, new_observation=pd.DataFrame({"a": [1.]}),
+                                new_observation_predictions=[1.], all_variable_names=["a"], _label="xyz")
+            with patch('webbrowser.open') as open_mock:
+                plots.plot(profile)
+            self.assertEqual(os.path.dirname(open_mock.call_args[0][0].replace("file://", "")),
+                             os.path.abspath(path) if sys.platform == "darwin" else path)
+            self.assertIn(plots._D3_engine_filename, os.listdir(path))
+        finally:
+            plots.set_output_directory(previous)
+
+
+class TestOutputDirectory(unittest.TestCase):
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        with open(os.path.join(self.path, plots._D3_engine_filename), 'w') as f:
+            f.write("engine")
+        now = time.time()
+        self.ids = [plots._new_plot_id() for _ in range(3)]
+        for age, plot_id in zip([300, 200, 100], self.ids):
+            for name in ['plots{}.html', 'profile{}.js']:
+                filename = os.path.join(self.path, name.format(plot_id))
+                with open(filename, 'w') as f:
+                    f.write("x" * 10)
+                os.utime(filename, (now - age, now - age))
+
+    def remaining(self):
+        return [plot_id for plot_id in self.ids
+                if os.path.exists(os.path.join(self.path, 'plots{}.html'.format(plot_id)))]
+
+    def test_plot_ids(self):
+        ids = set(plots._new_plot_id() for _ in range(1000))
+        self.assertEqual(len(ids), 1000)
+
+    def test_no_policy(self):
+        self.assertEqual(_evict_plots(self.path, EvictionPolicy(None, None, None)), [])
+        self.assertEqual(self.remaining(), self.ids)
+
+    def test_max_files(self):
+        self.assertEqual(_evict_plots(self.path, EvictionPolicy(5, None, None)), [self.ids[0]])
+        self.assertEqual(self.remaining(), self.ids[1:])
+        # the engine is never removed
+        self.assertIn(plots._D3_engine_filename, os.listdir(self.path))
+
+    def test_max_bytes(self):
+        self.assertEqual(_evict_plots(self.path, EvictionPolicy(None, 25, None)), [self.ids[1], self.ids[0]])
+        self.assertEqual(self.remaining(), self.ids[2:])
+
+    def test_max_age(self):
+        _evict_plots(self.path, EvictionPolicy(None, None, 150))
+        self.assertEqual(self.remaining(), self.ids[2:])
+        # kept plots are not removed even if too old
+        _evict_plots(self.path, EvictionPolicy(0, None, None), keep=(self.ids[2],))
+        self.assertEqual(self.remaining(), self.ids[2:])
+
+    def test_plot_eviction(self):
+        previous = plots._DATA_PATH, plots._EVICTION_POLICY
+        try:
+            plots.set_output_directory(self.path)
+            plots.set_eviction_policy(max_files=4)
+            profile = MagicMock(iter_profile=MagicMock(return_value=iter([])), selected_variables=["a"],
+                                new_observation_true=None, new_observation=pd.DataFrame({"a": [1.]}),
+                                new_observation_predictions=[1.], all_variable_names=["a"], _label="xyz")
+            with patch('webbrowser.open'):
+                plots.plot(profile)
+            # the new plot consists of 4 files
+            self.assertEqual(self.remaining(), [])
+            self.assertEqual(len([name for name in os.listdir(self.path) if name.endswith('.tmp')]), 0)
+            self.assertEqual(len(os.listdir(self.path)), 5)
+        finally:
+            plots.set_output_directory(previous[0])
+            plots._EVICTION_POLICY = previous[1]
+
+    def test_incorrect_policy(self):
+        with self.assertRaises(ValueError):
+            plots.set_eviction_policy(max_bytes=-1)
+
+
+class TestBundle(unittest.TestCase):
+
+    def setUp(self):
+        np.random.seed(42)
+        data = pd.DataFrame({"a": np.random.random(50), "b": np.random.choice(["x</script>", "y"], 50)})
+        explainer = MagicMock(data=data, var_names=["a", "b"], label="xyz",
+                              predict_fun=lambda df: df["a"].values * (df["b"] == "y"))
+        self.cp = individual_variable_profile(explainer, data.iloc[:5], y=np.arange(5), grid_points=11)
+        output_directory_patch(self)
+        vendor = vendor_patch()
+        vendor.start()
+        self.addCleanup(vendor.stop)
+
+    def test_dump_profiles_compressed(self):
+        content = gzip.decompress(base64.b64decode(dump_profiles_compressed([self.cp])))
+        self.assertEqual(json.loads(content.decode('utf-8')),
+                         json.loads(json.dumps(dump_profiles_columns([self.cp]))))
+
+    def test_escape(self):
+        self.assertEqual(_escape('a = "</script>";'), 'a = "<\\/script>";')
+
+    def test_file_scripts(self):
+        scripts = _file_scripts("7")
+        self.assertIn('src="profile7.js"', scripts['datasets'])
+        self.assertIn('https://d3js.org/d3.v5.min.js', scripts['libraries'])
+
+    def test_bundle_scripts(self):
+        scripts = _bundle_scripts([self.cp], {"variables": ["a", "b"]})
+        self.assertIn('profileGzip = "', scripts['datasets'])
+        self.assertNotIn('</script>', scripts['datasets'][:-len('</script>')])
+        self.assertIn('ceterisParibusD3', scripts['engine'])
+        scripts = _bundle_scripts([self.cp], {"variables": ["a", "b"]}, compress=False)
+        self.assertIn('profile = [{', scripts['datasets'])
+
+    def test_bundle_vendor(self):
+        scripts = _bundle_scripts([self.cp], {})
+        self.assertNotIn('https://', scripts['libraries'])
+        self.assertIn('<style>\n/* jquery.dataTables.css */', scripts['libraries'])
+        os.remove(os.path.join(plots._VENDOR_PATH, 'd3.v5.min.js'))
+        with self.assertRaises(ValueError):
+            _bundle_scripts([self.cp], {})
+
+    def test_vendor_directory(self):
+        path = os.path.join(tempfile.mkdtemp(), 'vendor')
+        previous = plots._VENDOR_PATH
+        try:
+            plots.set_vendor_directory(path)
+            with self.assertRaises(ValueError):
+                _bundle_scripts([self.cp], {})
+            with patch('urllib.request.urlopen', side_effect=lambda url, timeout: io.BytesIO(b"/* library */")):
+                self.assertEqual(len(plots.fetch_vendor_libraries()), len(plots._LIBRARIES))
+            self.assertEqual(sorted(os.listdir(path)), sorted(filename for filename, _, _ in plots._LIBRARIES))
+            self.assertIn('/* library */', _bundle_scripts([self.cp], {})['libraries'])
+        finally:
+            plots.set_vendor_directory(previous)
+
+    def test_fetch_vendor_libraries(self):
+        os.remove(os.path.join(plots._VENDOR_PATH, 'd3.v5.min.js'))
+        with patch('urllib.request.urlopen', side_effect=lambda url, timeout: io.BytesIO(url.encode())):
+            downloaded = plots.fetch_vendor_libraries()
+        self.assertEqual(downloaded, [os.path.join(plots._VENDOR_PATH, 'd3.v5.min.js')])
+        with open(downloaded[0]) as f:
+            self.assertEqual(f.read(), 'https://d3js.org/d3.v5.min.js')
+
+    def test_plot_bundle(self):
+        with patch('webbrowser.open') as open_mock:
+            plots.plot(self.cp, bundle=True)
+        plot_path = open_mock.call_args[0][0].replace("file://", "")
+        plot_id = os.path.basename(plot_path)[len("plots"):-len(".html")]
+        with open(plot_path) as f:
+            content = f.read()
+        self.assertIn('profileGzip', content)
+        self.assertEqual(content.count('<script'), content.count('</script>'))
+        # data is not written into separate files
+        self.assertFalse(os.path.exists(_get_data_paths(plot_id)[3]))
+
+
+class TestDownsampling(unittest.TestCase):
+
+    def setUp(self):
+        np.random.seed(42)
+        data = pd.DataFrame({"a": np.random.random(200), "b": np.random.random(200)})
+        self.explainer = MagicMock(data=data, var_names=["a", "b"], label="xyz",
+                                   predict_fun=lambda df: (df["a"] > 0.5) + df["b"].values)
+        self.cp = individual_variable_profile(self.explainer, data.iloc[:100], grid_points=21)
+        output_directory_patch(self)
+        vendor = vendor_patch()
+        vendor.start()
+        self.addCleanup(vendor.stop)
+
+    def test_representative_positions(self):
+        predictions = np.array([5., 1., 3., 2., 4.])
+        np.testing.assert_array_equal(_representative_positions(predictions, 3), [0, 1, 2])
+        np.testing.assert_array_equal(_representative_positions(predictions, 10), np.arange(5))
+
+    def test_downsampled_profiles(self):
+        profiles = _downsampled_profiles([self.cp, self.cp], 10)
+        self.assertEqual(len(profiles[0].new_observation), 10)
+        self.assertTrue(profiles[0].new_observation.index.equals(profiles[1].new_observation.index))
+        predictions = profiles[0].new_observation_predictions
+        self.assertEqual(min(predictions), min(self.cp.new_observation_predictions))
+        self.assertEqual(max(predictions), max(self.cp.new_observation_predictions))
+        with self.assertRaises(ValueError):
+            _downsampled_profiles([self.cp], 0)
+
+    def test_plot_max_profiles(self):
+        with patch('webbrowser.open') as open_mock:
+            plots.plot(self.cp, max_profiles=10, aggregate_profiles='mean', bundle=True, compress=False)
+        with open(open_mock.call_args[0][0].replace("file://", "")) as f:
+            content = f.read()
+        data = json.loads(content.split('profile = ', 1)[1].split(';\n', 1)[0])
+        self.assertEqual(len(set(id for chunk in data for id in chunk['_ids_'])), 10)
+        # profiles of the variable `b` are linear
+        self.assertLess(sum(len(chunk['_ids_']) for chunk in data), 10 * 2 * 21)
+        params = json.loads(content.split('params = ', 1)[1].split(';\n', 1)[0])
+        aggregated = self.cp.aggregate_profiles('mean')
+        np.testing.assert_allclose(params['aggregated_profiles'][0]['_yhat_'],
+                                   aggregated[aggregated['_vname_'] == 'a']['_yhat_'])
+
+    def test_plot_max_profiles_splits(self):
+        splits = {"a": [0, 0.4, 0.6, 1], "b": [0, 0.5, 1]}
+        cp = individual_variable_profile(self.explainer, self.cp.new_observation, variable_splits=splits)
+        with patch('webbrowser.open') as open_mock:
+            plots.plot(cp, max_profiles=5, bundle=True, compress=False)
+        with open(open_mock.call_args[0][0].replace("file://", "")) as f:
+            content = f.read()
+        data = json.loads(content.split('profile = ', 1)[1].split(';\n', 1)[0])
+        self.assertEqual(len(set(id for chunk in data for id in chunk['_ids_'])), 5)
+        # the middle point of the linear profiles of `b` is dropped
+        self.assertEqual(sum(len(chunk['_ids_']) for chunk in data), 5 * (4 + 2))
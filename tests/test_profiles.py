@@ -1,20 +1,44 @@
+import asyncio
+import io
+import json
 import os
+import tempfile
 import unittest
+import warnings
 from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from unittest.mock import MagicMock
 
 import numpy as np
 import pandas as pd
 
-from ceteris_paribus.profiles import _get_variables, CeterisParibus, _valid_variable_splits
+from ceteris_paribus.explainer import explain
+from ceteris_paribus.profiles import _get_variables, CeterisParibus, _valid_variable_splits, _predict_in_batches, \
+    _predict_in_parallel, _is_parallel, individual_variable_profile, individual_variable_profile_async, \
+    _interval_scores, _coarse_split, _stacked_grid, _sparse_grid, individual_variable_profiles, _simplified_mask, \
+    _is_coroutine_function
 from ceteris_paribus.utils import dump_profiles, dump_observations, transform_into_Series, save_profiles, \
-    save_observations
+    save_observations, _write_json_list, dump_profiles_columns, atomic_open
+
+
+def sum_predict(df):
+    return df.sum(axis=1).values
 
 
 class TestProfiles(unittest.TestCase):
 
     def setUp(self):
         self.cp = object.__new__(CeterisParibus)
+        self.cp._batch_size = None
+        self.cp._n_jobs = None
+        self.cp._executor = 'thread'
+        self.cp._split_method = 'exact'
+        self.cp._max_categories = None
+        self.cp._thresholds = None
+        self.cp._sparse = False
+
+    def calculate_profile(self, variable_splits):
+        return self.cp._profile_from_predictions(variable_splits, self.cp._calculate_predictions(variable_splits))
 
     def test_get_variables(self):
         explainer = MagicMock(var_names=["c", "a", "b"])
@@ -73,24 +97,23 @@ class TestProfiles(unittest.TestCase):
         self.assertEqual(len(splits_dict['b']), self.cp._grid_points)
         np.testing.assert_array_equal(splits_dict['a'], [1, 2])
 
-    def test_single_observation_df(self):
-        self.cp._label = "xyz"
+    def test_variable_grid(self):
         self.cp.all_variable_names = ["a", "b", "c"]
-        self.cp._predict_function = lambda df: df.sum(axis=1)
+        self.cp.new_observation = pd.DataFrame(np.array([[1, 2, 10], [4, 5, 6]]))
         splits = np.array([1, 3, 15])
-        observation_df = self.cp._single_observation_df(np.array([1, 2, 10]), "a", splits, profile_id=42)
-        self.assertEqual(set(observation_df.columns), {"a", "b", "c", "_yhat_", "_vname_", "_label_", "_ids_"})
-        np.testing.assert_array_equal(observation_df["_yhat_"], [13, 15, 27])
-        np.testing.assert_array_equal(observation_df["a"], splits)
-        np.testing.assert_array_equal(observation_df["b"], [2] * 3)
+        grid = self.cp._variable_grid("a", splits)
+        self.assertEqual(list(grid.columns), ["a", "b", "c"])
+        np.testing.assert_array_equal(grid["a"], [1, 3, 15, 1, 3, 15])
+        np.testing.assert_array_equal(grid["b"], [2, 2, 2, 5, 5, 5])
+        np.testing.assert_array_equal(self.cp._grid_ids(splits), [0, 0, 0, 1, 1, 1])
 
-    def test_single_variable_df(self):
+    def test_variable_profile(self):
         self.cp._label = "xyz"
         self.cp.all_variable_names = ["a", "b", "c"]
         self.cp._predict_function = lambda df: df.sum(axis=1)
         splits = np.array([1, 3, 15])
         self.cp.new_observation = pd.DataFrame(np.array([[1, 2, 10]]))
-        variable_df = self.cp._single_variable_df("a", splits)
+        variable_df = self.calculate_profile({"a": splits})
         self.assertEqual(set(variable_df.columns), {"a", "b", "c", "_yhat_", "_vname_", "_label_", "_ids_"})
         np.testing.assert_array_equal(variable_df["_yhat_"], [13, 15, 27])
         np.testing.assert_array_equal(variable_df["a"], splits)
@@ -111,7 +134,13 @@ class TestProfiles(unittest.TestCase):
     def test_get_variable_splits_1(self):
         self.cp.selected_variables = ["a", "c"]
         var_splits = {"a": [1, 2], "c": [3]}
-        self.assertEqual(var_splits, self.cp._get_variable_splits(var_splits))
+        splits = self.cp._get_variable_splits(var_splits)
+        self.assertEqual(list(splits.keys()), ["a", "c"])
+        # lists are converted into arrays
+        np.testing.assert_array_equal(splits["a"], np.array([1, 2]))
+        np.testing.assert_array_equal(splits["c"], np.array([3]))
+        var_splits = {"a": np.array([1, 2]), "c": np.array([3])}
+        self.assertIs(self.cp._get_variable_splits(var_splits), var_splits)
 
     def test_get_variable_splits_2(self):
         self.cp.selected_variables = ["b", "c"]
@@ -126,9 +155,539 @@ class TestProfiles(unittest.TestCase):
         self.assertEqual(len(var_splits["c"]), 4)
 
     def test_calculate_profile(self):
-        self.cp._single_variable_df = lambda var_name, var_split: pd.DataFrame({"c": [5], "d": [7]})
-        var_splits = {"a": [2, 5, 2], "b": [3, 6]}
-        self.assertEqual(self.cp._calculate_profile(var_splits).shape, (2, 2))
+        self.cp._label = "xyz"
+        self.cp.all_variable_names = ["a", "b"]
+        self.cp.new_observation = pd.DataFrame(np.array([[1, 2], [3, 4]]), index=[7, 9])
+        self.cp._predict_function = MagicMock(side_effect=lambda df: df.sum(axis=1))
+        var_splits = OrderedDict([("a", [2, 5, 2]), ("b", [3, 6])])
+        profile = self.calculate_profile(var_splits)
+        self.assertEqual(profile.shape, (10, 6))
+        # the whole grid is scored in a single call
+        self.assertEqual(self.cp._predict_function.call_count, 1)
+        np.testing.assert_array_equal(profile["_vname_"], ["a"] * 6 + ["b"] * 4)
+        np.testing.assert_array_equal(profile["_ids_"], [7, 7, 7, 9, 9, 9, 7, 7, 9, 9])
+        np.testing.assert_array_equal(profile["_yhat_"], [4, 7, 4, 6, 9, 6, 4, 7, 6, 9])
+
+    def test_calculate_profile_batches(self):
+        self.cp._label = "xyz"
+        self.cp.all_variable_names = ["a", "b"]
+        self.cp.new_observation = pd.DataFrame(np.array([[1, 2], [3, 4]]))
+        self.cp._predict_function = MagicMock(side_effect=lambda df: df.sum(axis=1))
+        self.cp._batch_size = 4
+        var_splits = OrderedDict([("a", [2, 5, 2]), ("b", [3, 6])])
+        profile = self.calculate_profile(var_splits)
+        self.assertEqual(self.cp._predict_function.call_count, 3)
+        np.testing.assert_array_equal(profile["_yhat_"], [4, 7, 4, 6, 9, 6, 4, 7, 6, 9])
+
+    def test_predict_in_batches(self):
+        X = pd.DataFrame({"a": np.arange(10)})
+        predict_function = MagicMock(side_effect=lambda df: df["a"].values * 2)
+        np.testing.assert_array_equal(_predict_in_batches(predict_function, X, 3), np.arange(10) * 2)
+        self.assertEqual(predict_function.call_count, 4)
+        np.testing.assert_array_equal(_predict_in_batches(predict_function, X), np.arange(10) * 2)
+        self.assertEqual(predict_function.call_count, 5)
+
+
+    def test_calculate_profile_parallel(self):
+        self.cp._label = "xyz"
+        self.cp.all_variable_names = ["a", "b", "c"]
+        self.cp.new_observation = pd.DataFrame(np.random.random((4, 3)))
+        self.cp._predict_function = sum_predict
+        self.cp._batch_size = 5
+        var_splits = OrderedDict([("a", [2, 5, 2]), ("c", np.linspace(0, 1, 7)), ("b", [3, 6])])
+        serial = self.calculate_profile(var_splits)
+        for n_jobs, executor in [(2, 'thread'), (-1, 'thread'), (2, 'process')]:
+            self.cp._n_jobs = n_jobs
+            self.cp._executor = executor
+            pd.testing.assert_frame_equal(serial, self.calculate_profile(var_splits))
+
+    def test_predict_in_parallel(self):
+        grids = [pd.DataFrame({"a": np.arange(i, i + 5)}) for i in range(3)]
+        with ThreadPoolExecutor(max_workers=3) as executor:
+            predictions = _predict_in_parallel(sum_predict, grids, executor=executor)
+        self.assertEqual(len(predictions), 3)
+        np.testing.assert_array_equal(predictions[2], np.arange(2, 7))
+        with self.assertRaises(ValueError):
+            _predict_in_parallel(sum_predict, grids, n_jobs=2, executor='gpu')
+
+    def test_is_parallel(self):
+        self.assertFalse(_is_parallel(None, 'thread'))
+        self.assertFalse(_is_parallel(1, 'process'))
+        self.assertTrue(_is_parallel(4, 'thread'))
+        with ThreadPoolExecutor() as executor:
+            self.assertTrue(_is_parallel(None, executor))
+
+
+class TestLazyProfiles(unittest.TestCase):
+
+    def setUp(self):
+        np.random.seed(42)
+        data = pd.DataFrame({"a": np.random.random(30), "b": np.random.randint(0, 4, 30), "c": np.random.random(30)})
+        self.explainer = MagicMock(data=data, var_names=["a", "b", "c"], predict_fun=sum_predict, label="xyz")
+        self.observations = data.iloc[:7]
+
+    def cp(self, **kwargs):
+        return CeterisParibus(self.explainer, self.observations, None, ["a", "b"], 5, None, **kwargs)
+
+    def test_lazy_profile(self):
+        cp = self.cp(lazy=True)
+        self.assertIsNone(cp._profile)
+        pd.testing.assert_frame_equal(cp.profile, self.cp().profile)
+
+    def test_iter_profile(self):
+        cp = self.cp(lazy=True, chunk_size=3)
+        chunks = list(cp.iter_profile())
+        # 3 chunks of observations for each of variables
+        self.assertEqual(len(chunks), 6)
+        self.assertEqual(len(chunks[0]), 3 * 5)
+        self.assertEqual(len(chunks[2]), 1 * 5)
+        self.assertIsNone(cp._profile)
+        pd.testing.assert_frame_equal(pd.concat(chunks, ignore_index=True), self.cp().profile)
+
+    def test_iter_profile_2(self):
+        cp = self.cp(lazy=True)
+        self.assertEqual([len(chunk) for chunk in cp.iter_profile()], [7 * 5, 7 * 4])
+        self.assertEqual(len(list(cp.iter_profile(chunk_size=2))), 8)
+        # stored predictions are yielded in chunks as well
+        cp = self.cp()
+        self.assertEqual(len(list(cp.iter_profile(chunk_size=2))), 8)
+        # materialized profile is yielded at once
+        cp.profile
+        self.assertEqual(len(list(cp.iter_profile(chunk_size=2))), 1)
+
+    def test_compact_profile(self):
+        cp = self.cp()
+        self.assertIsNone(cp._profile)
+        self.assertEqual(list(cp._predictions.keys()), ["a", "b"])
+        self.assertEqual(cp._predictions["a"].shape, (7, 5))
+        self.assertEqual(cp._predictions["b"].shape, (7, 4))
+        profile = cp.profile
+        self.assertEqual(len(profile), 7 * 9)
+        self.assertEqual(profile['_vname_'].dtype, 'category')
+        self.assertEqual(profile['_label_'].dtype, 'category')
+        np.testing.assert_array_equal(profile['_yhat_'][:5], cp._predictions["a"][0])
+        np.testing.assert_array_equal(profile['_yhat_'], sum_predict(profile[["a", "b", "c"]]))
+        self.assertEqual(list(cp.split_by('_vname_').keys()), ["a", "b"])
+
+    def test_save_lazy_profile(self):
+        filename = '_tmp_file3_'
+        cp = self.cp(lazy=True, chunk_size=2)
+        save_profiles([cp], filename)
+        self.assertIsNone(cp._profile)
+        with open(filename, 'r') as f:
+            content = f.read()
+        os.remove(filename)
+        self.assertTrue(content.startswith('profile = [') and content.endswith('];'))
+        self.assertEqual(json.loads(content[len('profile = '):-1]), dump_profiles([self.cp()]))
+
+    def test_simplified_profile(self):
+        cp = self.cp(lazy=True)
+        # profiles of the sum are linear, only the ends are kept
+        chunks = list(cp.iter_profile(simplify=True))
+        self.assertEqual([len(chunk) for chunk in chunks], [7 * 2, 7 * 2])
+        profile = self.cp().profile
+        pd.testing.assert_frame_equal(chunks[0], profile[profile['_vname_'] == 'a'].iloc[[0, 4, 5, 9, 10, 14, 15,
+                                                                                         19, 20, 24, 25, 29, 30, 34]])
+
+    def test_simplified_mask(self):
+        x = np.array([0., 1., 2., 3., 4.])
+        yhat = np.array([[0., 0., 1., 1., 1.], [0., 2., 4., 6., 8.]])
+        np.testing.assert_array_equal(_simplified_mask(x, yhat), [[True, True, True, False, True],
+                                                                   [True, False, False, False, True]])
+        self.assertTrue(_simplified_mask(np.array(['x', 'y', 'z']), np.zeros((1, 3))).all())
+
+    def test_select_observations(self):
+        cp = CeterisParibus(self.explainer, self.observations, np.arange(7), ["a", "b"], 5, None)
+        selected = cp.select_observations([1, 5])
+        self.assertEqual(list(selected.new_observation.index), [1, 5])
+        self.assertEqual(list(selected.new_observation_true), [1, 5])
+        np.testing.assert_array_equal(selected._predictions["b"], cp._predictions["b"][[1, 5]])
+        profile = cp.profile
+        pd.testing.assert_frame_equal(selected.profile, profile[profile['_ids_'].isin([1, 5])].reset_index(drop=True),
+                                      check_categorical=False)
+        self.assertEqual(len(cp.new_observation), 7)
+
+
+class TestExtendProfiles(unittest.TestCase):
+
+    def setUp(self):
+        np.random.seed(42)
+        self.data = pd.DataFrame({"a": np.random.random(30), "b": np.random.randint(0, 4, 30),
+                                  "c": np.random.random(30)})
+        self.predict = MagicMock(side_effect=sum_predict)
+        self.explainer = MagicMock(data=self.data, var_names=["a", "b", "c"], predict_fun=self.predict, label="xyz")
+
+    def cp(self, observations, variables, y=None, variable_splits=None, **kwargs):
+        return CeterisParibus(self.explainer, observations, y, variables, 5, variable_splits, **kwargs)
+
+    def predicted_rows(self):
+        return sum(len(call[0][0]) for call in self.predict.call_args_list)
+
+    def test_add_observations(self):
+        cp = self.cp(self.data.iloc[:4], ["a", "b"], y=np.arange(4))
+        cp.profile
+        self.predict.reset_mock()
+        cp.add_observations(self.data.iloc[4:7], y=np.arange(4, 7))
+        # grids of the new observations and the observations themselves
+        self.assertEqual(self.predicted_rows(), 3 * 9 + 3)
+        expected = self.cp(self.data.iloc[:7], ["a", "b"], y=np.arange(7))
+        pd.testing.assert_frame_equal(cp.profile, expected.profile)
+        np.testing.assert_array_equal(cp.new_observation_predictions, expected.new_observation_predictions)
+        np.testing.assert_array_equal(cp.new_observation_true, np.arange(7))
+
+    def test_add_observations_labels(self):
+        cp = self.cp(self.data.iloc[:2], ["a"], y=[1, 2])
+        cp.add_observations(self.data.iloc[[2]])
+        np.testing.assert_array_equal(cp.new_observation_true, [1, 2, np.nan])
+        cp = self.cp(self.data.iloc[:2], ["a"], lazy=True)
+        cp.add_observations(self.data.iloc[2].values)
+        self.assertIsNone(cp.new_observation_true)
+        self.assertIsNone(cp._predictions)
+        self.assertEqual(len(cp.profile), 3 * 5)
+        # an array gets a fresh id
+        self.assertEqual(list(cp.new_observation.index), [0, 1, 2])
+        self.assertEqual(sorted(cp.profile['_ids_'].unique()), [0, 1, 2])
+
+    def test_add_observations_ids(self):
+        cp = self.cp(self.data.iloc[:3], ["a", "b"])
+        cp.add_observations(self.data.iloc[10:12].reset_index(drop=True))
+        self.assertEqual(list(cp.new_observation.index), [0, 1, 2, 3, 4])
+        self.assertEqual(sorted(cp.profile['_ids_'].unique()), [0, 1, 2, 3, 4])
+        self.assertEqual([record['_ids_'] for record in dump_observations([cp])], [0, 1, 2, 3, 4])
+        cp.add_observations(self.data.iloc[10:12].values)
+        self.assertEqual(list(cp.new_observation.index), [0, 1, 2, 3, 4, 5, 6])
+        # distinct indexes are kept
+        cp = self.cp(self.data.iloc[:3], ["a"])
+        cp.add_observations(self.data.iloc[[20, 25]])
+        self.assertEqual(list(cp.new_observation.index), [0, 1, 2, 20, 25])
+        cp = self.cp(self.data.iloc[:3].set_axis(["x", "y", "z"]), ["a"])
+        with self.assertRaises(ValueError):
+            cp.add_observations(self.data.iloc[[5]].set_axis(["x"]))
+
+    def test_add_variables(self):
+        cp = self.cp(self.data.iloc[:4], ["a"])
+        self.predict.reset_mock()
+        cp.add_variables(["b", "a", "c"], variable_splits={"b": [0, 1], "c": [0.5]})
+        self.assertEqual(self.predicted_rows(), 4 * 3)
+        self.assertEqual(cp.selected_variables, ["a", "b", "c"])
+        expected = self.cp(self.data.iloc[:4], ["a", "b", "c"],
+                           variable_splits={"a": cp._variable_splits["a"], "b": [0, 1], "c": [0.5]})
+        pd.testing.assert_frame_equal(cp.profile, expected.profile)
+        with self.assertRaises(ValueError):
+            cp.add_variables(["d"])
+
+    def test_add_grid_points(self):
+        cp = self.cp(self.data.iloc[:4], ["a", "b"], variable_splits={"a": [0.2, 0.6], "b": [1, 3]})
+        cp.profile
+        self.predict.reset_mock()
+        cp.add_grid_points({"a": [0.6, 0.4, 0.1], "b": [3]})
+        # only values not present in the splits are scored
+        self.assertEqual(self.predicted_rows(), 4 * 2)
+        np.testing.assert_array_equal(cp._variable_splits["a"], [0.1, 0.2, 0.4, 0.6])
+        expected = self.cp(self.data.iloc[:4], ["a", "b"], variable_splits={"a": [0.1, 0.2, 0.4, 0.6], "b": [1, 3]})
+        pd.testing.assert_frame_equal(cp.profile, expected.profile)
+        with self.assertRaises(ValueError):
+            cp.add_grid_points({"c": [1]})
+
+
+class TestAdaptiveProfiles(unittest.TestCase):
+
+    def setUp(self):
+        np.random.seed(42)
+        self.data = pd.DataFrame({"a": np.random.random(300), "b": np.random.random(300),
+                                  "c": np.random.randint(0, 1000, 300)})
+        self.predict = MagicMock(side_effect=lambda df: (2. * (df["a"] > 0.37) + df["b"] + (df["c"] > 500)).values)
+        self.explainer = MagicMock(data=self.data, var_names=["a", "b", "c"], predict_fun=self.predict, label="xyz")
+
+    def predicted_rows(self):
+        return sum(len(call[0][0]) for call in self.predict.call_args_list)
+
+    def test_interval_scores(self):
+        split = np.arange(5.)
+        np.testing.assert_array_equal(_interval_scores(split, np.array([[0, 0, 1, 1, 1]])), [0, 1, 0, 0])
+        np.testing.assert_array_equal(_interval_scores(split, np.array([[0, 1, 2, 3, 4]])), [0, 0, 0, 0])
+        np.testing.assert_array_equal(_interval_scores(split[:2], np.array([[1, 3], [0, 1]])), [2])
+
+    def test_coarse_split(self):
+        np.testing.assert_array_equal(_coarse_split(np.arange(101)), np.arange(0, 101, 10))
+        np.testing.assert_array_equal(_coarse_split(np.arange(3)), np.arange(3))
+        np.testing.assert_array_equal(_coarse_split(np.repeat([0., 1., 2.], 40)), [0., 1., 2.])
+        # zero width intervals do not spoil scores of their neighbours
+        scores = _interval_scores(np.array([0., 0., 1., 2., 2.]), np.array([[0, 0, 0, 1, 1]]))
+        np.testing.assert_array_equal(scores, [0, 0, 1, 0])
+
+    def test_adaptive_tied_quantiles(self):
+        data = pd.DataFrame({"a": np.repeat([0., 1., 2.], 40)})
+        explainer = MagicMock(data=data, var_names=["a"], label="xyz",
+                              predict_fun=lambda df: (df["a"] > 1.5).values.astype(float))
+        with warnings.catch_warnings():
+            warnings.simplefilter("error")
+            cp = individual_variable_profile(explainer, data.iloc[:2], adaptive=True)
+        split = cp._variable_splits["a"]
+        self.assertTrue((np.diff(split) > 0).all())
+        position = np.searchsorted(split, 1.5, side='right')
+        self.assertLess(split[position] - split[position - 1], 0.001)
+
+    def test_adaptive_profile(self):
+        cp = individual_variable_profile(self.explainer, self.data.iloc[:5], adaptive=True)
+        # uniform grid would take 5 * 3 * 101 rows
+        self.assertLess(self.predicted_rows(), 5 * 3 * 101 / 4)
+        # linear profile is not refined
+        self.assertEqual(len(cp._variable_splits["b"]), 11)
+        # jumps are located precisely
+        split = cp._variable_splits["a"]
+        position = np.searchsorted(split, 0.37)
+        self.assertLess(split[position] - split[position - 1], 0.001)
+        split = cp._variable_splits["c"]
+        position = np.searchsorted(split, 500.5)
+        np.testing.assert_array_equal(split[position - 1:position + 1], [500, 501])
+        self.assertEqual(split.dtype, self.data["c"].dtype)
+        np.testing.assert_array_equal(cp.profile["_yhat_"], self.predict(cp.profile[["a", "b", "c"]]))
+
+    def test_adaptive_budget(self):
+        individual_variable_profile(self.explainer, self.data.iloc[:5], variables=["a"], adaptive=True,
+                                    max_predictions=100)
+        # the observations are scored as well
+        self.assertLessEqual(self.predicted_rows(), 100 + 5)
+
+    def test_adaptive_categorical(self):
+        data = pd.DataFrame({"a": np.random.random(50), "b": np.random.choice(["x", "y"], 50)})
+        explainer = MagicMock(data=data, var_names=["a", "b"], predict_fun=lambda df: df["a"].values, label="xyz")
+        cp = individual_variable_profile(explainer, data.iloc[:2], adaptive=True)
+        np.testing.assert_array_equal(cp._variable_splits["b"], ["x", "y"])
+
+    def test_adaptive_list_splits(self):
+        splits = {"a": list(np.linspace(0, 1, 41)), "b": [0, 0.5, 1], "c": list(range(0, 1000, 50))}
+        cp = individual_variable_profile(self.explainer, self.data.iloc[:2], variable_splits=splits, adaptive=True)
+        self.assertIsInstance(cp._variable_splits["a"], np.ndarray)
+        np.testing.assert_array_equal(cp.profile["_yhat_"], self.predict(cp.profile[["a", "b", "c"]]))
+
+
+class TestGrids(unittest.TestCase):
+
+    def setUp(self):
+        self.observations = pd.DataFrame({"a": [1, 2], "b": [0.5, 1.5], "c": pd.Categorical(["x", "y"]),
+                                          "d": ["u", "v"], "e": [True, False]})
+
+    def test_stacked_grid(self):
+        splits = OrderedDict([("a", np.array([3, 4, 5])), ("c", np.array(["y", "z"]))])
+        grid, bounds = _stacked_grid(self.observations, splits)
+        np.testing.assert_array_equal(bounds, [0, 6, 10])
+        self.assertEqual(list(map(str, grid.dtypes)), list(map(str, self.observations.dtypes)))
+        np.testing.assert_array_equal(grid["a"], [3, 4, 5, 3, 4, 5, 1, 1, 2, 2])
+        np.testing.assert_array_equal(grid["c"], ["x"] * 3 + ["y"] * 3 + ["y", "z", "y", "z"])
+        self.assertEqual(list(grid["c"].cat.categories), ["x", "y", "z"])
+        np.testing.assert_array_equal(grid["d"], ["u"] * 3 + ["v"] * 3 + ["u", "u", "v", "v"])
+
+    def test_stacked_grid_dtypes(self):
+        grid, _ = _stacked_grid(self.observations, {"a": np.array([0.5, 1.5])})
+        self.assertEqual(grid["a"].dtype, np.float64)
+        grid, _ = _stacked_grid(self.observations, {"b": np.array([1, 2]), "e": np.array([True])})
+        self.assertEqual(grid["b"].dtype, np.float64)
+        self.assertEqual(grid["e"].dtype, bool)
+        observations = pd.DataFrame({"a": pd.array([1, None], dtype="Int64")})
+        grid, _ = _stacked_grid(observations, {"a": np.array([7])})
+        self.assertEqual(grid["a"].dtype, "Int64")
+        np.testing.assert_array_equal(grid["a"], [7, 7])
+
+    def test_stacked_grid_columns(self):
+        grid, _ = _stacked_grid(pd.DataFrame([[1, 2]]), {"x": [0]}, columns=["x", "y"])
+        self.assertEqual(list(grid.columns), ["x", "y"])
+        np.testing.assert_array_equal(grid.values, [[0, 2]])
+
+    def test_sparse_grid(self):
+        observations = pd.DataFrame({"a": [0., 2.], "b": [1., 0.], "c": [0., 0.]})
+        splits = OrderedDict([("a", np.array([0., 1.])), ("c", np.array([3.]))])
+        grid, bounds = _sparse_grid(observations, splits, ["a", "b", "c"])
+        dense, dense_bounds = _stacked_grid(observations, splits)
+        np.testing.assert_array_equal(bounds, dense_bounds)
+        np.testing.assert_array_equal(grid.toarray(), dense.values)
+        # zeros are not stored
+        self.assertEqual(grid.nnz, np.count_nonzero(dense.values))
+
+    def test_sparse_profile(self):
+        from scipy import sparse
+        np.random.seed(42)
+        X = sparse.random(100, 4, density=0.3, format="csr", random_state=42)
+        coefficients = np.array([1., -2., 3., 0.5])
+        model = MagicMock(predict=MagicMock(side_effect=lambda X: X @ coefficients))
+        explainer = explain(model, ["a", "b", "c", "d"], data=X, label="sparse")
+        cp = individual_variable_profile(explainer, X[:3], grid_points=5)
+        for call in model.predict.call_args_list:
+            self.assertTrue(sparse.issparse(call[0][0]))
+        dense_explainer = explain(model, ["a", "b", "c", "d"], data=X.toarray(), label="sparse",
+                                  predict_function=lambda df: df.values @ coefficients)
+        expected = individual_variable_profile(dense_explainer, X[:3].toarray(), grid_points=5)
+        pd.testing.assert_frame_equal(cp.profile, expected.profile)
+        np.testing.assert_allclose(cp.new_observation_predictions, expected.new_observation_predictions)
+        lazy = individual_variable_profile(explainer, X[:3], grid_points=5, lazy=True)
+        pd.testing.assert_frame_equal(lazy.profile, expected.profile)
+
+
+class TestMultipleModels(unittest.TestCase):
+
+    def setUp(self):
+        np.random.seed(42)
+        data = pd.DataFrame({"a": np.random.random(30), "b": np.random.randint(0, 4, 30), "c": np.random.random(30)})
+        self.explainers = [MagicMock(data=data, var_names=["a", "b", "c"], label=label,
+                                     predict_fun=MagicMock(side_effect=predict))
+                           for label, predict in [("sum", sum_predict), ("a", lambda df: df["a"].values * 2),
+                                                  ("max", lambda df: df.max(axis=1).values)]]
+        self.observations = data.iloc[:4]
+
+    def test_profiles(self):
+        profiles = individual_variable_profiles(self.explainers, self.observations, variables=["a", "b"],
+                                                grid_points=5)
+        self.assertEqual(list(profiles.keys()), ["sum", "a", "max"])
+        grids = [explainer.predict_fun.call_args_list[-1][0][0] for explainer in self.explainers]
+        # a single grid is scored by all the models
+        self.assertTrue(all(grid is grids[0] for grid in grids))
+        self.assertEqual(len(grids[0]), 4 * (5 + 4))
+        for explainer, cp in zip(self.explainers, profiles.values()):
+            self.assertIs(cp._variable_splits, profiles["sum"]._variable_splits)
+            expected = individual_variable_profile(explainer, self.observations, variables=["a", "b"], grid_points=5)
+            pd.testing.assert_frame_equal(cp.profile, expected.profile)
+            np.testing.assert_array_equal(cp.new_observation_predictions, expected.new_observation_predictions)
+
+    def test_profiles_parallel(self):
+        profiles = individual_variable_profiles(self.explainers, self.observations, grid_points=5, n_jobs=2,
+                                                batch_size=7)
+        expected = individual_variable_profiles(self.explainers, self.observations, grid_points=5)
+        for label, cp in profiles.items():
+            pd.testing.assert_frame_equal(cp.profile, expected[label].profile)
+
+    def test_profiles_incorrect(self):
+        with self.assertRaises(ValueError):
+            individual_variable_profiles([], self.observations)
+        self.explainers[1].label = "sum"
+        with self.assertRaises(ValueError):
+            individual_variable_profiles(self.explainers, self.observations)
+        self.explainers[1].label = "a"
+        self.explainers[2].var_names = ["a", "c", "b"]
+        with self.assertRaises(ValueError):
+            individual_variable_profiles(self.explainers, self.observations)
+
+
+class TestAsyncProfiles(unittest.TestCase):
+
+    def setUp(self):
+        np.random.seed(42)
+        data = pd.DataFrame({"a": np.random.random(30), "b": np.random.randint(0, 4, 30), "c": np.random.random(30)})
+        self.calls = []
+        self.active = 0
+        self.max_active = 0
+
+        async def async_predict(df):
+            self.calls.append(len(df))
+            self.active += 1
+            self.max_active = max(self.max_active, self.active)
+            await asyncio.sleep(0.01)
+            self.active -= 1
+            return sum_predict(df)
+
+        self.explainer = MagicMock(data=data, var_names=["a", "b", "c"], predict_fun=async_predict, label="xyz")
+        self.sync_explainer = MagicMock(data=data, var_names=["a", "b", "c"], predict_fun=sum_predict, label="xyz")
+        self.observations = data.iloc[:7]
+        self.loop = asyncio.new_event_loop()
+
+    def tearDown(self):
+        self.loop.close()
+
+    def run_async(self, explainer, **kwargs):
+        return self.loop.run_until_complete(individual_variable_profile_async(
+            explainer, self.observations, variables=["a", "b"], grid_points=5, **kwargs))
+
+    def test_is_coroutine_function(self):
+        class AsyncModel:
+            async def __call__(self, df):
+                return sum_predict(df)
+
+        self.assertTrue(_is_coroutine_function(self.explainer.predict_fun))
+        self.assertTrue(_is_coroutine_function(AsyncModel()))
+        self.assertFalse(_is_coroutine_function(sum_predict))
+
+    def test_async_profile(self):
+        cp = self.run_async(self.explainer)
+        expected = individual_variable_profile(self.sync_explainer, self.observations, variables=["a", "b"],
+                                               grid_points=5)
+        self.assertIsInstance(cp, CeterisParibus)
+        # a call for every variable and for the observations
+        self.assertEqual(sorted(self.calls), [7, 7 * 4, 7 * 5])
+        pd.testing.assert_frame_equal(cp.profile, expected.profile)
+        np.testing.assert_array_equal(cp.new_observation_predictions, expected.new_observation_predictions)
+        self.assertEqual(dump_profiles([cp]), dump_profiles([expected]))
+
+    def test_async_concurrency(self):
+        cp = self.run_async(self.explainer, batch_size=4, max_concurrency=3)
+        self.assertTrue(all(calls <= 4 for calls in self.calls[:-1]))
+        self.assertEqual(self.max_active, 3)
+        self.assertEqual(cp._predictions["a"].shape, (7, 5))
+        self.max_active = 0
+        self.run_async(self.explainer, batch_size=4, max_concurrency=1)
+        self.assertEqual(self.max_active, 1)
+
+    def test_async_sync_predict(self):
+        cp = self.run_async(self.sync_explainer, batch_size=10)
+        expected = individual_variable_profile(self.sync_explainer, self.observations, variables=["a", "b"],
+                                               grid_points=5)
+        pd.testing.assert_frame_equal(cp.profile, expected.profile)
+
+
+class TestAggregatedProfiles(unittest.TestCase):
+
+    def setUp(self):
+        np.random.seed(42)
+        data = pd.DataFrame({"a": np.random.random(40), "b": np.random.randint(0, 4, 40),
+                             "c": np.random.choice(["x", "y"], 40)})
+        predict_function = lambda df: df["a"].astype(float).values * df["b"].astype(float).values
+        self.explainer = MagicMock(data=data, var_names=["a", "b", "c"], predict_fun=predict_function, label="xyz")
+        self.observations = data.iloc[:9]
+
+    def cp(self, **kwargs):
+        return CeterisParibus(self.explainer, self.observations, None, ["a", "b"], 6, None, **kwargs)
+
+    def test_aggregate_mean(self):
+        cp = self.cp()
+        aggregated = cp.aggregate_profiles()
+        self.assertEqual(len(aggregated), 6 + 4)
+        profile = cp.profile[cp.profile['_vname_'] == 'a']
+        expected = profile.groupby('a')['_yhat_'].mean()
+        aggregated_a = aggregated[aggregated['_vname_'] == 'a']
+        np.testing.assert_array_almost_equal(aggregated_a['_yhat_'], expected.values)
+        np.testing.assert_array_almost_equal(aggregated_a['a'], expected.index)
+        self.assertEqual(set(aggregated['_label_']), {"xyz"})
+
+    def test_aggregate_median(self):
+        cp = self.cp()
+        aggregated = cp.aggregate_profiles('median', quantiles=(0.1, 0.9))
+        profile = cp.profile[cp.profile['_vname_'] == 'b']
+        grouped = profile.groupby('b')['_yhat_']
+        aggregated_b = aggregated[aggregated['_vname_'] == 'b']
+        np.testing.assert_array_almost_equal(aggregated_b['_yhat_'], grouped.median().values)
+        np.testing.assert_array_almost_equal(aggregated_b['_yhat_lower_'], grouped.quantile(0.1).values)
+        np.testing.assert_array_almost_equal(aggregated_b['_yhat_upper_'], grouped.quantile(0.9).values)
+
+    def test_aggregate_groups(self):
+        cp = self.cp()
+        aggregated = cp.aggregate_profiles(group_by='c')
+        self.assertEqual(set(aggregated['_label_']), {"xyz_x", "xyz_y"})
+        # profiles of `a` keep the original values of `c`
+        profile = cp.profile[cp.profile['_vname_'] == 'a']
+        expected = profile.groupby(['c', 'a'])['_yhat_'].mean()
+        aggregated_a = aggregated[aggregated['_vname_'] == 'a'].sort_values(['_groups_', 'a'])
+        np.testing.assert_array_almost_equal(aggregated_a['_yhat_'], expected.values)
+
+    def test_aggregate_lazy(self):
+        expected = self.cp().aggregate_profiles('median', quantiles=(0.25, 0.75), group_by='c')
+        cp = self.cp(lazy=True)
+        pd.testing.assert_frame_equal(cp.aggregate_profiles('median', quantiles=(0.25, 0.75), group_by='c',
+                                                            chunk_size=2), expected)
+        self.assertIsNone(cp._predictions)
+        self.assertIsNone(cp._profile)
+
+    def test_aggregate_incorrect(self):
+        with self.assertRaises(ValueError):
+            self.cp().aggregate_profiles('max')
 
 
 class TestProfilesUtils(unittest.TestCase):
@@ -276,3 +835,60 @@ class TestProfilesUtils(unittest.TestCase):
         with open(filename, 'r') as f:
             self.assertTrue(f.read().startswith('profile ='))
         os.remove(filename)
+
+    def test_atomic_open(self):
+        directory = tempfile.mkdtemp()
+        filename = os.path.join(directory, 'file.js')
+        with atomic_open(filename) as f:
+            f.write("a")
+            self.assertFalse(os.path.exists(filename))
+        with self.assertRaises(ZeroDivisionError):
+            with atomic_open(filename) as f:
+                f.write("b")
+                1 / 0
+        # the file is intact and the temporary file is removed
+        self.assertEqual(os.listdir(directory), ['file.js'])
+        with open(filename) as f:
+            self.assertEqual(f.read(), "a")
+
+    def test_write_json_list(self):
+        for items in [[], [{"a": 1}], [{"a": 1, "b": [1, 2]}, {"c": "x"}, {}]]:
+            f = io.StringIO()
+            _write_json_list(f, iter(items))
+            self.assertEqual(f.getvalue(), json.dumps(items, indent=2))
+        for items in [[], [{"a": 1}], [{"a": 1, "b": [1, 2.5]}, {"c": "x"}]]:
+            f = io.StringIO()
+            _write_json_list(f, iter(items), indent=None)
+            self.assertEqual(f.getvalue(), json.dumps(items, separators=(',', ':')))
+
+    def test_dump_profiles_columns(self):
+        self.cp1.profile = pd.DataFrame.from_records([{"a": 1.5, "_yhat_": 2.0, "_vname_": "a", "_ids_": 0},
+                                                      {"a": 3.5, "_yhat_": 4.0, "_vname_": "a", "_ids_": 0}])
+        columns = dump_profiles_columns([self.cp1, self.cp1])
+        self.assertEqual(len(columns), 2)
+        self.assertEqual(columns[0], {"a": [1.5, 3.5], "_yhat_": [2.0, 4.0], "_vname_": ["a", "a"], "_ids_": [0, 0]})
+        self.assertIsInstance(columns[0]["_ids_"][0], int)
+
+    def test_save_profiles_columns(self):
+        self.cp1.profile = pd.DataFrame.from_records([{"a": 1.5, "_yhat_": np.float32(2.0), "_ids_": 0}] * 3)
+        filename = '_tmp_file4_'
+        stats = save_profiles([self.cp1], filename, orient='columns', indent=None)
+        with open(filename, 'r') as f:
+            content = f.read()
+        os.remove(filename)
+        self.assertEqual(content, 'profile = [{"a":[1.5,1.5,1.5],"_yhat_":[2.0,2.0,2.0],"_ids_":[0,0,0]}];')
+        self.assertEqual(stats.bytes, len(content))
+        self.assertGreaterEqual(stats.seconds, 0)
+        with self.assertRaises(ValueError):
+            save_profiles([self.cp1], filename, orient='index')
+
+    def test_dump_observations_3(self):
+        self.cp1.new_observation = pd.DataFrame.from_dict({"a": [1.2, 3.4], "c": ["x", "y"]})
+        self.cp1.all_variable_names = ["a", "c"]
+        self.cp1.new_observation_predictions = np.array([12.5, 3])
+        self.cp1._label = "some_label"
+        # labels with non default index
+        self.cp1.new_observation_true = pd.Series([7, 8], index=[10, 11])
+        observations = dump_observations([self.cp1])
+        self.assertEqual(observations[1], {"a": 3.4, "c": "y", "_yhat_": 3.0, "_label_": "some_label", "_ids_": 1,
+                                           "_y_": 8})
@@ -6,8 +6,9 @@ import pandas as pd
 from sklearn.metrics.pairwise import euclidean_distances
 
 from ceteris_paribus.gower import _normalize_mixed_data_columns, gower_distances, _calc_range_mixed_data_columns, \
-    _gower_dist
-from ceteris_paribus.select_data import select_sample, select_neighbours, _select_columns
+    _gower_dist, _encode_mixed_data, _encode_observation, _encode_observations, _gower_distances_block
+from ceteris_paribus.select_data import select_sample, select_neighbours, _select_columns, NeighbourIndex, \
+    select_sample_stream, _allocate, select_neighbours_batch
 
 
 class TestSelect(unittest.TestCase):
@@ -45,6 +46,58 @@ class TestSelect(unittest.TestCase):
         pos = list(self.y).index(sample_y[0])
         self.assertSequenceEqual(list(sample_x.iloc[0]), list(self.x[pos]))
 
+    def test_select_sample_global_state(self):
+        np.random.seed(0)
+        expected = np.random.random()
+        np.random.seed(0)
+        select_sample(self.x, n=2)
+        self.assertEqual(np.random.random(), expected)
+
+    def test_select_sample_stream(self):
+        df = pd.DataFrame({'a': np.arange(1000), 'b': np.arange(1000) % 7})
+        chunks = [df.iloc[i:i + 100] for i in range(0, 1000, 100)]
+        sample = select_sample_stream(chunks, n=50, seed=1)
+        self.assertEqual(sample.shape, (50, 2))
+        self.assertEqual(len(set(sample['a'])), 50)
+        np.testing.assert_array_equal(sample['b'], sample['a'] % 7)
+        # the same seed gives the same sample, regardless of chunks
+        pd.testing.assert_frame_equal(sample, select_sample_stream(iter(chunks), n=50, seed=1))
+        self.assertFalse(sample.equals(select_sample_stream(chunks, n=50, seed=2)))
+
+    def test_select_sample_stream_uniform(self):
+        counts = np.zeros(10)
+        for seed in range(200):
+            counts[select_sample_stream(np.arange(10).reshape((-1, 1)), n=3, seed=seed)[0]] += 1
+        self.assertTrue(np.all(np.abs(counts - 60) < 25))
+
+    def test_select_sample_stream_labels(self):
+        sample_x, sample_y = select_sample_stream([self.x[:2], self.x[2:]], self.y, n=2)
+        for (_, row), label in zip(sample_x.iterrows(), sample_y):
+            self.assertSequenceEqual(list(row), list(self.x[list(self.y).index(label)]))
+        sample_x = select_sample_stream([self.x[:2], self.x[2:]], n=300)
+        self.assertEqual(len(sample_x), len(self.x))
+
+    def test_select_sample_stream_stratified(self):
+        df = pd.DataFrame({'a': np.arange(1000), 'g': ['x'] * 700 + ['y'] * 200 + ['z'] * 100})
+        chunks = [df.iloc[i:i + 64] for i in range(0, 1000, 64)]
+        sample = select_sample_stream(chunks, n=20, stratify='g')
+        self.assertEqual(sample['g'].value_counts().to_dict(), {'x': 14, 'y': 4, 'z': 2})
+        sample_x, sample_y = select_sample_stream(chunks, y='g', n=10, stratify='y')
+        self.assertEqual(list(sample_x.columns), ['a'])
+        self.assertEqual(sample_y.value_counts().to_dict(), {'x': 7, 'y': 2, 'z': 1})
+        np.testing.assert_array_equal(df['g'].iloc[sample_x['a']], sample_y)
+
+    def test_select_sample_stream_incorrect(self):
+        with self.assertRaises(ValueError):
+            select_sample_stream([], n=2)
+        with self.assertRaises(ValueError):
+            select_sample_stream([self.x], n=2, stratify='y')
+
+    def test_allocate(self):
+        self.assertEqual(_allocate({'a': 5, 'b': 3, 'c': 2}, 3), {'a': 1, 'b': 1, 'c': 1})
+        self.assertEqual(_allocate({'a': 7, 'b': 2, 'c': 1}, 5), {'a': 4, 'b': 1, 'c': 0})
+        self.assertEqual(sum(_allocate({'a': 1, 'b': 1, 'c': 1}, 2).values()), 2)
+
     def test_select_neighbours(self):
         neighbours = select_neighbours(self.x, self.x[0], dist_fun=euclidean_distances, n=1)
         neighbours2 = select_neighbours(self.x, self.x[0], dist_fun='gower', n=1)
@@ -139,6 +192,83 @@ class TestSelect(unittest.TestCase):
         self.select_columns_helper(subset, (self.x, observation))
 
 
+class TestNeighbourIndex(unittest.TestCase):
+
+    def setUp(self):
+        np.random.seed(42)
+        self.df = pd.DataFrame({'a': np.random.random(200), 'b': np.random.random(200) * 10,
+                                'c': np.random.choice(['x', 'y', 'z'], 200)})
+        self.y = pd.Series(np.arange(200))
+
+    def test_query_1(self):
+        index = NeighbourIndex(self.df)
+        neighbours = index.query(self.df.iloc[17], n=5)
+        distances = gower_distances(self.df, self.df.iloc[17])
+        self.assertEqual(neighbours[0], 17)
+        np.testing.assert_array_equal(neighbours, np.argsort(distances, kind='mergesort')[:5])
+
+    def test_query_2(self):
+        # many observations at once
+        index = NeighbourIndex(self.df)
+        neighbours = index.query(self.df.iloc[[3, 8, 11]], n=4)
+        self.assertEqual(neighbours.shape, (3, 4))
+        np.testing.assert_array_equal(neighbours[:, 0], [3, 8, 11])
+        np.testing.assert_array_equal(neighbours[1], index.query(self.df.iloc[8], n=4))
+
+    def test_query_3(self):
+        index = NeighbourIndex(self.df, variable_names=['a', 'b', 'c'], selected_variables=['a', 'c'])
+        observation = [0.5, 100, 'x']
+        expected = np.argsort(gower_distances(self.df[['a', 'c']], pd.Series([0.5, 'x'])), kind='mergesort')[:6]
+        np.testing.assert_array_equal(index.query(observation, n=6), expected)
+
+    def test_query_4(self):
+        index = NeighbourIndex(self.df[['a', 'b']].values, dist_fun=euclidean_distances)
+        neighbours = index.query(self.df[['a', 'b']].values[:2], n=3)
+        np.testing.assert_array_equal(neighbours[:, 0], [0, 1])
+
+    def test_query_tree(self):
+        numeric = self.df[['a', 'b']]
+        index = NeighbourIndex(numeric)
+        tree_index = NeighbourIndex(numeric, tree='kd_tree')
+        self.assertIsNotNone(tree_index._tree)
+        np.testing.assert_array_equal(tree_index.query(numeric.iloc[:10], n=5), index.query(numeric.iloc[:10], n=5))
+
+    def test_query_tree_2(self):
+        # warning expected, tree is not supported for categorical data
+        index = NeighbourIndex(self.df, tree='ball_tree')
+        self.assertIsNone(index._tree)
+
+    def test_query_blocks(self):
+        df = self.df.copy()
+        df.loc[[4, 9], 'a'] = np.nan
+        df.loc[[5, 12], 'c'] = np.nan
+        observations = df.iloc[:30]
+        index = NeighbourIndex(df)
+        expected = np.array([index.query(observation, n=7) for _, observation in observations.iterrows()])
+        np.testing.assert_array_equal(index.query(observations, n=7, query_block_size=8, data_block_size=16), expected)
+        np.testing.assert_array_equal(index.query(observations, n=7, query_block_size=8, data_block_size=16,
+                                                  n_jobs=2), expected)
+
+    def test_select_neighbours_batch(self):
+        observations = self.df.iloc[[3, 8, 11]].values
+        neighbours = select_neighbours_batch(self.df, observations, n=4, data_block_size=50)
+        np.testing.assert_array_equal(neighbours, NeighbourIndex(self.df).query(self.df.iloc[[3, 8, 11]], n=4))
+        neighbours = select_neighbours_batch(self.df[['a', 'b']].values, observations[:, :2], n=3,
+                                             dist_fun=euclidean_distances, data_block_size=7)
+        distances = euclidean_distances(observations[:, :2].astype(float), self.df[['a', 'b']].values)
+        np.testing.assert_array_equal(neighbours, np.argsort(distances, axis=1)[:, :3])
+
+    def test_select(self):
+        index = NeighbourIndex(self.df, self.y)
+        sample_x, sample_y = index.select(self.df.iloc[5], n=3)
+        self.assertEqual(sample_x.shape, (3, 3))
+        np.testing.assert_array_equal(sample_x['a'], self.df['a'].iloc[sample_y])
+
+    def test_select_2(self):
+        with self.assertRaises(ValueError):
+            NeighbourIndex(self.df, dist_fun='euclidean')
+
+
 class TestGower(unittest.TestCase):
 
     def setUp(self):
@@ -170,6 +300,14 @@ class TestGower(unittest.TestCase):
                                              np.array([0, 0.3590, 0.6707, 0.3178, 0.1687, 0.5262, 0.5969, 0.4777]),
                                              decimal=3)
 
+    def test_gower_distances_block(self):
+        encoded = _encode_mixed_data(self.X)
+        observations = [self.observation, _normalize_mixed_data_columns(self.observation_missing)]
+        numeric, codes = _encode_observations(encoded, observations)
+        distances = _gower_distances_block(encoded, numeric, codes, slice(2, 7))
+        for i, observation in enumerate(observations):
+            np.testing.assert_array_equal(distances[i], gower_distances(self.X, observation)[2:7])
+
     def test_gower_dist_1(self):
         # test dist(a, a) == 0
         distance = _gower_dist(self.observation, self.observation, self.ranges, self.X.dtypes)
@@ -195,3 +333,33 @@ class TestGower(unittest.TestCase):
         ranges = _calc_range_mixed_data_columns(X_with_nans, self.observation, dtypes)
         distance = _gower_dist(X_with_nans[-1], self.observation, ranges, dtypes)
         self.assertAlmostEqual(distance, 0.7727, delta=0.0001)
+
+    def test_gower_distances_2(self):
+        # vectorized distances are the same as calculated pair by pair
+        observations = [self.observation, self.observation_missing, _normalize_mixed_data_columns(self.X.iloc[3])]
+        X = pd.concat([self.X, pd.DataFrame({'age': [25], 'salary': [1000.0], 'available_credit': [300],
+                                             'children': [True]})], ignore_index=True)
+        dtypes = X.dtypes
+        arr = _normalize_mixed_data_columns(X)
+        for observation in observations:
+            ranges = _calc_range_mixed_data_columns(arr, observation, dtypes)
+            expected = [_gower_dist(row, observation, ranges, dtypes) for row in arr]
+            np.testing.assert_array_almost_equal(gower_distances(X, observation), expected, decimal=12)
+
+    def test_gower_distances_3(self):
+        distances = gower_distances(self.X, self.X.iloc[0], dtype=np.float32)
+        self.assertEqual(distances.dtype, np.float32)
+        np.testing.assert_array_almost_equal(distances, gower_distances(self.X, self.X.iloc[0]), decimal=5)
+
+    def test_gower_distances_nan_first_row(self):
+        # ranges skip missing values, also in the first row
+        X = pd.DataFrame({'a': [np.nan, 1., 3.], 'b': ['x', 'y', 'x']})
+        distances = gower_distances(X, _normalize_mixed_data_columns([2., 'x']))
+        np.testing.assert_array_almost_equal(distances, [0, 0.75, 0.25])
+
+    def test_encode_observation(self):
+        encoded = _encode_mixed_data(self.X)
+        np.testing.assert_array_equal(encoded.numeric_mask, [True, False, False, True, False, True])
+        numeric, codes = _encode_observation(encoded, [22, 'F', 'UNKNOWN', np.nan, np.nan, 1000])
+        np.testing.assert_array_equal(numeric, [22, np.nan, 1000])
+        np.testing.assert_array_equal(codes, [2, -2, -1])
@@ -0,0 +1,116 @@
+import unittest
+from unittest.mock import MagicMock
+
+import numpy as np
+import pandas as pd
+
+from ceteris_paribus.explainer import explain
+from ceteris_paribus.profiles import individual_variable_profile
+from ceteris_paribus.sketches import QuantileSketch, SplitSketch, capped_split, sketch_splits
+
+
+class TestQuantileSketch(unittest.TestCase):
+
+    def setUp(self):
+        self.values = np.random.RandomState(42).normal(size=100000)
+        self.q = np.linspace(0, 1, 21)
+
+    def _rank_error(self, quantiles):
+        ranks = np.searchsorted(np.sort(self.values), quantiles) / len(self.values)
+        return np.max(np.abs(ranks - self.q))
+
+    def test_quantiles(self):
+        sketch = QuantileSketch().update(self.values)
+        quantiles = sketch.quantiles(self.q)
+        self.assertEqual(sketch.count, len(self.values))
+        self.assertEqual(quantiles[0], self.values.min())
+        self.assertEqual(quantiles[-1], self.values.max())
+        self.assertLess(self._rank_error(quantiles), 0.02)
+        # memory is much smaller than the data
+        self.assertLess(sum(len(items) for items in sketch._levels), 2000)
+
+    def test_merge(self):
+        sketches = [QuantileSketch(seed=i).update(chunk) for i, chunk in enumerate(np.array_split(self.values, 10))]
+        sketch = sketches[0]
+        for other in sketches[1:]:
+            sketch.merge(other)
+        self.assertEqual(sketch.count, len(self.values))
+        self.assertLess(self._rank_error(sketch.quantiles(self.q)), 0.02)
+
+    def test_small(self):
+        sketch = QuantileSketch().update([3., 1., np.nan, 2.])
+        self.assertEqual(sketch.count, 3)
+        np.testing.assert_array_equal(sketch.quantiles([0, 0.5, 1]), [1, 2, 3])
+
+    def test_empty(self):
+        self.assertTrue(np.isnan(QuantileSketch().quantiles([0.5])).all())
+
+    def test_reproducible(self):
+        np.testing.assert_array_equal(QuantileSketch().update(self.values).quantiles(self.q),
+                                      QuantileSketch().update(self.values).quantiles(self.q))
+
+
+class TestSplitSketch(unittest.TestCase):
+
+    def test_split_float(self):
+        split = SplitSketch(grid_points=5).update(np.linspace(0, 1, 1001)).split()
+        np.testing.assert_allclose(split, [0, 0.25, 0.5, 0.75, 1], atol=0.01)
+
+    def test_split_integers(self):
+        sketch = SplitSketch(max_categories=10)
+        sketch.update(np.array([1, 2, 2, 3]))
+        np.testing.assert_array_equal(sketch.split(), [1, 2, 3])
+        sketch.update(np.arange(1000))
+        split = sketch.split()
+        self.assertLessEqual(len(split), 10)
+        self.assertEqual(split.dtype, np.arange(1).dtype)
+        self.assertEqual((split[0], split[-1]), (0, 999))
+
+    def test_split_categories(self):
+        sketch = SplitSketch(max_categories=2)
+        sketch.update(pd.Series(['a', 'b', 'b', 'c']))
+        sketch.update(pd.Series(['c', 'c', 'd']))
+        np.testing.assert_array_equal(sketch.split(), ['b', 'c'])
+        self.assertEqual(sketch.split().dtype, object)
+
+    def test_merge(self):
+        sketch = SplitSketch().update(pd.Series(['a', 'b']))
+        sketch.merge(SplitSketch().update(pd.Series(['c'])))
+        np.testing.assert_array_equal(sketch.split(), ['a', 'b', 'c'])
+
+    def test_capped_split(self):
+        np.testing.assert_array_equal(capped_split(np.array([1, 2, 1]), 5), [1, 2])
+        self.assertLessEqual(len(capped_split(np.arange(1000), 10)), 10)
+        np.testing.assert_array_equal(capped_split(pd.Series(['a', 'b', 'b', 'c', 'c', 'c']), 2), ['b', 'c'])
+
+    def test_sketch_splits(self):
+        df = pd.DataFrame({'a': np.arange(100) / 10., 'b': np.arange(100) % 3})
+        splits = sketch_splits([df.iloc[:50], df.iloc[50:]], ['a', 'b'], grid_points=3)
+        np.testing.assert_allclose(splits['a'], [0, 5, 9.9], atol=0.2)
+        np.testing.assert_array_equal(splits['b'], [0, 1, 2])
+
+
+class TestSketchProfiles(unittest.TestCase):
+
+    def setUp(self):
+        np.random.seed(42)
+        self.data = pd.DataFrame({'a': np.random.random(1000), 'b': np.random.randint(0, 500, 1000)})
+        model = MagicMock(predict=MagicMock(side_effect=lambda df: (df['a'] * df['b']).values))
+        self.explainer = explain(model, data=self.data, label='model')
+
+    def test_profile_sketch(self):
+        cp = individual_variable_profile(self.explainer, self.data.iloc[:2], grid_points=11, split_method='sketch',
+                                         max_categories=20)
+        self.assertEqual(len(cp._variable_splits['a']), 11)
+        self.assertLessEqual(len(cp._variable_splits['b']), 20)
+        np.testing.assert_allclose(cp._variable_splits['a'], np.quantile(self.data['a'], np.linspace(0, 1, 11)),
+                                   atol=0.05)
+
+    def test_profile_max_categories(self):
+        cp = individual_variable_profile(self.explainer, self.data.iloc[:2], variables=['b'], max_categories=20)
+        self.assertLessEqual(len(cp._variable_splits['b']), 20)
+        self.assertEqual(len(cp.profile), 2 * len(cp._variable_splits['b']))
+
+    def test_incorrect_method(self):
+        with self.assertRaises(ValueError):
+            individual_variable_profile(self.explainer, self.data.iloc[:2], split_method='tdigest')
@@ -0,0 +1,119 @@
+import unittest
+from unittest.mock import MagicMock
+
+import numpy as np
+import pandas as pd
+from sklearn.ensemble import GradientBoostingRegressor, RandomForestClassifier, HistGradientBoostingRegressor
+from sklearn.linear_model import LinearRegression
+from sklearn.tree import DecisionTreeRegressor
+
+from ceteris_paribus.explainer import explain
+from ceteris_paribus.profiles import individual_variable_profile
+from ceteris_paribus.trees import model_thresholds, threshold_split, _feature_name
+
+try:
+    import xgboost
+except ImportError:
+    xgboost = None
+
+try:
+    import lightgbm
+except ImportError:
+    lightgbm = None
+
+
+class TestThresholds(unittest.TestCase):
+
+    def setUp(self):
+        random_state = np.random.RandomState(42)
+        self.X = pd.DataFrame({'a': random_state.random_sample(300), 'b': random_state.randint(0, 20, 300),
+                               'c': random_state.random_sample(300)})
+        self.y = 3 * self.X['a'] + self.X['b'] + random_state.random_sample(300)
+
+    def test_decision_tree(self):
+        model = DecisionTreeRegressor(max_depth=3, random_state=42).fit(self.X.values, self.y)
+        thresholds = model_thresholds(model, ['a', 'b', 'c'])
+        split_nodes = model.tree_.feature >= 0
+        self.assertEqual(sum(len(values) for values in thresholds.values()),
+                         len(np.unique(list(zip(model.tree_.feature[split_nodes],
+                                                model.tree_.threshold[split_nodes])), axis=0)))
+        for var, values in thresholds.items():
+            self.assertTrue((np.diff(values) > 0).all())
+
+    def test_ensembles(self):
+        for model in [GradientBoostingRegressor(n_estimators=5, random_state=42),
+                      HistGradientBoostingRegressor(max_iter=5)]:
+            thresholds = model_thresholds(model.fit(self.X, self.y), ['a', 'b', 'c'])
+            self.assertTrue({'a', 'b'}.issubset(thresholds))
+        model = RandomForestClassifier(n_estimators=3, random_state=42).fit(self.X.values, self.y > 10)
+        self.assertIn('b', model_thresholds(model, ['a', 'b', 'c']))
+
+    def test_feature_names(self):
+        # names stored in the model take precedence over positions
+        model = DecisionTreeRegressor(max_depth=3).fit(self.X[['c', 'a']], self.y)
+        self.assertEqual(set(model_thresholds(model, ['a', 'b', 'c'])), {'a', 'c'})
+        self.assertEqual(_feature_name('f1', ['x', 'y']), 'y')
+        self.assertEqual(_feature_name('Column_0', ['x', 'y']), 'x')
+        self.assertEqual(_feature_name('y', ['x', 'y']), 'y')
+
+    def test_unsupported(self):
+        with self.assertRaises(ValueError):
+            model_thresholds(LinearRegression().fit(self.X, self.y), ['a', 'b', 'c'])
+
+    def test_threshold_split(self):
+        split = threshold_split(np.array([0.25, 0.5, 2.]), np.array([0., 0.4, 1.]))
+        self.assertEqual(len(split), 6)
+        self.assertEqual((split[0], split[-1]), (0, 1))
+        self.assertTrue(split[1] < 0.25 < split[2] < split[3] < 0.5 < split[4])
+        self.assertEqual(split[3], np.float32(split[3]))
+        np.testing.assert_array_equal(threshold_split(np.array([2.5, 4.]), np.arange(10)), [0, 2, 3, 4, 5, 9])
+        np.testing.assert_array_equal(threshold_split(np.array([]), np.array([1., 2., 3.])), [1, 3])
+
+
+class TestTreeProfiles(unittest.TestCase):
+
+    def setUp(self):
+        random_state = np.random.RandomState(42)
+        self.X = pd.DataFrame({'a': random_state.random_sample(300), 'b': random_state.randint(0, 20, 300),
+                               'c': random_state.random_sample(300), 'd': random_state.choice(['x', 'y'], 300)})
+        self.y = 3 * self.X['a'] + self.X['b'] + random_state.random_sample(300)
+
+    def assert_exact(self, model, variables):
+        calls = []
+        predict = lambda df: calls.append(len(df)) or model.predict(df[variables].values)
+        explainer = explain(model, list(self.X.columns), data=self.X, predict_function=predict, label='tree')
+        cp = individual_variable_profile(explainer, self.X.iloc[:3], engine='tree')
+        tree_rows = sum(calls)
+        dense = individual_variable_profile(explainer, self.X.iloc[:3], grid_points=1001)
+        self.assertLess(tree_rows, (sum(calls) - tree_rows) / 10)
+        for var in variables:
+            split = cp._variable_splits[var]
+            # every point of the dense grid falls into a piece represented by the closest point of the split from the left
+            pieces = np.searchsorted(split, dense._variable_splits[var], side='right') - 1
+            np.testing.assert_allclose(cp._predictions[var][:, pieces], dense._predictions[var])
+        np.testing.assert_array_equal(cp._variable_splits['d'], ['x', 'y'])
+        return cp
+
+    def test_decision_tree(self):
+        model = DecisionTreeRegressor(max_depth=4, random_state=42).fit(self.X[['a', 'b', 'c']].values, self.y)
+        self.assert_exact(model, ['a', 'b', 'c'])
+
+    def test_gradient_boosting(self):
+        model = GradientBoostingRegressor(n_estimators=10, max_depth=2, random_state=42)
+        cp = self.assert_exact(model.fit(self.X[['a', 'b', 'c']].values, self.y), ['a', 'b', 'c'])
+        self.assertEqual(cp._variable_splits['b'].dtype, self.X['b'].dtype)
+
+    def test_incorrect_engine(self):
+        explainer = MagicMock(data=self.X, var_names=list(self.X.columns), predict_fun=len, label='tree')
+        with self.assertRaises(ValueError):
+            individual_variable_profile(explainer, self.X.iloc[:1], engine='forest')
+
+    @unittest.skipIf(xgboost is None, "xgboost not installed")
+    def test_xgboost(self):
+        model = xgboost.XGBRegressor(n_estimators=10, max_depth=2).fit(self.X[['a', 'b', 'c']].values, self.y)
+        self.assert_exact(model, ['a', 'b', 'c'])
+
+    @unittest.skipIf(lightgbm is None, "lightgbm not installed")
+    def test_lightgbm(self):
+        model = lightgbm.LGBMRegressor(n_estimators=10, num_leaves=4).fit(self.X[['a', 'b', 'c']].values, self.y)
+        self.assert_exact(model, ['a', 'b', 'c'])